@@ -0,0 +1,186 @@
+"""Approximate nearest-neighbour index (IVF) over normalized embedding matrices"""
+
+import time
+from typing import Callable, Dict, List, Sequence
+
+import numpy as np
+
+INDEX_FILE = 'ivf_index.npz'
+DEFAULT_N_PROBE = 8
+
+
+def kmeans(matrix, n_clusters, n_iter=20, seed=0, max_train=None, block_size=8192, spherical=True):
+    """k-means over the rows of matrix.
+
+    spherical=True clusters normalized rows by cosine similarity and returns
+    L2-normalized centroids; spherical=False is plain Euclidean k-means.
+    """
+    rng = np.random.default_rng(seed)
+    n_rows = matrix.shape[0]
+
+    # Train on a sample, the coarse quantizer does not need every row
+    max_train = max_train or 256 * n_clusters
+    if n_rows > max_train:
+        train = np.asarray(matrix[np.sort(rng.choice(n_rows, max_train, replace=False))], dtype=np.float32)
+    else:
+        train = np.asarray(matrix, dtype=np.float32)
+
+    centroids = train[rng.choice(train.shape[0], n_clusters, replace=False)].copy()
+    for _ in range(n_iter):
+        assignments = assign(train, centroids, block_size, spherical)
+        counts = np.bincount(assignments, minlength=n_clusters)
+        # Per-dimension weighted bincounts are much faster than np.add.at
+        sums = np.stack([np.bincount(assignments, weights=train[:, d], minlength=n_clusters)
+                         for d in range(train.shape[1])], axis=1).astype(np.float32)
+
+        # Re-seed empty clusters from random training rows
+        empty = np.flatnonzero(counts == 0)
+        if len(empty):
+            sums[empty] = train[rng.choice(train.shape[0], len(empty), replace=False)]
+            counts[empty] = 1
+
+        if spherical:
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            norms[norms == 0] = 1.0
+            centroids = sums / norms
+        else:
+            centroids = sums / counts[:, None]
+    return centroids.astype(np.float32)
+
+
+def assign(matrix, centroids, block_size=8192, spherical=True):
+    """Index of the most similar (or, if not spherical, the nearest) centroid for every row, in blocks"""
+    assignments = np.empty(matrix.shape[0], dtype=np.int64)
+    # ||x - c||^2 ranks like ||c||^2 - 2 x.c, since ||x|| is the same for every centroid
+    centroid_norms = None if spherical else 0.5 * np.sum(centroids * centroids, axis=1)
+    for start in range(0, matrix.shape[0], block_size):
+        block = np.asarray(matrix[start:start + block_size], dtype=np.float32)
+        similarity = block @ centroids.T
+        if centroid_norms is not None:
+            similarity -= centroid_norms
+        assignments[start:start + block_size] = np.argmax(similarity, axis=1)
+    return assignments
+
+
+class IVFIndex:
+    """Inverted file index: rows are bucketed by their nearest k-means centroid.
+
+    A query scores only the rows in its n_probe closest buckets. Larger
+    n_probe means better recall and slower queries; n_probe == n_lists is
+    exact search.
+    """
+
+    def __init__(self, centroids, offsets, rows):
+        self.centroids = centroids  # (n_lists, dim)
+        self.offsets = offsets      # (n_lists + 1,) start of each list in rows
+        self.rows = rows            # row ids grouped by list
+
+    @property
+    def n_lists(self):
+        return self.centroids.shape[0]
+
+    @classmethod
+    def build(cls, matrix, n_lists=None, n_iter=20, seed=0):
+        """Cluster the rows of a normalized matrix into n_lists buckets"""
+        n_rows = matrix.shape[0]
+        if n_rows == 0:
+            raise ValueError("Cannot build an index over an empty matrix")
+
+        # sqrt(N) lists keeps both the centroid scan and the list scans small
+        n_lists = min(n_lists or max(1, int(np.sqrt(n_rows))), n_rows)
+
+        start = time.time()
+        centroids = kmeans(matrix, n_lists, n_iter=n_iter, seed=seed)
+        assignments = assign(matrix, centroids)
+
+        rows = np.argsort(assignments, kind='stable').astype(np.int64)
+        offsets = np.zeros(n_lists + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(assignments, minlength=n_lists))
+        print(f"Built IVF index with {n_lists} lists over {n_rows} rows in {time.time() - start:.1f}s")
+        return cls(centroids, offsets, rows)
+
+    def candidates(self, query, n_probe=DEFAULT_N_PROBE):
+        """Row ids in the n_probe lists closest to a normalized query vector"""
+        n_probe = max(1, min(n_probe, self.n_lists))
+        centroid_scores = self.centroids @ query
+        if n_probe < self.n_lists:
+            probe = np.argpartition(-centroid_scores, n_probe - 1)[:n_probe]
+        else:
+            probe = np.arange(self.n_lists)
+        return np.concatenate([self.rows[self.offsets[i]:self.offsets[i + 1]] for i in probe])
+
+    def save(self, path):
+        np.savez(path, centroids=self.centroids, offsets=self.offsets, rows=self.rows)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        return cls(data['centroids'], data['offsets'], data['rows'])
+
+
+def sample_queries(matrix, n_queries=200, noise=0.05, seed=0):
+    """Perturbed stored rows, used as stand-in queries when no real ones are given"""
+    rng = np.random.default_rng(seed)
+    picks = rng.choice(matrix.shape[0], min(n_queries, matrix.shape[0]), replace=False)
+    queries = np.asarray(matrix[picks], dtype=np.float32)
+    queries = queries + rng.normal(0, noise, queries.shape).astype(np.float32)
+    return queries / np.linalg.norm(queries, axis=1, keepdims=True)
+
+
+def recall_at_k(matrix, queries, search_fn: Callable[[np.ndarray, int], Sequence[int]], k=10):
+    """Mean fraction of the exact top-k rows that search_fn also returns, plus mean latency in ms"""
+    hits = 0
+    elapsed = 0.0
+    for query in queries:
+        exact = np.argsort(-(matrix @ query))[:k]
+        start = time.perf_counter()
+        found = search_fn(query, k)
+        elapsed += time.perf_counter() - start
+        hits += len(set(np.asarray(found).tolist()) & set(exact.tolist()))
+    return hits / (len(queries) * min(k, matrix.shape[0])), 1000 * elapsed / len(queries)
+
+
+def recall_report(matrix, index: IVFIndex, queries=None, k=10,
+                  n_probe_values=(1, 2, 4, 8, 16, 32)) -> List[Dict]:
+    """Print and return recall@k and latency of the index against exact search"""
+    queries = sample_queries(matrix) if queries is None else queries
+
+    def exact(query, top_k):
+        scores = matrix @ query
+        return np.argpartition(-scores, top_k - 1)[:top_k] if top_k < len(scores) else np.arange(len(scores))
+
+    _, exact_ms = recall_at_k(matrix, queries, exact, k)
+    print(f"Exact search: {exact_ms:.3f} ms/query over {matrix.shape[0]} rows")
+
+    report = []
+    for n_probe in n_probe_values:
+        if n_probe > index.n_lists:
+            break
+
+        def ivf(query, top_k, n_probe=n_probe):
+            rows = index.candidates(query, n_probe)
+            scores = matrix[rows] @ query
+            if top_k < len(scores):
+                return rows[np.argpartition(-scores, top_k - 1)[:top_k]]
+            return rows
+
+        recall, ms = recall_at_k(matrix, queries, ivf, k)
+        report.append({'n_probe': n_probe, 'recall': recall, 'ms_per_query': ms})
+        print(f"n_probe={n_probe:<4} recall@{k}={recall:.3f}  {ms:.3f} ms/query")
+    return report
+
+
+if __name__ == '__main__':
+    import argparse
+    import os
+    from vector_store import read_store, resolve_store_dir
+
+    parser = argparse.ArgumentParser(description="Report IVF recall@k against exact search")
+    parser.add_argument("store", help="Store directory, e.g. vector_db/stripe")
+    parser.add_argument("--k", type=int, default=10)
+    args = parser.parse_args()
+
+    _, embeddings, _ = read_store(args.store)
+    index_path = os.path.join(resolve_store_dir(args.store), INDEX_FILE)
+    ivf_index = IVFIndex.load(index_path) if os.path.exists(index_path) else IVFIndex.build(embeddings)
+    recall_report(embeddings, ivf_index, k=args.k)
@@ -1,14 +1,19 @@
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, Response, request, jsonify, render_template, stream_with_context
 import os
 import json
 import argparse
+import uuid
 
 # Import all necessary components (assuming they're defined in separate modules)
 from intent_recognizer import IntentRecognizer
-from vector_store import VectorStore
+from intent_classifier import SemanticIntentClassifier
+from store_manager import StoreManager
 from code_generator import CodeGenerator
 from payment_api_agent import PaymentAPIAgent, PaymentAPIAgentWithLLM
 from llm_service import LLMService
+from semantic_cache import SemanticCache, BACKENDS, MemoryBackend, SQLiteBackend
+from session_store import SessionStore
+import model_registry
 
 app = Flask(__name__)
 
@@ -34,20 +39,39 @@ def initialize_agent(use_llm=True):
     for directory in directories:
         os.makedirs(directory, exist_ok=True)
 
+    # Load the shared embedding model now instead of on the first request
+    if os.environ.get("WARMUP_MODELS", "").lower() in ("1", "true", "yes"):
+        print("Warming up embedding model...")
+        model_registry.warmup()
+
     # Step 1: Initialize the intent recognizer
     print("Initializing intent recognizer...")
     intent_recognizer = IntentRecognizer()
+    intent_classifier = None
+    if os.environ.get("SEMANTIC_INTENTS", "").lower() in ("1", "true", "yes"):
+        # Classify queries the patterns miss by their embedding; unclear ones get a clarifying question
+        intent_classifier = SemanticIntentClassifier(
+            min_confidence=float(os.environ.get("INTENT_MIN_CONFIDENCE", "0.35"))
+        )
 
     # Step 2: Create mock vector stores for this example
     # In production, you'd run the scraping and embedding scripts first
     print("Initializing vector stores...")
+    store_options = {
+        'index_type': os.environ.get("VECTOR_INDEX", "flat"),
+        'n_probe': int(os.environ.get("IVF_N_PROBE", "8")),
+        'search_mode': os.environ.get("SEARCH_MODE", "dense"),
+        'quantization': os.environ.get("VECTOR_QUANTIZATION") or None,
+        'rerank_factor': int(os.environ.get("RERANK_FACTOR", "4"))
+    }
+    # New snapshots published by populate_kb.py are picked up without a restart
+    store_paths = {
+        'stripe': "vector_db/stripe",
+        'paypal': "vector_db/paypal"
+    }
+    poll_interval = int(os.environ.get("STORE_POLL_INTERVAL", "30"))
     try:
-        paypal_store = VectorStore("vector_db/paypal/embeddings.json")
-        stripe_store = VectorStore("vector_db/stripe/embeddings.json")
-        vector_stores = {
-            'stripe': stripe_store,
-            'paypal': paypal_store
-        }
+        vector_stores = StoreManager(store_paths, store_options, poll_interval)
     except FileNotFoundError:
         # Create mock vector stores with empty data
         print("Vector store files not found. Creating mock stores...")
@@ -57,19 +81,15 @@ def initialize_agent(use_llm=True):
                 json.dump([], f)
 
         # Retry loading
-        paypal_store = VectorStore("vector_db/paypal/embeddings.json")
-        stripe_store = VectorStore("vector_db/stripe/embeddings.json")
-        vector_stores = {
-            'stripe': stripe_store,
-            'paypal': paypal_store
-        }
+        vector_stores = StoreManager(store_paths, store_options, poll_interval)
+    vector_stores.start()
 
     # Step 3: Initialize code generator
     print("Initializing code generator...")
-    # Create sample templates if not exists
-    templates_file = "code_examples/templates.json"
-    if not os.path.exists(templates_file):
-        example_templates = {
+    # Create sample templates if not exists, one file per provider
+    templates_dir = os.path.join("code_examples", "templates")
+    if not os.path.exists("code_examples/templates.json") and not os.path.isdir(templates_dir):
+        stripe_templates = {
             "stripe_payment_processing_javascript": {
                 "code": "const stripe = require('stripe')('YOUR_STRIPE_SECRET_KEY');\n\nasync function createPayment() {\n  try {\n    const paymentIntent = await stripe.paymentIntents.create({\n      amount: 1000, // Amount in cents\n      currency: 'usd',\n      payment_method_types: ['card'],\n      description: 'Software development services',\n    });\n    return paymentIntent;\n  } catch (error) {\n    console.error('Error creating payment:', error);\n  }\n}",
                 "explanation": "This code creates a PaymentIntent in Stripe, which is the recommended way to accept payments. The amount is in cents (1000 = $10.00).",
@@ -81,12 +101,20 @@ def initialize_agent(use_llm=True):
                 "requires": ["stripe Python package"]
             }
         }
-        os.makedirs("code_examples", exist_ok=True)
-        with open(templates_file, 'w') as f:
-            json.dump(example_templates, f)
+        os.makedirs(templates_dir, exist_ok=True)
+        with open(os.path.join(templates_dir, "stripe.json"), 'w') as f:
+            json.dump(stripe_templates, f)
 
     code_generator = CodeGenerator("code_examples")
 
+    # Conversation state per browser session, bounded and dropped when idle
+    session_store = SessionStore(
+        max_turns=int(os.environ.get("SESSION_MAX_TURNS", "20")),
+        idle_timeout=int(os.environ.get("SESSION_IDLE_TIMEOUT", "3600")),
+        max_sessions=int(os.environ.get("SESSION_MAX_SESSIONS", "10000")),
+        path=os.environ.get("SESSION_STORE_PATH") or None
+    )
+
     # Step 4: Initialize LLM service if requested
     if True:
         print("Initializing LLM service...")
@@ -96,16 +124,38 @@ def initialize_agent(use_llm=True):
             print("Please set your API key: export LLM_API_KEY=your_key_here")
 
         llm_service = LLMService(api_key=api_key)
-        agent = PaymentAPIAgentWithLLM(intent_recognizer, vector_stores, code_generator, llm_service)
+        agent = PaymentAPIAgentWithLLM(intent_recognizer, vector_stores, code_generator, llm_service,
+                                       semantic_cache=initialize_semantic_cache(), session_store=session_store,
+                                       intent_classifier=intent_classifier)
         print("Agent with LLM integration initialized!")
     else:
         # Use the base agent without LLM
-        agent = PaymentAPIAgent(intent_recognizer, vector_stores, code_generator)
+        agent = PaymentAPIAgent(intent_recognizer, vector_stores, code_generator, session_store, intent_classifier)
         print("Base agent initialized!")
 
     return agent
 
 
+def initialize_semantic_cache():
+    """SemanticCache of LLM answers configured from the environment, or None if disabled"""
+    backend_name = os.environ.get("SEMANTIC_CACHE", "memory").lower()
+    if backend_name in ("", "0", "off", "none"):
+        return None
+    if backend_name not in BACKENDS:
+        print(f"Unknown SEMANTIC_CACHE backend {backend_name!r}, expected one of {sorted(BACKENDS)}; disabling it")
+        return None
+
+    max_entries = int(os.environ.get("SEMANTIC_CACHE_SIZE", "10000"))
+    ttl = int(os.environ.get("SEMANTIC_CACHE_TTL", str(24 * 3600)))
+    if backend_name == "sqlite":
+        backend = SQLiteBackend(os.environ.get("SEMANTIC_CACHE_PATH", "vector_db/semantic_cache.sqlite3"),
+                                max_entries=max_entries, ttl=ttl)
+    else:
+        backend = MemoryBackend(max_entries=max_entries, ttl=ttl)
+    print(f"Semantic answer cache: {backend_name} backend")
+    return SemanticCache(backend, threshold=float(os.environ.get("SEMANTIC_CACHE_THRESHOLD", "0.92")))
+
+
 # Parse command line arguments
 parser = argparse.ArgumentParser(description="Payment API Integration Agent")
 parser.add_argument("--llm", action="store_true", help="Enable LLM integration")
@@ -120,6 +170,21 @@ def index():
     return render_template('index.html')
 
 
+SESSION_COOKIE = "session_id"
+
+# Batch requests: queries accepted per request, and LLM calls in flight at once for one batch
+MAX_BATCH_QUERIES = int(os.environ.get("MAX_BATCH_QUERIES", "100"))
+LLM_BATCH_CONCURRENCY = int(os.environ.get("LLM_BATCH_CONCURRENCY", "8"))
+
+
+def request_session_id(data, cookies):
+    """Session id from the request body or cookie, or a new one"""
+    session_id = data.get('session_id') or cookies.get(SESSION_COOKIE)
+    if isinstance(session_id, str) and 0 < len(session_id) <= 64:
+        return session_id
+    return uuid.uuid4().hex
+
+
 @app.route('/api/query', methods=['POST'])
 def process_query():
     data = request.json
@@ -128,13 +193,85 @@ def process_query():
     if not user_query:
         return jsonify({"error": "No query provided"}), 400
 
+    session_id = request_session_id(data, request.cookies)
     try:
-        response = agent.process_query(user_query)
-        return jsonify(response)
+        response = agent.process_query(user_query, session_id=session_id)
+        response["session_id"] = session_id
+        http_response = jsonify(response)
+        http_response.set_cookie(SESSION_COOKIE, session_id, httponly=True, samesite='Lax')
+        return http_response
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 
+def batch_queries(data):
+    """The queries of a batch request, or an error message"""
+    queries = data.get('queries') if isinstance(data, dict) else None
+    if not isinstance(queries, list) or not queries:
+        return None, "No queries provided"
+    if len(queries) > MAX_BATCH_QUERIES:
+        return None, f"At most {MAX_BATCH_QUERIES} queries per batch"
+    if not all(isinstance(query, str) and query.strip() for query in queries):
+        return None, "Every query must be a non-empty string"
+    return queries, None
+
+
+@app.route('/api/query/batch', methods=['POST'])
+def process_batch():
+    queries, error = batch_queries(request.json)
+    if error:
+        return jsonify({"error": error}), 400
+
+    try:
+        return jsonify({"responses": agent.process_batch(queries, max_concurrency=LLM_BATCH_CONCURRENCY)})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+def sse_event(event, data):
+    """Format one server-sent event"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+# Server-sent events should reach the browser as they are written, not buffered by a proxy
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+
+@app.route('/api/query/stream', methods=['POST'])
+def stream_query():
+    data = request.json
+    user_query = data.get('query', '')
+
+    if not user_query:
+        return jsonify({"error": "No query provided"}), 400
+
+    session_id = request_session_id(data, request.cookies)
+
+    def generate():
+        try:
+            for event, payload in agent.stream_query(user_query, session_id=session_id):
+                yield sse_event(event, payload)
+        except Exception as e:
+            yield sse_event("error", {"error": str(e)})
+
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream', headers=SSE_HEADERS)
+    response.set_cookie(SESSION_COOKIE, session_id, httponly=True, samesite='Lax')
+    return response
+
+
+@app.route('/api/stats', methods=['GET'])
+def stats():
+    # Cache counters for the query embedding caches and each store's result cache
+    return jsonify({
+        "query_embeddings": model_registry.cache_stats(),
+        "search_results": {provider: store.cache_stats() for provider, store in agent.vector_stores.items()},
+        "store_versions": agent.vector_stores.versions(),
+        "store_swaps": agent.vector_stores.swaps,
+        "semantic_cache": agent.semantic_cache.stats() if getattr(agent, 'semantic_cache', None) else None,
+        "sessions": agent.sessions.stats()
+    })
+
+
 @app.route('/api/scrape', methods=['POST'])
 def scrape_documentation():
     # This endpoint would trigger the documentation scraping process
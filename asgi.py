@@ -0,0 +1,109 @@
+"""ASGI entry point: uvicorn asgi:app
+
+/api/query, /api/query/stream and /api/query/batch are served natively with async LLM calls,
+so one worker can hold hundreds of requests waiting on the LLM API. Query
+encoding and search run in a bounded thread pool. Every other route is the Flask app from app.py,
+mounted as WSGI.
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+from starlette.applications import Starlette
+from starlette.middleware.wsgi import WSGIMiddleware
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Mount, Route
+
+from app import (agent, app as flask_app, sse_event, SSE_HEADERS, SESSION_COOKIE, request_session_id,
+                 batch_queries, LLM_BATCH_CONCURRENCY)
+
+# Encoding and search are CPU bound, so more threads than cores only adds contention
+search_executor = ThreadPoolExecutor(max_workers=int(os.environ.get("SEARCH_WORKERS", str(os.cpu_count() or 4))),
+                                     thread_name_prefix="search")
+
+
+async def read_query(request: Request):
+    """(query, session id) of a query request"""
+    try:
+        data = await request.json()
+    except ValueError:
+        data = {}
+    if not isinstance(data, dict):
+        data = {}
+    return data.get('query', ''), request_session_id(data, request.cookies)
+
+
+async def process_query(request: Request):
+    user_query, session_id = await read_query(request)
+
+    if not user_query:
+        return JSONResponse({"error": "No query provided"}, status_code=400)
+
+    try:
+        response = await agent.aprocess_query(user_query, executor=search_executor, session_id=session_id)
+        response["session_id"] = session_id
+        http_response = JSONResponse(response)
+        http_response.set_cookie(SESSION_COOKIE, session_id, httponly=True, samesite='lax')
+        return http_response
+    except Exception as e:
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+
+async def stream_query(request: Request):
+    user_query, session_id = await read_query(request)
+
+    if not user_query:
+        return JSONResponse({"error": "No query provided"}, status_code=400)
+
+    async def generate():
+        try:
+            async for event, payload in agent.astream_query(user_query, executor=search_executor,
+                                                            session_id=session_id):
+                yield sse_event(event, payload)
+        except Exception as e:
+            yield sse_event("error", {"error": str(e)})
+
+    response = StreamingResponse(generate(), media_type='text/event-stream', headers=SSE_HEADERS)
+    response.set_cookie(SESSION_COOKIE, session_id, httponly=True, samesite='lax')
+    return response
+
+
+async def process_batch(request: Request):
+    try:
+        data = await request.json()
+    except ValueError:
+        data = {}
+    queries, error = batch_queries(data)
+    if error:
+        return JSONResponse({"error": error}, status_code=400)
+
+    try:
+        responses = await agent.aprocess_batch(queries, executor=search_executor,
+                                               max_concurrency=LLM_BATCH_CONCURRENCY)
+        return JSONResponse({"responses": responses})
+    except Exception as e:
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    yield
+    # Close the pooled LLM connections, the search threads and the session database on shutdown
+    llm_service = getattr(agent, 'llm_service', None)
+    if llm_service is not None:
+        await llm_service.aclose()
+    search_executor.shutdown(wait=False)
+    agent.sessions.close()
+
+
+app = Starlette(
+    routes=[
+        Route('/api/query', process_query, methods=['POST']),
+        Route('/api/query/stream', stream_query, methods=['POST']),
+        Route('/api/query/batch', process_batch, methods=['POST']),
+        Mount('/', WSGIMiddleware(flask_app)),
+    ],
+    lifespan=lifespan
+)
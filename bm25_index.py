@@ -0,0 +1,162 @@
+"""Lexical BM25 index over store records, for exact identifiers that embeddings match poorly"""
+
+import re
+import time
+from collections import Counter
+from typing import Dict, Iterable, List
+
+import numpy as np
+
+BM25_FILE = 'bm25_index.npz'
+DEFAULT_K1 = 1.2
+DEFAULT_B = 0.75
+
+# Identifiers such as PaymentIntent, /v2/checkout/orders or PLATFORM_FEES.AMOUNT
+IDENTIFIER_PATTERN = re.compile(r'/?[A-Za-z0-9_]+(?:[./:-][A-Za-z0-9_]+)*')
+SEPARATOR_PATTERN = re.compile(r'[./:-]')
+CAMEL_PATTERN = re.compile(r'[A-Z]+(?![a-z])|[A-Z]?[a-z]+|[0-9]+')
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercased terms for text, keeping whole identifiers as well as their parts.
+
+    "/v2/checkout/orders" yields the full path plus "v2", "checkout" and
+    "orders"; "PaymentIntent" yields "paymentintent", "payment" and "intent".
+    Queries and documents go through the same function, so an exact
+    identifier in a query matches its compound term.
+    """
+    terms = []
+    for match in IDENTIFIER_PATTERN.finditer(text):
+        identifier = match.group(0)
+        if identifier.islower() and identifier.isalnum():
+            # Plain words, by far the most common case
+            terms.append(identifier)
+            continue
+
+        parts = [part for part in SEPARATOR_PATTERN.split(identifier.strip('/')) if part]
+        if len(parts) > 1 or identifier.startswith('/'):
+            terms.append(identifier.lower())
+
+        for part in parts:
+            terms.append(part.lower())
+            words = [word for piece in part.split('_') if piece
+                     for word in (CAMEL_PATTERN.findall(piece) if not piece.islower() and not piece.isupper()
+                                  else [piece])]
+            if len(words) > 1:
+                terms.extend(word.lower() for word in words)
+    return terms
+
+
+def lexical_text(record: Dict) -> str:
+    """The text of a store record that is indexed for lexical search"""
+    return f"{record.get('title', '')} {record.get('text', '')}"
+
+
+class BM25Builder:
+    """Accumulates term frequencies row by row, so records can be streamed in"""
+
+    def __init__(self):
+        self.vocabulary = {}
+        # One entry per (row, distinct term in the row), in row order
+        self.term_ids = []
+        self.rows = []
+        self.tfs = []
+        self.lengths = []
+
+    def add(self, records: Iterable[Dict]):
+        for record in records:
+            row = len(self.lengths)
+            terms = tokenize(lexical_text(record))
+            for term, tf in Counter(terms).items():
+                self.term_ids.append(self.vocabulary.setdefault(term, len(self.vocabulary)))
+                self.rows.append(row)
+                self.tfs.append(tf)
+            self.lengths.append(len(terms))
+
+    def build(self, k1=DEFAULT_K1, b=DEFAULT_B):
+        """Freeze the postings into a BM25Index with per-posting weights precomputed"""
+        start = time.time()
+        n_rows = len(self.lengths)
+        lengths = np.array(self.lengths, dtype=np.float32)
+        avg_length = float(lengths.mean()) if n_rows and lengths.sum() else 1.0
+
+        terms = sorted(self.vocabulary, key=self.vocabulary.get)
+        term_ids = np.array(self.term_ids, dtype=np.int64)
+        rows = np.array(self.rows, dtype=np.int32)
+        tf = np.array(self.tfs, dtype=np.float32)
+
+        # Group the postings by term; the stable sort keeps each list in row order
+        order = np.argsort(term_ids, kind='stable')
+        term_ids, rows, tf = term_ids[order], rows[order], tf[order]
+        df = np.bincount(term_ids, minlength=len(terms)).astype(np.float32)
+        offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(df)
+
+        # Everything in the BM25 sum except the query terms depends only on
+        # the document, so each posting stores its final contribution
+        idf = np.log(1.0 + (n_rows - df + 0.5) / (df + 0.5))
+        norm = k1 * (1.0 - b + b * lengths[rows] / avg_length)
+        weights = (idf[term_ids] * tf * (k1 + 1.0) / (tf + norm)).astype(np.float32)
+
+        print(f"Built BM25 index with {len(terms)} terms over {n_rows} rows in {time.time() - start:.1f}s")
+        return BM25Index(np.array(terms, dtype=str), offsets, rows, weights, n_rows)
+
+
+class BM25Index:
+    """Inverted index in CSR form: the postings of term i are rows/weights[offsets[i]:offsets[i + 1]]"""
+
+    def __init__(self, terms, offsets, rows, weights, n_rows):
+        self.terms = terms
+        self.offsets = offsets
+        self.rows = rows
+        self.weights = weights
+        self.n_rows = int(n_rows)
+        self.term_ids = {term: i for i, term in enumerate(terms.tolist())}
+
+    @classmethod
+    def build(cls, records: Iterable[Dict], k1=DEFAULT_K1, b=DEFAULT_B):
+        builder = BM25Builder()
+        builder.add(records)
+        return builder.build(k1, b)
+
+    def scores(self, query: str) -> np.ndarray:
+        """BM25 score of every row for query; rows sharing no term score 0"""
+        scores = np.zeros(self.n_rows, dtype=np.float32)
+        for term in set(tokenize(query)):
+            term_id = self.term_ids.get(term)
+            if term_id is None:
+                continue
+            start, end = self.offsets[term_id], self.offsets[term_id + 1]
+            # A term occurs at most once per row in its postings, so plain fancy-index add is safe
+            scores[self.rows[start:end]] += self.weights[start:end]
+        return scores
+
+    def rank(self, query: str, top_k: int, rows=None):
+        """(row ids, scores) of the top_k matching rows, best first, optionally only among rows"""
+        scores = self.scores(query)
+        if rows is not None:
+            candidates = rows[scores[rows] > 0]
+        else:
+            candidates = np.flatnonzero(scores)
+        if len(candidates) > top_k:
+            candidates = candidates[np.argpartition(-scores[candidates], top_k - 1)[:top_k]]
+        candidates = candidates[np.argsort(-scores[candidates], kind='stable')]
+        return candidates, scores[candidates]
+
+    def save(self, path):
+        np.savez(path, terms=self.terms, offsets=self.offsets, rows=self.rows, weights=self.weights,
+                 n_rows=np.array(self.n_rows))
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        return cls(data['terms'], data['offsets'], data['rows'], data['weights'], data['n_rows'])
+
+
+def reciprocal_rank_fusion(rankings: List[Iterable[int]], k=60) -> Dict[int, float]:
+    """Fuse several best-first lists of row ids: score(row) = sum of 1 / (k + rank)"""
+    fused = {}
+    for ranking in rankings:
+        for rank, row in enumerate(ranking, start=1):
+            fused[int(row)] = fused.get(int(row), 0.0) + 1.0 / (k + rank)
+    return fused
@@ -1,53 +1,150 @@
 import json
-from typing import Dict, Optional
+import os
+import re
+import threading
+from typing import Dict, List, Optional, Tuple
+
+WILDCARD = '*'
+PLACEHOLDER_PATTERN = re.compile(r'\{(\w+)\}')
+PROVIDER_TEMPLATES_DIR = 'templates'  # per-provider files: <code_examples_dir>/templates/<provider>.json
+
+
+class CompiledTemplate:
+    """A template's code split once into literal text and {placeholder} names.
+
+    parts alternates literal text (even indices) and placeholder names (odd
+    indices), so rendering is a single join. Placeholders without a value
+    are left as written, since code like f"{e}" uses the same braces.
+    """
+
+    def __init__(self, template: Dict):
+        self.code = template['code']
+        self.explanation = template['explanation']
+        self.requires = template.get('requires', [])
+        self.parts = PLACEHOLDER_PATTERN.split(self.code)
+        self.names = self.parts[1::2]
+
+    def render(self, parameters: Optional[Dict] = None) -> str:
+        if not parameters or not self.names:
+            return self.code
+        parts = self.parts.copy()
+        parts[1::2] = [str(parameters[name]) if name in parameters else '{' + name + '}' for name in self.names]
+        return ''.join(parts)
+
+
+def template_key(key: str, template: Dict) -> Tuple[str, str, str]:
+    """(provider, intent, language) of a template named provider_intent_language.
+
+    The intent may itself contain underscores; entries can also name their
+    provider, intent and language explicitly. Any part may be '*'.
+    """
+    parts = key.split('_')
+    if len(parts) < 3 and not all(field in template for field in ('provider', 'intent', 'language')):
+        raise ValueError(f"Template key {key!r} is not provider_intent_language")
+    return (template.get('provider', parts[0]),
+            template.get('intent', '_'.join(parts[1:-1])),
+            template.get('language', parts[-1]))
+
 
 class CodeGenerator:
+    """Code templates indexed by (provider, intent, language).
+
+    Templates live in code_examples_dir/templates/<provider>.json, each
+    loaded the first time a lookup needs that provider. A shared
+    code_examples_dir/templates.json, for templates such as '*' provider
+    ones, is loaded up front if present. A request resolves to the exact
+    template, then to templates with '*' in place of the language, intent or
+    provider, then to the fallback examples. Each combination is resolved
+    once, so lookups stay constant time however many templates there are.
+    """
+
     def __init__(self, code_examples_dir: str):
-        # Load code templates
-        with open(f"{code_examples_dir}/templates.json", 'r') as f:
-            self.templates = json.load(f)
+        self.code_examples_dir = code_examples_dir
+        self.templates = {}   # raw template entries by key, as loaded
+        self.index = {}       # (provider, intent, language) -> CompiledTemplate
+        self.loaded_providers = set()
+        self.resolved = {}    # (provider, intent, language) -> (template, language, is_fallback)
+        self._lock = threading.RLock()
 
-    def generate_code(self, intent: str, provider: str, language: str, parameters: Dict = None) -> Dict:
-        """Generate code snippet based on intent, provider and language"""
-        # Default to empty dict if no parameters provided
-        if parameters is None:
-            parameters = {}
+        # Providers with a template file; the files themselves are read on demand
+        providers_dir = os.path.join(code_examples_dir, PROVIDER_TEMPLATES_DIR)
+        self.provider_files = {}
+        if os.path.isdir(providers_dir):
+            self.provider_files = {name[:-len('.json')]: os.path.join(providers_dir, name)
+                                   for name in sorted(os.listdir(providers_dir)) if name.endswith('.json')}
 
-        # Find appropriate template
-        template_key = f"{provider}_{intent}_{language}"
-        if template_key in self.templates:
-            template = self.templates[template_key]
+        # Load shared code templates
+        templates_file = os.path.join(code_examples_dir, "templates.json")
+        if os.path.exists(templates_file):
+            self.add_templates(self.read_templates(templates_file))
+        elif not self.provider_files:
+            raise FileNotFoundError(f"No templates.json or {PROVIDER_TEMPLATES_DIR}/*.json in {code_examples_dir}")
 
-            # Simple template substitution
-            code = template['code']
-            for key, value in parameters.items():
-                placeholder = f"{{{key}}}"
-                code = code.replace(placeholder, str(value))
+    @staticmethod
+    def read_templates(path: str) -> Dict:
+        with open(path, 'r') as f:
+            return json.load(f)
 
-            return {
-                'code': code,
-                'language': language,
-                'explanation': template['explanation'],
-                'requires': template.get('requires', [])
-            }
-        else:
+    def add_templates(self, templates: Dict):
+        """Index and compile template entries"""
+        with self._lock:
+            for key, template in templates.items():
+                self.templates[key] = template
+                self.index[template_key(key, template)] = CompiledTemplate(template)
+            # New templates can change how any combination resolves
+            self.resolved = {}
+
+    def load_provider(self, provider: Optional[str]):
+        """Load templates/<provider>.json on first use"""
+        if provider not in self.provider_files or provider in self.loaded_providers:
+            return
+        with self._lock:
+            if provider in self.loaded_providers:
+                return
+            self.add_templates(self.read_templates(self.provider_files[provider]))
+            self.loaded_providers.add(provider)
+
+    def candidates(self, intent: str, provider: str, language: str) -> List[Tuple[Tuple[str, str, str], bool]]:
+        """Index keys to try for a request, most specific first, each flagged if it is a fallback example"""
+        return [
+            ((provider, intent, language), False),
+            ((provider, intent, WILDCARD), False),
+            ((provider, WILDCARD, language), False),
+            ((WILDCARD, intent, language), False),
+            ((provider, WILDCARD, WILDCARD), False),
+            ((WILDCARD, intent, WILDCARD), False),
+            ((WILDCARD, WILDCARD, language), False),
+            ((WILDCARD, WILDCARD, WILDCARD), False),
             # Fallback - find closest match by removing constraints
-            fallbacks = [
-                f"{provider}_{intent}_javascript",  # Try JavaScript as default language
-                f"{provider}_payment_processing_{language}",  # Try payment processing as default intent
-                "stripe_payment_processing_javascript"  # Ultimate fallback
-            ]
-
-            for fallback in fallbacks:
-                if fallback in self.templates:
-                    template = self.templates[fallback]
-                    return {
-                        'code': template['code'],
-                        'language': fallback.split('_')[-1],
-                        'explanation': template['explanation'] + "\n(Note: This is a fallback example.)",
-                        'requires': template.get('requires', [])
-                    }
+            ((provider, intent, 'javascript'), True),  # Try JavaScript as default language
+            ((provider, 'payment_processing', language), True),  # Try payment processing as default intent
+            (('stripe', 'payment_processing', 'javascript'), True)  # Ultimate fallback
+        ]
+
+    def resolve(self, intent: str, provider: str, language: str):
+        """(template, language, is_fallback) for a request, or None if nothing matches"""
+        request = (provider, intent, language)
+        # Under the lock, so a match is never memoized after add_templates has reset the memo
+        with self._lock:
+            if request in self.resolved:
+                return self.resolved[request]
+
+            match = None
+            for key, is_fallback in self.candidates(intent, provider, language):
+                # Only read a provider's file when a candidate needs it, e.g. stripe's for the last fallback
+                self.load_provider(key[0])
+                template = self.index.get(key)
+                if template is not None:
+                    # A fallback example is in its own language; other matches answer the request's
+                    match = (template, key[2] if is_fallback else language, is_fallback)
+                    break
+            self.resolved[request] = match
+            return match
 
+    def generate_code(self, intent: str, provider: str, language: str, parameters: Dict = None) -> Dict:
+        """Generate code snippet based on intent, provider and language"""
+        match = self.resolve(intent, provider, language)
+        if match is None:
             # If all else fails
             return {
                 'code': "// No suitable code example found",
@@ -56,6 +153,22 @@ class CodeGenerator:
                 'requires': []
             }
 
+        template, match_language, is_fallback = match
+        if is_fallback:
+            return {
+                'code': template.code,
+                'language': match_language,
+                'explanation': template.explanation + "\n(Note: This is a fallback example.)",
+                'requires': template.requires
+            }
+
+        return {
+            'code': template.render(parameters),
+            'language': match_language,
+            'explanation': template.explanation,
+            'requires': template.requires
+        }
+
 # Example code templates (in practice you'd have this in an external JSON file)
 example_templates = {
     "stripe_payment_processing_javascript": {
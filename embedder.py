@@ -1,99 +1,196 @@
 
 import os
 import json
+import hashlib
 import re
+import time
 from nltk.tokenize import sent_tokenize
 import numpy as np
-from sentence_transformers import SentenceTransformer
+from model_registry import DEFAULT_MODEL, get_model
+from vector_store import StoreWriter, write_store, read_store, resolve_store_dir, MANIFEST_FILE
+from ann_index import INDEX_FILE, IVFIndex, recall_report
+from quantization import QUANTIZERS, build_quantizer, quantization_report
+
+DEFAULT_BATCH_SIZE = 64
+CHUNK_SIZE = 1000  # characters; longer paragraphs are split at sentence boundaries
+NO_QUANTIZATION = 'none'  # quantization value that drops codes a previous build saved
+
+def iter_structured_docs(input_file):
+    """Yield structured documents one at a time from a JSON Lines file.
+
+    Legacy .json files holding a single list are still accepted.
+    """
+    with open(input_file, 'r') as f:
+        if not input_file.endswith('.jsonl'):
+            yield from json.load(f)
+            return
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+def index_structured_docs(structured_file):
+    """Byte offset of each document in a JSON Lines file, keyed by the scraped file it came from"""
+    offsets = {}
+    if not structured_file.endswith('.jsonl') or not os.path.exists(structured_file):
+        return offsets
+    try:
+        with open(structured_file, 'rb') as f:
+            for line in iter(f.readline, b''):
+                if line.strip():
+                    source_file = json.loads(line).get('source_file')
+                    if source_file:
+                        offsets[source_file] = f.tell() - len(line)
+    except (OSError, ValueError) as e:
+        print(f"Could not reuse {structured_file}: {e}")
+        return {}
+    return offsets
+
+def structure_document(filepath):
+    """Clean and chunk one scraped page; returns None for empty pages.
+
+    A plain module-level function so it can run in a process pool.
+    """
+    filename = os.path.basename(filepath)
+    try:
+        with open(filepath, 'r') as f:
+            doc = json.load(f)
+
+        # Skip empty documents
+        if not doc.get('content'):
+            return None
+
+        # Clean content
+        content = doc['content']
+        content = re.sub(r'\s+', ' ', content).strip()  # Remove extra whitespace
+
+        # Break into chunks (paragraphs or sections)
+        # This is a simple approach - in practice you might use more sophisticated chunking
+        chunks = []
+        paragraphs = [p.strip() for p in content.split('\n\n') if p.strip()]
+
+        for paragraph in paragraphs:
+            # If paragraph is very long, split into sentences
+            if len(paragraph) > CHUNK_SIZE:
+                sentences = sent_tokenize(paragraph)
+                current_chunk = ""
+
+                for sentence in sentences:
+                    if len(current_chunk) + len(sentence) < CHUNK_SIZE:
+                        current_chunk += " " + sentence
+                    else:
+                        if current_chunk:
+                            chunks.append(current_chunk.strip())
+                        current_chunk = sentence
+
+                if current_chunk:
+                    chunks.append(current_chunk.strip())
+            else:
+                chunks.append(paragraph)
+
+        # Extract code examples and their context
+        code_examples = []
+        for code in doc.get('code_examples', []):
+            if code.strip():
+                # Detect language (simplified)
+                language = "unknown"
+                if "function" in code and "{" in code:
+                    language = "javascript"
+                elif "def " in code and ":" in code:
+                    language = "python"
+                elif "<?php" in code:
+                    language = "php"
+
+                code_examples.append({
+                    'code': code.strip(),
+                    'language': language
+                })
 
-def clean_and_structure_docs(input_dir, output_file):
-    """Clean and structure scraped documentation"""
-    print(f"Cleaning and structuring documents from {input_dir}...")
+        # Create structured document
+        return {
+            'title': doc['title'],
+            'url': doc['url'],
+            'chunks': chunks,
+            'code_examples': code_examples,
+            'category': categorize_document(doc['title'], content),
+            'source_file': filename
+        }
 
-    structured_docs = []
+    except Exception as e:
+        print(f"Error processing {filename}: {e}")
+        return None
+
+def iter_cleaned_docs(input_dir, unchanged_files=None, previous_file=None, executor=None, window=64, cleaned=None):
+    """Yield structured documents for the pages in input_dir, one at a time, in filename order.
+
+    Files listed in unchanged_files (as reported by the crawl cache) reuse
+    their document from previous_file instead of being cleaned again. If an
+    executor (e.g. a ProcessPoolExecutor) is given, documents are cleaned in
+    parallel on it, `window` files at a time so results never pile up.
+    cleaned maps filenames to futures of structure_document already
+    submitted, e.g. while the pages were still being crawled.
+    """
+    cleaned = cleaned or {}
+    unchanged_files = set(unchanged_files or ())
+    offsets = index_structured_docs(previous_file) if unchanged_files and previous_file else {}
+
+    # Every page in the input directory, skipping the crawl cache and other dotfiles
+    filenames = sorted(name for name in os.listdir(input_dir) if name.endswith('.json') and not name.startswith('.'))
+
+    previous = open(previous_file, 'r') if offsets else None
+    try:
+        for start in range(0, len(filenames), window):
+            names = filenames[start:start + window]
+            pending = [os.path.join(input_dir, name) for name in names
+                       if name not in cleaned and not (name in unchanged_files and name in offsets)]
+
+            if executor is not None:
+                results = executor.map(structure_document, pending)
+            else:
+                results = map(structure_document, pending)
+            results = dict(zip((os.path.basename(path) for path in pending), results))
+
+            for name in names:
+                if name in cleaned:
+                    doc = cleaned[name].result()
+                elif name in results:
+                    doc = results[name]
+                else:
+                    previous.seek(offsets[name])
+                    doc = json.loads(previous.readline())
+                    doc['reused'] = True
+                if doc:
+                    yield doc
+    finally:
+        if previous:
+            previous.close()
+
+def clean_and_structure_docs(input_dir, output_file, unchanged_files=None, executor=None, cleaned=None):
+    """Clean and structure scraped documentation into a JSON Lines file.
+
+    Documents are streamed to disk as they are produced, so memory use does
+    not depend on the number of pages. Returns the number of documents.
+    cleaned holds documents already being cleaned, see iter_cleaned_docs.
+    """
+    print(f"Cleaning and structuring documents from {input_dir}...")
 
     # Ensure output directory exists
     os.makedirs(os.path.dirname(output_file), exist_ok=True)
 
-    # Process each file in the input directory
-    for filename in os.listdir(input_dir):
-        if filename.endswith('.json'):
-            filepath = os.path.join(input_dir, filename)
-
-            try:
-                with open(filepath, 'r') as f:
-                    doc = json.load(f)
-
-                # Skip empty documents
-                if not doc.get('content'):
-                    continue
-
-                # Clean content
-                content = doc['content']
-                content = re.sub(r'\s+', ' ', content).strip()  # Remove extra whitespace
-
-                # Break into chunks (paragraphs or sections)
-                # This is a simple approach - in practice you might use more sophisticated chunking
-                chunks = []
-                paragraphs = [p.strip() for p in content.split('\n\n') if p.strip()]
-
-                for paragraph in paragraphs:
-                    # If paragraph is very long, split into sentences
-                    if len(paragraph) > 1000:
-                        sentences = sent_tokenize(paragraph)
-                        current_chunk = ""
-
-                        for sentence in sentences:
-                            if len(current_chunk) + len(sentence) < 1000:
-                                current_chunk += " " + sentence
-                            else:
-                                if current_chunk:
-                                    chunks.append(current_chunk.strip())
-                                current_chunk = sentence
+    count = 0
+    reused = 0
+    tmp_file = output_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+        for doc in iter_cleaned_docs(input_dir, unchanged_files, output_file, executor, cleaned=cleaned):
+            reused += doc.pop('reused', False)
+            f.write(json.dumps(doc, separators=(',', ':')))
+            f.write('\n')
+            count += 1
 
-                        if current_chunk:
-                            chunks.append(current_chunk.strip())
-                    else:
-                        chunks.append(paragraph)
-
-                # Extract code examples and their context
-                code_examples = []
-                for code in doc.get('code_examples', []):
-                    if code.strip():
-                        # Detect language (simplified)
-                        language = "unknown"
-                        if "function" in code and "{" in code:
-                            language = "javascript"
-                        elif "def " in code and ":" in code:
-                            language = "python"
-                        elif "<?php" in code:
-                            language = "php"
-
-                        code_examples.append({
-                            'code': code.strip(),
-                            'language': language
-                        })
-
-                # Create structured document
-                structured_doc = {
-                    'title': doc['title'],
-                    'url': doc['url'],
-                    'chunks': chunks,
-                    'code_examples': code_examples,
-                    'category': categorize_document(doc['title'], content)
-                }
-
-                structured_docs.append(structured_doc)
-
-            except Exception as e:
-                print(f"Error processing {filename}: {e}")
-
-    # Save structured documents
-    with open(output_file, 'w') as f:
-        json.dump(structured_docs, f, indent=2)
-
-    print(f"Structured {len(structured_docs)} documents to {output_file}")
-    return structured_docs
+    # Replace only once complete, the previous file is read for reuse while writing
+    os.replace(tmp_file, output_file)
+
+    print(f"Structured {count} documents to {output_file} ({reused} unchanged, reused)")
+    return count
 
 def categorize_document(title, content):
     """Categorize document based on content"""
@@ -114,67 +211,210 @@ def categorize_document(title, content):
 
     return 'general'
 
-def create_embeddings(input_file, output_dir):
-    """Create embeddings for structured documentation"""
+def content_hash(text):
+    """Stable hash of the exact text that gets embedded"""
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+def document_records(doc):
+    """Build the store records for one structured document, in store order"""
+    records = []
+
+    # One record per text chunk
+    for chunk_idx, chunk in enumerate(doc['chunks']):
+        records.append({
+            'document_id': doc['url'],
+            'chunk_id': chunk_idx,
+            'title': doc['title'],
+            'text': chunk,
+            'category': doc['category']
+        })
+
+    # Also one per code example, with a context prefix for better search
+    for code_idx, example in enumerate(doc['code_examples']):
+        records.append({
+            'document_id': doc['url'],
+            'chunk_id': f"code_{code_idx}",
+            'title': doc['title'],
+            'text': f"Code example ({example['language']}): {example['code']}",
+            'category': doc['category'],
+            'code': example['code'],
+            'language': example['language']
+        })
+
+    for record in records:
+        record['content_hash'] = content_hash(record['text'])
+
+    return records
+
+def load_previous_vectors(output_dir, model_name):
+    """(content hash -> row, embeddings) for an existing store built with the same model and chunking"""
+    try:
+        documents, embeddings, manifest = read_store(output_dir)
+    except FileNotFoundError:
+        return {}, None
+
+    if len(documents) == 0:
+        return {}, None
+    if manifest.get('model', DEFAULT_MODEL) != model_name:
+        print("Existing store was built with a different model, re-embedding everything")
+        return {}, None
+    if manifest.get('chunk_size', CHUNK_SIZE) != CHUNK_SIZE:
+        print("Existing store was built with a different chunk size, re-embedding everything")
+        return {}, None
+
+    rows = {}
+    for row, doc in enumerate(documents):
+        rows[doc.get('content_hash') or content_hash(doc['text'])] = row
+    return rows, embeddings
+
+def previous_build_settings(output_dir):
+    """{'ann_index', 'quantization', 'model', 'chunk_size'} of the live snapshot in output_dir, from its manifest"""
+    manifest_file = os.path.join(resolve_store_dir(output_dir), MANIFEST_FILE)
+    manifest = {}
+    if os.path.exists(manifest_file):
+        with open(manifest_file, 'r') as f:
+            manifest = json.load(f)
+    artifacts = set(manifest.get('artifacts', []))
+    quantization = next((mode for mode, quantizer_class in QUANTIZERS.items()
+                         if quantizer_class.filename in artifacts or quantizer_class.filename + '.npz' in artifacts),
+                        None)
+    return {'ann_index': INDEX_FILE in artifacts, 'quantization': quantization,
+            'model': manifest.get('model'), 'chunk_size': manifest.get('chunk_size')}
+
+def resolve_build_settings(output_dir, ann_index=None, quantization=None):
+    """(ann_index, quantization) for a rebuild: None keeps what the live snapshot has.
+
+    Servers configured with VECTOR_INDEX=ivf or VECTOR_QUANTIZATION rely on
+    these artifacts, so a rebuild only drops them when asked to, with
+    ann_index=False or quantization='none'.
+    """
+    previous = previous_build_settings(output_dir)
+    if ann_index is None:
+        ann_index = previous['ann_index']
+        if ann_index:
+            print(f"Keeping the IVF index of the previous build in {output_dir}")
+    if quantization is None:
+        quantization = previous['quantization']
+        if quantization:
+            print(f"Keeping the {quantization} codes of the previous build in {output_dir}")
+    return ann_index, None if quantization == NO_QUANTIZATION else quantization
+
+def create_embeddings(input_file, output_dir, model_name=DEFAULT_MODEL, batch_size=DEFAULT_BATCH_SIZE,
+                      incremental=False, ann_index=None, ann_lists=None, quantization=None):
+    """Create embeddings for structured documentation.
+
+    Documents are read, chunked, encoded in batches of batch_size and
+    appended to the new store one batch at a time, so memory use stays flat
+    however large the corpus is.
+    With incremental=True, chunks whose content hash is already in the
+    existing store reuse its vector and only new or changed chunks are
+    encoded. Chunks that no longer exist are dropped by the rewrite. A store
+    built with another model or CHUNK_SIZE is re-embedded in full.
+    With ann_index=True an IVF index is built and saved with the vectors.
+    quantization ('int8' or 'pq') also saves compressed codes of the vectors
+    and reports their recall against exact search. Left as None, both
+    follow the previous build, see resolve_build_settings.
+    """
     print(f"Creating embeddings from {input_file}...")
 
     # Create output directory
     os.makedirs(output_dir, exist_ok=True)
+    ann_index, quantization = resolve_build_settings(output_dir, ann_index, quantization)
 
+    writer = None
     try:
-        # Load documents
-        with open(input_file, 'r') as f:
-            documents = json.load(f)
-
         # Initialize embedding model
-        print("Loading embedding model...")
-        model = SentenceTransformer('all-MiniLM-L6-v2')
-
-        # Process each document
-        embeddings_data = []
-
-        print(f"Processing {len(documents)} documents...")
-        for doc_idx, doc in enumerate(documents):
-            print(f"Processing document {doc_idx + 1}/{len(documents)}: {doc['title']}")
-
-            # Create embeddings for each chunk
-            for chunk_idx, chunk in enumerate(doc['chunks']):
-                embedding = model.encode(chunk)
-
-                embeddings_data.append({
-                    'document_id': doc['url'],
-                    'chunk_id': chunk_idx,
-                    'title': doc['title'],
-                    'text': chunk,
-                    'category': doc['category'],
-                    'embedding': embedding.tolist()
-                })
-
-            # Also create embeddings for code examples
-            for code_idx, example in enumerate(doc['code_examples']):
-                # Add a context prefix for better search
-                context = f"Code example ({example['language']}): {example['code']}"
-                embedding = model.encode(context)
-
-                embeddings_data.append({
-                    'document_id': doc['url'],
-                    'chunk_id': f"code_{code_idx}",
-                    'title': doc['title'],
-                    'text': context,
-                    'category': doc['category'],
-                    'code': example['code'],
-                    'language': example['language'],
-                    'embedding': embedding.tolist()
-                })
-
-        # Save embeddings
-        output_file = os.path.join(output_dir, 'embeddings.json')
-        with open(output_file, 'w') as f:
-            json.dump(embeddings_data, f)
-
-        print(f"Created {len(embeddings_data)} embeddings saved to {output_file}")
-        return len(embeddings_data)
+        model = get_model(model_name)
+        dimension = model.get_sentence_embedding_dimension()
+
+        previous_rows, previous_embeddings = load_previous_vectors(output_dir, model_name) if incremental else ({}, None)
+        writer = StoreWriter(output_dir, dimension, model_name, settings={'chunk_size': CHUNK_SIZE})
+
+        stats = {'encoded': 0, 'reused': 0}
+        start = time.time()
+
+        def flush(records):
+            # Encode each distinct new text in the batch once, reuse the rest
+            pending = {}
+            for record in records:
+                key = record['content_hash']
+                if key not in previous_rows and key not in pending:
+                    pending[key] = record['text']
+
+            fresh = {}
+            if pending:
+                encoded = model.encode(list(pending.values()), batch_size=batch_size)
+                fresh = dict(zip(pending.keys(), np.asarray(encoded, dtype=np.float32)))
+
+            vectors = np.zeros((len(records), dimension), dtype=np.float32)
+            for row, record in enumerate(records):
+                key = record['content_hash']
+                vectors[row] = fresh[key] if key in fresh else previous_embeddings[previous_rows[key]]
+            writer.append(records, vectors)
+
+            stats['encoded'] += len(pending)
+            stats['reused'] += len(records) - len(pending)
+            elapsed = time.time() - start
+            rate = stats['encoded'] / elapsed if elapsed > 0 else float('inf')
+            print(f"Encoded {stats['encoded']} chunks, reused {stats['reused']} ({rate:.1f} chunks/sec)")
+
+        # Stream documents through in batches, keeping output order
+        batch = []
+        for doc in iter_structured_docs(input_file):
+            batch.extend(document_records(doc))
+            while len(batch) >= batch_size:
+                flush(batch[:batch_size])
+                batch = batch[batch_size:]
+        if batch:
+            flush(batch)
+
+        matrix = writer.finalize()
+        if ann_index and writer.count:
+            writer.add_artifact(INDEX_FILE, build_ivf_index(matrix, ann_lists))
+        if quantization and writer.count:
+            quantizer = build_quantizer(quantization, matrix)
+            quantization_report(matrix, quantizer)
+            writer.add_artifact(quantizer.filename, quantizer)
+
+        # Publish the new snapshot
+        writer.publish()
+
+        print(f"Created {writer.count} embeddings saved to {output_dir}")
+        return writer.count
 
     except Exception as e:
+        if writer is not None:
+            writer.abort()
         print(f"Error creating embeddings: {e}")
-        return 0
\ No newline at end of file
+        return 0
+
+def build_ivf_index(matrix, n_lists=None):
+    """Build an IVF index for a normalized matrix and report its recall against exact search"""
+    index = IVFIndex.build(matrix, n_lists)
+    recall_report(matrix, index)
+    return index
+
+def build_ann_index(output_dir, n_lists=None):
+    """Add an IVF index to an existing store by publishing a new snapshot"""
+    documents, embeddings, manifest = read_store(output_dir)
+    if len(documents) == 0:
+        print(f"No embeddings in {output_dir}, skipping index build")
+        return None
+    index = build_ivf_index(embeddings, n_lists)
+    artifacts = {INDEX_FILE: index}
+    # Keep the previous build's quantized codes in the new snapshot
+    _, quantization = resolve_build_settings(output_dir)
+    if quantization:
+        quantizer = build_quantizer(quantization, embeddings)
+        artifacts[quantizer.filename] = quantizer
+    write_store(output_dir, documents, embeddings, manifest.get('model', DEFAULT_MODEL), artifacts)
+    return index
+
+def convert_legacy_embeddings(embeddings_file, model_name=DEFAULT_MODEL):
+    """Rewrite a legacy embeddings.json store in the binary format next to it"""
+    documents, embeddings, _ = read_store(embeddings_file)
+    if embeddings.shape[0] == 0:
+        embeddings = np.zeros((0, get_model(model_name).get_sentence_embedding_dimension()), dtype=np.float32)
+    write_store(os.path.dirname(embeddings_file), documents, embeddings, model_name)
+    print(f"Converted {len(documents)} embeddings from {embeddings_file}")
+    return len(documents)
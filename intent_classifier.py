@@ -0,0 +1,120 @@
+"""Nearest-centroid intent classification on the query embedding used for search"""
+
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from model_registry import DEFAULT_MODEL, get_model, encode_query
+
+DEFAULT_MIN_CONFIDENCE = 0.35  # cosine similarity to the nearest centroid
+DEFAULT_MIN_MARGIN = 0.03      # lead of the nearest centroid over the runner-up
+
+# A few labelled questions per intent; phrasings the regex patterns do not cover
+SEED_EXAMPLES = {
+    'authentication': [
+        "how do I get my API keys",
+        "where do I find my client id and secret",
+        "sign requests to the API with my credentials",
+        "get an OAuth access token",
+        "my API key is not accepted",
+        "configure the SDK with my secret key",
+    ],
+    'payment_processing': [
+        "charge a customer's credit card",
+        "take a one-time payment on my checkout page",
+        "collect money from a buyer",
+        "create an order and capture the funds",
+        "accept card payments on my website",
+        "confirm a payment intent",
+    ],
+    'subscription': [
+        "bill customers every month",
+        "set up a monthly plan",
+        "charge a recurring fee automatically",
+        "create a subscription with a free trial",
+        "upgrade or cancel a customer's plan",
+        "recurring billing for memberships",
+    ],
+    'refund': [
+        "give a customer their money back",
+        "refund an order",
+        "reverse a charge",
+        "partially refund a purchase",
+        "send money back to the buyer",
+        "undo a captured payment",
+    ],
+    'error_handling': [
+        "the API returns a 400 error",
+        "my payment keeps getting declined",
+        "webhook signature verification fails",
+        "why is my request rejected",
+        "debug a failed transaction",
+        "handle card declined exceptions",
+    ],
+}
+
+
+class SemanticIntentClassifier:
+    """Classifies a query by its nearest per-intent centroid of seed example embeddings.
+
+    The centroids are encoded once, on first use. Classifying a query is one
+    matrix-vector product with the normalized query embedding, which
+    model_registry has already cached for search, so no extra model call.
+    """
+
+    def __init__(self, seed_examples: Optional[Dict[str, List[str]]] = None, model_name: str = DEFAULT_MODEL,
+                 min_confidence: float = DEFAULT_MIN_CONFIDENCE, min_margin: float = DEFAULT_MIN_MARGIN):
+        self.seed_examples = seed_examples or SEED_EXAMPLES
+        self.model_name = model_name
+        self.min_confidence = min_confidence
+        self.min_margin = min_margin
+        self.intents = list(self.seed_examples)
+        self._centroids = None
+        self._lock = threading.Lock()
+
+    @property
+    def centroids(self) -> np.ndarray:
+        """(n_intents, dim) normalized mean embedding of each intent's examples"""
+        if self._centroids is None:
+            with self._lock:
+                if self._centroids is None:
+                    self._centroids = self.build_centroids()
+        return self._centroids
+
+    def build_centroids(self) -> np.ndarray:
+        examples = [example for intent in self.intents for example in self.seed_examples[intent]]
+        # One batch for every seed example
+        embeddings = np.asarray(get_model(self.model_name).encode(examples, normalize_embeddings=True),
+                                dtype=np.float32)
+
+        centroids = np.empty((len(self.intents), embeddings.shape[1]), dtype=np.float32)
+        offset = 0
+        for i, intent in enumerate(self.intents):
+            count = len(self.seed_examples[intent])
+            centroid = embeddings[offset:offset + count].mean(axis=0)
+            centroids[i] = centroid / (np.linalg.norm(centroid) or 1.0)
+            offset += count
+        return centroids
+
+    def scores(self, query_embedding: np.ndarray) -> np.ndarray:
+        """Cosine similarity of the query to every intent centroid"""
+        return self.centroids @ query_embedding
+
+    def classify(self, query_embedding: np.ndarray) -> Tuple[Optional[str], float]:
+        """(intent, confidence) for an encoded query; intent is None when the confidence is too low.
+
+        The confidence is the similarity to the nearest centroid. It counts as
+        low when under min_confidence, or when the runner-up is within
+        min_margin, i.e. the query sits between two intents.
+        """
+        scores = self.scores(query_embedding)
+        order = np.argsort(-scores)
+        best = float(scores[order[0]])
+        margin = best - float(scores[order[1]]) if len(order) > 1 else best
+        if best < self.min_confidence or margin < self.min_margin:
+            return None, best
+        return self.intents[order[0]], best
+
+    def classify_query(self, query: str) -> Tuple[Optional[str], float]:
+        return self.classify(encode_query(query, self.model_name))
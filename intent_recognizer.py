@@ -1,5 +1,117 @@
 import re
-from typing import Dict, List, Optional
+from typing import Dict, FrozenSet, Hashable, List, Optional, Set, Tuple
+
+# Providers and language keywords, in priority order: the first one found in the query wins.
+# Keywords match as substrings, so 'javascript' must come before 'java'.
+PROVIDERS = ['stripe', 'paypal']
+LANGUAGES = {
+    'javascript': ['javascript', 'js', 'node', 'nodejs'],
+    'python': ['python', 'py'],
+    'php': ['php'],
+    'ruby': ['ruby'],
+    'java': ['java'],
+    'c#': ['c#', '.net', 'dotnet'],
+}
+
+MAX_PHRASES = 1000  # a pattern expanding to more literal phrases is searched as a regex instead
+REGEX_SYNTAX = set('[]*+?{}^$.')
+
+
+def expand_pattern(pattern: str) -> Set[str]:
+    """Every lowercased string a pattern of literals, groups and | alternatives matches.
+
+    '(how to|how do I) (refund|return)' expands to the four phrases. Raises
+    ValueError for anything else (classes, repeats, anchors, escapes such
+    as \\b), since those do not match a finite set of strings.
+    """
+    def alternatives(i):
+        phrases, i = sequence(i)
+        while i < len(pattern) and pattern[i] == '|':
+            more, i = sequence(i + 1)
+            phrases |= more
+        return phrases, i
+
+    def sequence(i):
+        phrases = {''}
+        while i < len(pattern) and pattern[i] not in '|)':
+            char = pattern[i]
+            if char == '(':
+                i += 1
+                if pattern.startswith('?:', i):
+                    i += 2
+                elif pattern.startswith('?', i):
+                    raise ValueError(f"Unsupported group in {pattern!r}")
+                group, i = alternatives(i)
+                if i >= len(pattern) or pattern[i] != ')':
+                    raise ValueError(f"Unbalanced group in {pattern!r}")
+                i += 1
+            elif char == '\\':
+                if i + 1 >= len(pattern) or pattern[i + 1].isalnum():
+                    raise ValueError(f"Unsupported escape in {pattern!r}")
+                group, i = {pattern[i + 1]}, i + 2
+            elif char in REGEX_SYNTAX:
+                raise ValueError(f"Unsupported syntax {char!r} in {pattern!r}")
+            else:
+                group, i = {char}, i + 1
+
+            phrases = {phrase + part for phrase in phrases for part in group}
+            if len(phrases) > MAX_PHRASES:
+                raise ValueError(f"{pattern!r} expands to too many phrases")
+        return phrases, i
+
+    phrases, end = alternatives(0)
+    if end != len(pattern):
+        raise ValueError(f"Unbalanced group in {pattern!r}")
+    return {phrase.lower() for phrase in phrases}
+
+
+class KeywordAutomaton:
+    """Aho-Corasick automaton over characters: finds which labelled phrases occur in a text in one pass"""
+
+    def __init__(self, phrases: Dict[Hashable, Set[str]]):
+        # phrases maps a label to the phrases that signal it
+        self.goto: List[Dict[str, int]] = [{}]
+        self.outputs: List[FrozenSet[Hashable]] = [frozenset()]
+        self.always: FrozenSet[Hashable] = frozenset(label for label, texts in phrases.items() if '' in texts)
+
+        outputs: List[Set[Hashable]] = [set()]
+        for label, texts in phrases.items():
+            for text in texts:
+                node = 0
+                for char in text:
+                    if char not in self.goto[node]:
+                        self.goto.append({})
+                        outputs.append(set())
+                        self.goto[node][char] = len(self.goto) - 1
+                    node = self.goto[node][char]
+                outputs[node].add(label)
+
+        # Breadth-first failure links: the longest proper suffix of a node's text that is also a prefix
+        self.fail = [0] * len(self.goto)
+        queue = list(self.goto[0].values())
+        for node in queue:
+            for char, child in self.goto[node].items():
+                fallback = self.fail[node]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(char, 0)
+                outputs[child] |= outputs[self.fail[child]]
+                queue.append(child)
+        self.outputs = [frozenset(labels) for labels in outputs]
+
+    def search(self, text: str) -> Set[Hashable]:
+        """Labels of every phrase occurring in text"""
+        goto, fail, outputs = self.goto, self.fail, self.outputs
+        found = set(self.always)
+        node = 0
+        for char in text:
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            if outputs[node]:
+                found |= outputs[node]
+        return found
+
 
 class IntentRecognizer:
     def __init__(self):
@@ -31,45 +143,104 @@ class IntentRecognizer:
                 r'(in|using|with) (javascript|python|ruby|php|java|node|nodejs|\.net|c#)'
             ]
         }
+        self.compile()
+
+    def compile(self):
+        """Build the keyword automaton; call again after changing self.intents.
+
+        Intent patterns are expanded into the literal phrases they match and
+        loaded into one automaton together with the provider and language
+        keywords, so a single pass over the query finds all three. A pattern
+        that does not expand to a finite set of phrases is precompiled and
+        searched separately.
+        """
+        phrases: Dict[Tuple[str, str], Set[str]] = {}
+        self.regex_intents: List[Tuple[str, re.Pattern]] = []
+        for intent, patterns in self.intents.items():
+            for pattern in patterns:
+                try:
+                    phrases.setdefault(('intent', intent), set()).update(expand_pattern(pattern))
+                except ValueError:
+                    self.regex_intents.append((intent, re.compile(pattern, re.IGNORECASE)))
+
+        for provider in PROVIDERS:
+            phrases[('provider', provider)] = {provider}
+        for language, keywords in LANGUAGES.items():
+            phrases[('language', language)] = set(keywords)
+
+        self.automaton = KeywordAutomaton(phrases)
+
+    def scan(self, query: str) -> Set[Tuple[str, str]]:
+        """(kind, name) labels of every intent, provider and language in the lowercased query"""
+        found = self.automaton.search(query)
+        for intent, pattern in self.regex_intents:
+            if ('intent', intent) not in found and pattern.search(query):
+                found.add(('intent', intent))
+        return found
 
     def detect_provider(self, query: str) -> Optional[str]:
-        query = query.lower()
-        if 'stripe' in query:
-            return 'stripe'
-        elif 'paypal' in query:
-            return 'paypal'
-        return None
+        found = self.scan(query.lower())
+        return next((provider for provider in PROVIDERS if ('provider', provider) in found), None)
 
     def detect_language(self, query: str) -> Optional[str]:
+        found = self.scan(query.lower())
+        return next((language for language in LANGUAGES if ('language', language) in found), None)
+
+    def recognize(self, query: str) -> Dict:
         query = query.lower()
-        languages = {
-            'javascript': ['javascript', 'js', 'node', 'nodejs'],
-            'python': ['python', 'py'],
-            'php': ['php'],
-            'ruby': ['ruby'],
-            'java': ['java'],
-            'c#': ['c#', '.net', 'dotnet'],
+        found = self.scan(query)
+
+        return {
+            # Intents in declaration order
+            'matched_intents': [intent for intent in self.intents if ('intent', intent) in found],
+            'payment_provider': next((provider for provider in PROVIDERS if ('provider', provider) in found), None),
+            'programming_language': next((language for language in LANGUAGES if ('language', language) in found),
+                                         None),
+            'query': query
         }
 
-        for lang, keywords in languages.items():
-            if any(keyword in query for keyword in keywords):
-                return lang
-        return None
 
-    def recognize(self, query: str) -> Dict:
+if __name__ == '__main__':
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description="Compare the keyword automaton with one re.search per pattern")
+    parser.add_argument("--iterations", type=int, default=20000)
+    args = parser.parse_args()
+
+    queries = [
+        "How do I process a payment with Stripe using JavaScript?",
+        "I want to process a payment with PayPal using Python",
+        "How do I handle subscription billing?",
+        "What's the code for refunding a payment in JavaScript?",
+        "How do I troubleshoot payment errors?",
+        "I'm using Stripe",
+        "Python",
+    ]
+    recognizer = IntentRecognizer()
+
+    def per_pattern_recognize(query):
+        # The previous implementation: every pattern searched separately, then substring checks
         query = query.lower()
         matched_intents = []
-
-        # Check for each intent
-        for intent, patterns in self.intents.items():
+        for intent, patterns in recognizer.intents.items():
             for pattern in patterns:
                 if re.search(pattern, query, re.IGNORECASE):
                     matched_intents.append(intent)
                     break
+        provider = next((p for p in PROVIDERS if p in query), None)
+        language = next((lang for lang, keywords in LANGUAGES.items() if any(k in query for k in keywords)), None)
+        return {'matched_intents': matched_intents, 'payment_provider': provider,
+                'programming_language': language, 'query': query}
 
-        return {
-            'matched_intents': list(set(matched_intents)),
-            'payment_provider': self.detect_provider(query),
-            'programming_language': self.detect_language(query),
-            'query': query
-        }
+    for query in queries:
+        assert recognizer.recognize(query) == per_pattern_recognize(query), query
+
+    for label, recognize in [("per pattern", per_pattern_recognize), ("automaton", recognizer.recognize)]:
+        best = float('inf')
+        for _ in range(5):
+            start = time.perf_counter()
+            for i in range(args.iterations):
+                recognize(queries[i % len(queries)])
+            best = min(best, (time.perf_counter() - start) / args.iterations * 1e6)
+        print(f"{label:<12} {best:.1f} us/query")
@@ -1,21 +1,137 @@
 import os
 import json
+import random
+import threading
+import time
+import asyncio
+from contextlib import contextmanager
+import aiohttp
 import requests
+from requests.adapters import HTTPAdapter
 from typing import Dict, List, Optional
 
+# 529 is the API's "overloaded" status
+RETRY_STATUSES = {429, 500, 502, 503, 504, 529}
+# Failures worth another attempt; any other client error fails the call at once
+RETRY_ERRORS = (requests.ConnectionError, requests.Timeout)
+ASYNC_RETRY_ERRORS = (aiohttp.ClientConnectionError, asyncio.TimeoutError)
+
+
+class LLMServiceError(Exception):
+    """The LLM API could not produce a response; callers fall back to a non-LLM answer"""
+
+
+class CircuitOpenError(LLMServiceError):
+    """Calls are being short-circuited after repeated failures"""
+
+
+class CircuitBreaker:
+    """Stops calling a failing API for a while instead of making every request wait on it.
+
+    After failure_threshold consecutive failures the circuit opens and calls
+    fail immediately. Once reset_timeout seconds have passed one trial call
+    is let through (half-open): success closes the circuit, failure opens it
+    again.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return 'half-open'
+        return 'open'
+
+    def allow(self):
+        with self.lock:
+            state = self.state
+            if state == 'closed':
+                return True
+            if state == 'half-open' and not self.trial_in_flight:
+                self.trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_in_flight = False
+
+    def release(self):
+        with self.lock:
+            self.trial_in_flight = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_in_flight = False
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    print(f"LLM API failed {self.failures} times in a row, opening circuit for {self.reset_timeout}s")
+                self.opened_at = time.monotonic()
+
+    @contextmanager
+    def guard(self):
+        """Run one call through the breaker, recording its outcome"""
+        if not self.allow():
+            raise CircuitOpenError("LLM API circuit is open")
+        try:
+            yield
+        except Exception:
+            self.record_failure()
+            raise
+        except BaseException:
+            # Cancelled or abandoned by the caller, which says nothing about the API
+            self.release()
+            raise
+        else:
+            self.record_success()
+
+
 class LLMService:
-    def __init__(self, api_key=None):
+    def __init__(self, api_key=None, pool_size=None, max_connections=None, connect_timeout=None,
+                 read_timeout=None, max_retries=None, backoff=None, breaker=None):
         self.api_key = api_key or os.environ.get("LLM_API_KEY")
         self.api_url = "https://api.anthropic.com/v1/messages"  # For Claude
         # Alternative: "https://api.openai.com/v1/chat/completions"  # For ChatGPT
 
-    def generate_response(self, messages, context=None):
-        """Generate a response using the LLM API"""
+        self.connect_timeout = connect_timeout or float(os.environ.get("LLM_CONNECT_TIMEOUT", "5"))
+        self.read_timeout = read_timeout or float(os.environ.get("LLM_READ_TIMEOUT", "60"))
+        self.max_retries = max_retries if max_retries is not None else int(os.environ.get("LLM_MAX_RETRIES", "2"))
+        self.backoff = backoff if backoff is not None else float(os.environ.get("LLM_RETRY_BACKOFF", "0.5"))
+        self.breaker = breaker or CircuitBreaker(
+            failure_threshold=int(os.environ.get("LLM_BREAKER_THRESHOLD", "5")),
+            reset_timeout=float(os.environ.get("LLM_BREAKER_RESET", "30"))
+        )
+
+        # Sync client: one keep-alive session, shared by the worker threads
+        pool_size = pool_size or int(os.environ.get("LLM_POOL_SIZE", "10"))
+        self.http = requests.Session()
+        self.http.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+        self.http.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+
+        # Async client: one pooled session per event loop, created on first use
+        self.max_connections = max_connections or int(os.environ.get("LLM_MAX_CONNECTIONS", "200"))
+        self._sessions = {}
+        self._closing = set()
+
+    def build_request(self, messages, context=None):
+        """Headers and JSON payload for a messages API call"""
         headers = {
             "Content-Type": "application/json",
-            "x-api-key": self.api_key,
             "anthropic-version": "2023-06-01"  # For Claude
         }
+        if self.api_key:
+            headers["x-api-key"] = self.api_key
 
         # Prepare system message with context
         system_message = """You are a payment API integration assistant. Your job is to help developers integrate payment services like Stripe and PayPal into their applications.
@@ -24,7 +140,8 @@ Use the provided documentation context to answer questions accurately."""
         if context:
             system_message += "\n\nHere's some relevant documentation to help answer the question:\n"
             for i, doc in enumerate(context, 1):
-                system_message += f"\n{i}. {doc['text']}\n"
+                # Code snippets from the generator carry an explanation instead of text
+                system_message += f"\n{i}. {doc.get('text') or doc.get('explanation', '')}\n"
                 if 'code' in doc:
                     system_message += f"Code example ({doc.get('language', 'code')}):\n{doc['code']}\n"
 
@@ -36,11 +153,185 @@ Use the provided documentation context to answer questions accurately."""
             "max_tokens": 1000
         }
 
-        try:
-            response = requests.post(self.api_url, headers=headers, json=payload)
-            response.raise_for_status()
-            return response.json()['content'][0]['text']
-        except Exception as e:
-            print(f"Error calling LLM API: {e}")
-            return "I encountered an error while processing your request. Please try again."
+        return headers, payload
+
+    def generate_response(self, messages, context=None):
+        """Generate a response using the LLM API.
+
+        Raises LLMServiceError if the API keeps failing or the circuit is open.
+        """
+        headers, payload = self.build_request(messages, context)
+
+        with self.breaker.guard():
+            response = self.post(headers, payload)
+            try:
+                return response_text(response.json())
+            except ValueError as e:
+                raise LLMServiceError(f"Unexpected LLM API response: {e}") from e
+
+    async def agenerate_response(self, messages, context=None):
+        """Generate a response without blocking the event loop while waiting on the API"""
+        headers, payload = self.build_request(messages, context)
+
+        with self.breaker.guard():
+            response = await self.apost(headers, payload)
+            try:
+                return response_text(await response.json())
+            except (ValueError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                raise LLMServiceError(f"Unexpected LLM API response: {e}") from e
+            finally:
+                response.release()
+
+    def stream_response(self, messages, context=None):
+        """Yield the response text in pieces as the API streams it.
+
+        Raises LLMServiceError, possibly after some pieces have been yielded.
+        """
+        headers, payload = self.build_request(messages, context)
+        payload["stream"] = True
+
+        with self.breaker.guard():
+            with self.post(headers, payload, stream=True) as response:
+                try:
+                    for line in response.iter_lines(decode_unicode=True):
+                        text = parse_stream_line(line)
+                        if text:
+                            yield text
+                except requests.RequestException as e:
+                    raise LLMServiceError(f"LLM API stream interrupted: {e}") from e
+
+    async def astream_response(self, messages, context=None):
+        """Async version of stream_response for the ASGI app"""
+        headers, payload = self.build_request(messages, context)
+        payload["stream"] = True
+
+        with self.breaker.guard():
+            response = await self.apost(headers, payload)
+            try:
+                async for line in response.content:
+                    text = parse_stream_line(line.decode('utf-8'))
+                    if text:
+                        yield text
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                raise LLMServiceError(f"LLM API stream interrupted: {e}") from e
+            finally:
+                response.release()
+
+    def post(self, headers, payload, stream=False):
+        """POST to the API on the pooled session, retrying connection errors, 429 and 5xx"""
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self.http.post(self.api_url, headers=headers, json=payload, stream=stream,
+                                          timeout=(self.connect_timeout, self.read_timeout))
+            except requests.RequestException as e:
+                # e.g. a connection dropped mid-body (ChunkedEncodingError) or an invalid URL
+                if not isinstance(e, RETRY_ERRORS) or attempt == self.max_retries:
+                    raise LLMServiceError(f"LLM API request failed: {e}") from e
+                delay = self.retry_delay(attempt)
+                print(f"Error calling LLM API ({e!r}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+                continue
+
+            if response.status_code in RETRY_STATUSES and attempt < self.max_retries:
+                delay = self.retry_delay(attempt, response.headers.get('Retry-After'))
+                response.close()
+                print(f"LLM API returned {response.status_code}, retrying in {delay:.1f}s")
+                time.sleep(delay)
+                continue
+            if response.status_code >= 400:
+                response.close()
+                raise LLMServiceError(f"LLM API returned {response.status_code}")
+            return response
+
+    async def apost(self, headers, payload):
+        """Async post(); the caller must release() the returned response"""
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = await self.session().post(self.api_url, headers=headers, json=payload)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if not isinstance(e, ASYNC_RETRY_ERRORS) or attempt == self.max_retries:
+                    raise LLMServiceError(f"LLM API request failed: {e!r}") from e
+                delay = self.retry_delay(attempt)
+                print(f"Error calling LLM API ({e!r}), retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+                continue
+
+            if response.status in RETRY_STATUSES and attempt < self.max_retries:
+                delay = self.retry_delay(attempt, response.headers.get('Retry-After'))
+                response.release()
+                print(f"LLM API returned {response.status}, retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+                continue
+            if response.status >= 400:
+                response.release()
+                raise LLMServiceError(f"LLM API returned {response.status}")
+            return response
+
+    def retry_delay(self, attempt, retry_after=None):
+        """Exponential backoff with jitter, or the server's Retry-After when it sends one"""
+        if retry_after and retry_after.isdigit():
+            return float(retry_after)
+        return self.backoff * 2 ** attempt + random.uniform(0, self.backoff)
+
+    def session(self):
+        """The pooled aiohttp session of the running event loop, created on first use.
+
+        Sessions left behind by event loops that have since closed are closed here.
+        """
+        loop = asyncio.get_running_loop()
+        for stale_loop in [other for other in self._sessions if other.is_closed()]:
+            task = loop.create_task(self._sessions.pop(stale_loop).close())
+            self._closing.add(task)
+            task.add_done_callback(self._closing.discard)
+
+        session = self._sessions.get(loop)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_connections)
+            # Per-read rather than total timeout, so long streamed answers are not cut off
+            timeout = aiohttp.ClientTimeout(sock_connect=self.connect_timeout, sock_read=self.read_timeout)
+            session = self._sessions[loop] = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        return session
+
+    async def aclose(self):
+        """Close the sessions of every event loop the service was used from"""
+        loop = asyncio.get_running_loop()
+        sessions, self._sessions = self._sessions, {}
+        for session_loop, session in sessions.items():
+            if session_loop is not loop and session_loop.is_running():
+                # Its connections belong to that loop, so close it there
+                await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(session.close(), session_loop))
+            else:
+                await session.close()
+        pending = [task for task in self._closing if task.get_loop() is loop]
+        if pending:
+            await asyncio.gather(*pending)
+
+    def close(self):
+        self.http.close()
+
+
+def response_text(data):
+    """The answer text of a (non-streamed) messages API response"""
+    try:
+        return data['content'][0]['text']
+    except (KeyError, IndexError, TypeError) as e:
+        raise LLMServiceError(f"Unexpected LLM API response: {data!r:.200}") from e
+
+
+def parse_stream_line(line):
+    """Text carried by one line of the messages API event stream, if any.
 
+    Only content_block_delta events with a text delta carry text; an error
+    event raises LLMServiceError so callers handle it like a failed request.
+    """
+    if not line or not line.startswith('data:'):
+        return None
+    try:
+        event = json.loads(line[len('data:'):].strip())
+    except ValueError as e:
+        raise LLMServiceError(f"Malformed LLM API stream event: {e}") from e
+    if event.get('type') == 'error':
+        raise LLMServiceError(event.get('error', {}).get('message', 'stream error'))
+    if event.get('type') == 'content_block_delta' and event['delta'].get('type') == 'text_delta':
+        return event['delta']['text']
+    return None
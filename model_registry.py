@@ -0,0 +1,108 @@
+"""Process-wide registry of SentenceTransformer encoders"""
+
+import os
+import threading
+import time
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+from sentence_transformers import SentenceTransformer
+
+from query_cache import LRUCache, normalize_query
+
+DEFAULT_MODEL = 'all-MiniLM-L6-v2'
+
+_models: Dict[str, SentenceTransformer] = {}
+_query_caches: Dict[str, LRUCache] = {}
+_lock = threading.Lock()
+
+
+def get_model(name: Optional[str] = None) -> SentenceTransformer:
+    """Return the shared encoder for name, loading it on first use"""
+    name = name or DEFAULT_MODEL
+    model = _models.get(name)
+    if model is not None:
+        return model
+
+    with _lock:
+        # Another thread may have finished loading while we waited
+        model = _models.get(name)
+        if model is None:
+            print(f"Loading embedding model {name}...")
+            start = time.time()
+            model = SentenceTransformer(name)
+            _models[name] = model
+            print(f"Loaded {name} in {time.time() - start:.1f}s")
+    return model
+
+
+def get_query_cache(name: Optional[str] = None) -> LRUCache:
+    """The query embedding cache shared by everything that uses encoder name"""
+    name = name or DEFAULT_MODEL
+    cache = _query_caches.get(name)
+    if cache is None:
+        with _lock:
+            cache = _query_caches.setdefault(name, LRUCache(
+                max_entries=int(os.environ.get("QUERY_CACHE_SIZE", "2048")),
+                ttl=int(os.environ.get("QUERY_CACHE_TTL", "3600"))
+            ))
+    return cache
+
+
+def encode_query(query: str, name: Optional[str] = None) -> np.ndarray:
+    """L2-normalized float32 embedding of a query, cached per encoder.
+
+    The returned array is shared between callers and marked read-only.
+    """
+    cache = get_query_cache(name)
+    key = normalize_query(query)
+    embedding = cache.get(key)
+    if embedding is None:
+        embedding = np.asarray(get_model(name).encode(key), dtype=np.float32)
+        norm = np.linalg.norm(embedding)
+        if norm > 0:
+            embedding = embedding / norm
+        embedding.setflags(write=False)
+        cache.put(key, embedding)
+    return embedding
+
+
+def encode_queries(queries: List[str], name: Optional[str] = None) -> np.ndarray:
+    """(len(queries), dim) matrix of encode_query embeddings.
+
+    Queries missing from the cache are encoded together in one batch, and
+    each distinct one only once; their rows are cached for encode_query.
+    """
+    cache = get_query_cache(name)
+    keys = [normalize_query(query) for query in queries]
+    embeddings = {key: cache.get(key) for key in keys}
+    missing = [key for key, embedding in embeddings.items() if embedding is None]
+
+    if missing:
+        encoded = np.asarray(get_model(name).encode(missing), dtype=np.float32).reshape(len(missing), -1)
+        norms = np.linalg.norm(encoded, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        for key, embedding in zip(missing, encoded / norms):
+            embedding.setflags(write=False)
+            cache.put(key, embedding)
+            embeddings[key] = embedding
+
+    if not keys:
+        return np.zeros((0, 0), dtype=np.float32)
+    return np.stack([embeddings[key] for key in keys])
+
+
+def cache_stats():
+    """Hit/miss/eviction counters of every query embedding cache"""
+    return {name: cache.stats() for name, cache in _query_caches.items()}
+
+
+def warmup(names: Optional[Iterable[str]] = None):
+    """Load the given encoders up front and run one encode so the first request is not slow"""
+    for name in names or [DEFAULT_MODEL]:
+        get_model(name).encode("warmup")
+
+
+def loaded_models():
+    """Names of the encoders currently held by this process"""
+    return list(_models.keys())
@@ -1,46 +1,109 @@
 import json
-from typing import Dict, List, Optional
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Optional, Tuple
+from vector_store import federated_search, federated_search_batch
+from llm_service import LLMServiceError
+from model_registry import encode_query, encode_queries
+from semantic_cache import result_ids
+from session_store import ConversationSession, SessionStore
+
+DEFAULT_BATCH_CONCURRENCY = 8  # LLM calls in flight at once for one batch
 
 class PaymentAPIAgent:
-    def __init__(self, intent_recognizer, vector_stores, code_generator):
+    def __init__(self, intent_recognizer, vector_stores, code_generator, session_store=None,
+                 intent_classifier=None):
         self.intent_recognizer = intent_recognizer
         self.vector_stores = vector_stores  # Dict mapping provider to vector store
         self.code_generator = code_generator
-        self.conversation_history = []
+        self.sessions = session_store if session_store is not None else SessionStore()
+        self.intent_classifier = intent_classifier  # Optional SemanticIntentClassifier
+
+    @property
+    def conversation_history(self) -> List[Dict]:
+        """Turns of the default session, used when no session id is given"""
+        return list(self.sessions.get().turns)
+
+    def add_turn(self, session: ConversationSession, role: str, content: str, intent_data: Optional[Dict] = None):
+        """Record a message in the session's history and persist the session"""
+        session.add_turn(role, content, intent_data)
+        self.sessions.save(session)
+
+    def process_query(self, query: str, session_id: Optional[str] = None) -> Dict:
+        session = self.sessions.get(session_id)
 
-    def process_query(self, query: str) -> Dict:
         # Recognize intent
-        intent_data = self.intent_recognizer.recognize(query)
+        intent_data = self.recognize_intent(query, session)
 
         # Add to conversation history
-        self.conversation_history.append({
-            "role": "user",
-            "content": query
-        })
+        self.add_turn(session, "user", query, intent_data)
 
         # Determine if we need to ask for missing information
-        response = self.handle_missing_info(intent_data)
+        response = self.handle_missing_info(intent_data, session)
         if response:
             return response
 
-        # Choose provider
-        provider = intent_data['payment_provider']
-
         # Search documentation
-        if provider and provider in self.vector_stores:
-            vector_store = self.vector_stores[provider]
-            search_results = vector_store.search(query, top_k=3)
-        else:
-            # If no provider specified, search both
-            search_results = []
-            for p, store in self.vector_stores.items():
-                if provider is None or p == provider:
-                    results = store.search(query, top_k=2)
-                    for r in results:
-                        r['provider'] = p
-                    search_results.extend(results)
+        search_results = self.search_documentation(query, intent_data, top_k=3, federated_top_k=4)
 
         # Generate code if needed
+        code_snippet = self.generate_snippet(intent_data)
+
+        # Prepare response
+        response = self.format_response(intent_data, search_results, code_snippet)
+
+        # Add to conversation history
+        self.add_turn(session, "assistant", response['message'])
+
+        return response
+
+    def process_batch(self, queries: List[str], max_concurrency: int = DEFAULT_BATCH_CONCURRENCY) -> List[Dict]:
+        """Answer independent queries together, one response per query in order.
+
+        Each query is answered on its own, without conversation history.
+        Intents are recognized for every query, all queries are encoded in
+        one batch per model, and each store scores them together.
+        """
+        responses, pending = self.prepare_batch(queries, top_k=3, federated_top_k=4)
+        for i, (query, session, intent_data, search_results) in pending.items():
+            responses[i] = self.format_response(intent_data, search_results, self.generate_snippet(intent_data))
+        return responses
+
+    def prepare_batch(self, queries: List[str], top_k: int, federated_top_k: int):
+        """Everything up to and including search for a batch.
+
+        Returns (responses, pending): responses holds the clarification
+        question for queries missing information and None elsewhere; pending
+        maps the index of every other query to (query, session, intent_data,
+        search_results).
+        """
+        # One encoder batch per model; recognition and search then hit the query embedding cache
+        model_names = {store.model_name for store in self.vector_stores.values()}
+        if self.intent_classifier is not None:
+            model_names.add(self.intent_classifier.model_name)
+        for model_name in model_names:
+            encode_queries(queries, model_name)
+
+        responses = [None] * len(queries)
+        pending = {}
+        for i, query in enumerate(queries):
+            session = ConversationSession(f"batch-{i}", persist=False)
+            intent_data = self.recognize_intent(query, session)
+            self.add_turn(session, "user", query, intent_data)
+            responses[i] = self.handle_missing_info(intent_data, session)
+            if responses[i] is None:
+                pending[i] = (query, session, intent_data)
+
+        search_results = self.search_documentation_batch(
+            [query for query, _, _ in pending.values()],
+            [intent_data for _, _, intent_data in pending.values()],
+            top_k, federated_top_k
+        )
+        return responses, {i: item + (results,) for (i, item), results in zip(pending.items(), search_results)}
+
+    def generate_snippet(self, intent_data: Dict) -> Optional[Dict]:
+        """Code for the first code-related intent, or None if the query has none"""
+        provider = intent_data['payment_provider']
         code_snippet = None
         if any(intent in intent_data['matched_intents'] for intent in ['authentication', 'payment_processing', 'subscription', 'refund']):
             # Use the first matched intent for code generation
@@ -56,28 +119,143 @@ class PaymentAPIAgent:
                 provider=provider or 'stripe',  # Default to Stripe if not specified
                 language=intent_data['programming_language'] or 'javascript'  # Default to JS
             )
+        return code_snippet
+
+    async def aprocess_query(self, query: str, executor=None, session_id: Optional[str] = None) -> Dict:
+        """process_query for async servers: encoding and search run in executor, off the event loop"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, self.process_query, query, session_id)
+
+    async def aprocess_batch(self, queries: List[str], executor=None,
+                             max_concurrency: int = DEFAULT_BATCH_CONCURRENCY) -> List[Dict]:
+        """process_batch for async servers, run in executor"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, self.process_batch, queries, max_concurrency)
+
+    def stream_query(self, query: str, session_id: Optional[str] = None) -> Iterator[Tuple[str, Dict]]:
+        """Yield (event, data) pairs for query: documentation first, then message tokens, then done"""
+        yield from self.response_events(self.process_query(query, session_id))
+
+    async def astream_query(self, query: str, executor=None, session_id: Optional[str] = None):
+        """Async stream_query for async servers"""
+        loop = asyncio.get_running_loop()
+        response = await loop.run_in_executor(executor, self.process_query, query, session_id)
+        for event in self.response_events(response):
+            yield event
+
+    def response_events(self, response: Dict) -> Iterator[Tuple[str, Dict]]:
+        """Stream events for a response that is already complete"""
+        yield "documentation", self.documentation_event(response.get("intent_data"), response.get("documentation", []))
+        yield "token", {"text": response["message"]}
+        yield "done", response
+
+    def documentation_event(self, intent_data: Optional[Dict], documentation: List[Dict]) -> Dict:
+        return {
+            "intent_data": intent_data,
+            "documentation": documentation[:3] if documentation else []
+        }
 
-        # Prepare response
-        response = self.format_response(intent_data, search_results, code_snippet)
+    def search_documentation(self, query: str, intent_data: Dict, top_k: int,
+                             federated_top_k: int) -> List[Dict]:
+        """Search the provider's store, or rank across all stores if no provider is known.
 
-        # Add to conversation history
-        self.conversation_history.append({
-            "role": "assistant",
-            "content": response['message']
-        })
+        Chunks in the categories of the recognized intents rank higher, and
+        code examples are limited to the programming language.
+        """
+        provider = intent_data['payment_provider']
+        categories = [intent for intent in intent_data['matched_intents'] if intent != 'language_preference']
+        language = intent_data['programming_language']
 
-        return response
+        if provider and provider in self.vector_stores:
+            results = self.vector_stores[provider].search(query, top_k=top_k, categories=categories,
+                                                          language=language)
+            for r in results:
+                r['provider'] = provider
+            return results
+
+        # If no provider specified, encode once and rank results from every store together
+        return federated_search(self.vector_stores, query, top_k=federated_top_k, parallel=True,
+                                categories=categories, language=language)
+
+    def search_documentation_batch(self, queries: List[str], intent_datas: List[Dict], top_k: int,
+                                   federated_top_k: int) -> List[List[Dict]]:
+        """search_documentation for many queries, with one batch search per store"""
+        filters = [([intent for intent in intent_data['matched_intents'] if intent != 'language_preference'],
+                    intent_data['programming_language']) for intent_data in intent_datas]
+
+        # Queries for a known provider search its store; the rest search every store together
+        groups = {}
+        for i, intent_data in enumerate(intent_datas):
+            provider = intent_data['payment_provider']
+            groups.setdefault(provider if provider in self.vector_stores else None, []).append(i)
+
+        results = [[] for _ in queries]
+        for provider, indices in groups.items():
+            group_queries = [queries[i] for i in indices]
+            group_filters = [filters[i] for i in indices]
+            if provider is None:
+                group_results = federated_search_batch(self.vector_stores, group_queries, top_k=federated_top_k,
+                                                       parallel=True, filters=group_filters)
+            else:
+                store = self.vector_stores[provider]
+                group_results = store.search_batch(group_queries, store.encode_queries(group_queries), top_k,
+                                                   group_filters)
+                for query_results in group_results:
+                    for r in query_results:
+                        r['provider'] = provider
+            for i, query_results in zip(indices, group_results):
+                results[i] = query_results
+        return results
+
+    def recognize_intent(self, query: str, session: ConversationSession) -> Dict:
+        """Intents matched by the patterns; with an intent classifier, a query they miss is classified semantically.
+
+        A query the classifier is not confident about either continues the
+        session's previous task, as a follow-up like "and in Python?" does,
+        or is left without an intent so the user is asked what they need.
+        """
+        intent_data = self.intent_recognizer.recognize(query)
+        if self.intent_classifier is None:
+            return intent_data
+
+        if any(intent != 'language_preference' for intent in intent_data['matched_intents']):
+            intent_data['intent_source'] = 'pattern'
+            intent_data['intent_confidence'] = 1.0
+            return intent_data
+
+        intent, confidence = self.intent_classifier.classify_query(query)
+        intent_data['intent_confidence'] = confidence
+        if intent:
+            intent_data['matched_intents'].insert(0, intent)
+            intent_data['intent_source'] = 'semantic'
+        elif session.last_intent:
+            intent_data['matched_intents'].insert(0, session.last_intent)
+            intent_data['intent_source'] = 'session'
+        else:
+            intent_data['intent_source'] = None
+        return intent_data
 
-    def handle_missing_info(self, intent_data: Dict) -> Optional[Dict]:
+    def handle_missing_info(self, intent_data: Dict, session: ConversationSession) -> Optional[Dict]:
         """Check if we need more information from the user"""
-        if not intent_data['payment_provider'] and not self.has_previous_provider():
+        if not intent_data['payment_provider'] and not self.has_previous_provider(session):
             return {
                 "message": "Which payment provider are you working with? PayPal or Stripe?",
                 "missing_info": "payment_provider",
                 "options": ["PayPal", "Stripe"]
             }
 
-        if any(intent in intent_data['matched_intents'] for intent in ['authentication', 'payment_processing', 'subscription', 'refund']) and not intent_data['programming_language'] and not self.has_previous_language():
+        if self.intent_classifier is not None and intent_data.get('intent_source') is None:
+            # Neither the patterns nor the classifier could tell what the user wants; ask before searching
+            provider = intent_data['payment_provider'] or session.last_provider
+            return {
+                "message": f"What would you like to do with {provider.capitalize()}?",
+                "missing_info": "intent",
+                "options": ["Set up authentication", "Accept payment", "Create a subscription", "Issue a refund",
+                            "Troubleshoot an error"],
+                "intent_confidence": intent_data['intent_confidence']
+            }
+
+        if any(intent in intent_data['matched_intents'] for intent in ['authentication', 'payment_processing', 'subscription', 'refund']) and not intent_data['programming_language'] and not self.has_previous_language(session):
             return {
                 "message": "What programming language are you using for the integration?",
                 "missing_info": "programming_language",
@@ -86,24 +264,13 @@ class PaymentAPIAgent:
 
         return None
 
-    def has_previous_provider(self) -> bool:
-        """Check if a payment provider was mentioned in conversation history"""
-        for msg in self.conversation_history:
-            if msg["role"] == "user":
-                if "paypal" in msg["content"].lower():
-                    return True
-                if "stripe" in msg["content"].lower():
-                    return True
-        return False
-
-    def has_previous_language(self) -> bool:
-        """Check if a programming language was mentioned in conversation history"""
-        languages = ["javascript", "python", "php", "ruby", "java", "c#", "node"]
-        for msg in self.conversation_history:
-            if msg["role"] == "user":
-                if any(lang in msg["content"].lower() for lang in languages):
-                    return True
-        return False
+    def has_previous_provider(self, session: ConversationSession) -> bool:
+        """Check if a payment provider was mentioned in the session"""
+        return session.last_provider is not None
+
+    def has_previous_language(self, session: ConversationSession) -> bool:
+        """Check if a programming language was mentioned in the session"""
+        return session.last_language is not None
 
     def format_response(self, intent_data: Dict, search_results: List[Dict], code_snippet: Optional[Dict]) -> Dict:
         """Format a helpful response based on the available information"""
@@ -153,75 +320,245 @@ class PaymentAPIAgent:
         }
 
 class PaymentAPIAgentWithLLM(PaymentAPIAgent):
-    def __init__(self, intent_recognizer, vector_stores, code_generator, llm_service):
-        super().__init__(intent_recognizer, vector_stores, code_generator)
+    def __init__(self, intent_recognizer, vector_stores, code_generator, llm_service, semantic_cache=None,
+                 session_store=None, intent_classifier=None):
+        super().__init__(intent_recognizer, vector_stores, code_generator, session_store, intent_classifier)
         self.llm_service = llm_service
+        self.semantic_cache = semantic_cache  # Optional SemanticCache of earlier LLM answers
+
+    def process_query(self, query: str, session_id: Optional[str] = None) -> Dict:
+        response, request = self.prepare_llm_request(query, session_id)
+        if response:
+            return response
+        return self.answer(request)
+
+    def answer(self, request: Dict) -> Dict:
+        """The response to a prepared request: cached, from the LLM, or the template fallback"""
+        cached = self.cached_answer(request)
+        if cached is not None:
+            return self.finish_llm_response(request, cached, cached=True)
+
+        # Generate response with LLM using documentation context
+        try:
+            llm_response = self.llm_service.generate_response(
+                messages=request['messages'],
+                context=request['context']
+            )
+        except LLMServiceError as e:
+            return self.fallback_response(request, e)
+        self.remember_answer(request, llm_response)
+        return self.finish_llm_response(request, llm_response)
+
+    def process_batch(self, queries: List[str], max_concurrency: int = DEFAULT_BATCH_CONCURRENCY) -> List[Dict]:
+        """Answer independent queries together; at most max_concurrency LLM calls run at once"""
+        responses, pending = self.prepare_batch(queries, top_k=3, federated_top_k=6)
+        requests = {i: self.llm_request(*item) for i, item in pending.items()}
+        if requests:
+            with ThreadPoolExecutor(max_workers=max(1, min(max_concurrency, len(requests))),
+                                    thread_name_prefix="llm-batch") as executor:
+                for i, response in zip(requests, executor.map(self.answer, requests.values())):
+                    responses[i] = response
+        return responses
+
+    async def aprocess_batch(self, queries: List[str], executor=None,
+                             max_concurrency: int = DEFAULT_BATCH_CONCURRENCY) -> List[Dict]:
+        """process_batch for async servers: search runs in executor and LLM calls are awaited"""
+        loop = asyncio.get_running_loop()
+        responses, requests = await loop.run_in_executor(executor, self.prepare_llm_batch, queries)
+        semaphore = asyncio.Semaphore(max(1, max_concurrency))
+
+        async def answer(request):
+            async with semaphore:
+                return await self.aanswer(request)
+
+        answers = await asyncio.gather(*(answer(request) for request in requests.values()))
+        for i, response in zip(requests, answers):
+            responses[i] = response
+        return responses
+
+    def prepare_llm_batch(self, queries: List[str]) -> Tuple[List[Optional[Dict]], Dict[int, Dict]]:
+        responses, pending = self.prepare_batch(queries, top_k=3, federated_top_k=6)
+        return responses, {i: self.llm_request(*item) for i, item in pending.items()}
+
+    async def aprocess_query(self, query: str, executor=None, session_id: Optional[str] = None) -> Dict:
+        """Like process_query, but the LLM call awaits instead of holding a thread.
+
+        Intent recognition, query encoding and search are CPU bound and run
+        in executor, so the event loop stays free for other requests.
+        """
+        loop = asyncio.get_running_loop()
+        response, request = await loop.run_in_executor(executor, self.prepare_llm_request, query, session_id)
+        if response:
+            return response
+        return await self.aanswer(request)
+
+    async def aanswer(self, request: Dict) -> Dict:
+        """answer with an awaited LLM call"""
+        cached = self.cached_answer(request)
+        if cached is not None:
+            return self.finish_llm_response(request, cached, cached=True)
+
+        try:
+            llm_response = await self.llm_service.agenerate_response(
+                messages=request['messages'],
+                context=request['context']
+            )
+        except LLMServiceError as e:
+            return self.fallback_response(request, e)
+        self.remember_answer(request, llm_response)
+        return self.finish_llm_response(request, llm_response)
+
+    def stream_query(self, query: str, session_id: Optional[str] = None) -> Iterator[Tuple[str, Dict]]:
+        """Yield the retrieved documentation as soon as search is done, then LLM tokens as they arrive"""
+        response, request = self.prepare_llm_request(query, session_id)
+        if response:
+            yield from self.response_events(response)
+            return
+
+        yield "documentation", self.documentation_event(request['intent_data'], request['search_results'])
+
+        cached = self.cached_answer(request)
+        if cached is not None:
+            yield "token", {"text": cached}
+            yield "done", self.finish_llm_response(request, cached, cached=True)
+            return
+
+        tokens = []
+        try:
+            for text in self.llm_service.stream_response(messages=request['messages'], context=request['context']):
+                tokens.append(text)
+                yield "token", {"text": text}
+        except LLMServiceError as e:
+            if not tokens:
+                fallback = self.fallback_response(request, e)
+                yield "token", {"text": fallback["message"]}
+                yield "done", fallback
+                return
+            print(f"LLM stream interrupted, keeping the partial answer: {e}")
+        else:
+            self.remember_answer(request, "".join(tokens))
+
+        yield "done", self.finish_llm_response(request, "".join(tokens))
+
+    async def astream_query(self, query: str, executor=None, session_id: Optional[str] = None):
+        """Async stream_query: search runs in executor and tokens are awaited"""
+        loop = asyncio.get_running_loop()
+        response, request = await loop.run_in_executor(executor, self.prepare_llm_request, query, session_id)
+        if response:
+            for event in self.response_events(response):
+                yield event
+            return
+
+        yield "documentation", self.documentation_event(request['intent_data'], request['search_results'])
+
+        cached = self.cached_answer(request)
+        if cached is not None:
+            yield "token", {"text": cached}
+            yield "done", self.finish_llm_response(request, cached, cached=True)
+            return
+
+        tokens = []
+        try:
+            async for text in self.llm_service.astream_response(messages=request['messages'],
+                                                                context=request['context']):
+                tokens.append(text)
+                yield "token", {"text": text}
+        except LLMServiceError as e:
+            if not tokens:
+                fallback = self.fallback_response(request, e)
+                yield "token", {"text": fallback["message"]}
+                yield "done", fallback
+                return
+            print(f"LLM stream interrupted, keeping the partial answer: {e}")
+        else:
+            self.remember_answer(request, "".join(tokens))
+
+        yield "done", self.finish_llm_response(request, "".join(tokens))
+
+    def prepare_llm_request(self, query: str, session_id: Optional[str] = None) -> Tuple[Optional[Dict], Optional[Dict]]:
+        """Everything before the LLM call.
+
+        Returns (response, None) when the user must be asked for missing
+        information, otherwise (None, request) with the LLM messages and context.
+        """
+        session = self.sessions.get(session_id)
 
-    def process_query(self, query: str) -> Dict:
         # Recognize intent
-        intent_data = self.intent_recognizer.recognize(query)
+        intent_data = self.recognize_intent(query, session)
 
         # Add to conversation history
-        self.conversation_history.append({
-            "role": "user",
-            "content": query
-        })
+        self.add_turn(session, "user", query, intent_data)
 
         # Determine if we need to ask for missing information
-        response = self.handle_missing_info(intent_data)
+        response = self.handle_missing_info(intent_data, session)
         if response:
-            return response
-
-        # Choose provider
-        provider = intent_data['payment_provider']
+            return response, None
 
         # Search documentation
-        search_results = []
-        for p, store in self.vector_stores.items():
-            if provider is None or p == provider:
-                results = store.search(query, top_k=3)
-                for r in results:
-                    r['provider'] = p
-                search_results.extend(results)
+        search_results = self.search_documentation(query, intent_data, top_k=3, federated_top_k=6)
 
-        # Generate code if needed
-        code_snippet = None
-        if any(intent in intent_data['matched_intents'] for intent in ['authentication', 'payment_processing', 'subscription', 'refund']):
-            for intent in intent_data['matched_intents']:
-                if intent in ['authentication', 'payment_processing', 'subscription', 'refund']:
-                    primary_intent = intent
-                    break
-            else:
-                primary_intent = 'payment_processing'
+        return None, self.llm_request(query, session, intent_data, search_results)
 
-            code_snippet = self.code_generator.generate_code(
-                intent=primary_intent,
-                provider=provider or 'stripe',
-                language=intent_data['programming_language'] or 'javascript'
-            )
+    def llm_request(self, query: str, session: ConversationSession, intent_data: Dict,
+                    search_results: List[Dict]) -> Dict:
+        """The LLM messages and context for a query whose documentation has been searched"""
+        # Generate code if needed
+        code_snippet = self.generate_snippet(intent_data)
 
         # Prepare messages for LLM
         messages = []
-        for msg in self.conversation_history[-5:]:  # Use last 5 messages for context
+        for msg in session.recent(5):  # Use last 5 messages for context
             messages.append({
                 "role": msg["role"],
                 "content": msg["content"]
             })
 
-        # Generate response with LLM using documentation context
-        llm_response = self.llm_service.generate_response(
-            messages=messages,
-            context=search_results + ([code_snippet] if code_snippet else [])
-        )
+        context = search_results + ([code_snippet] if code_snippet else [])
+        request = {
+            "session": session,
+            "intent_data": intent_data,
+            "search_results": search_results,
+            "code_snippet": code_snippet,
+            "messages": messages,
+            "context": context
+        }
+        if self.semantic_cache is not None:
+            # The embedding was computed for search, so this is a cache lookup
+            request["cache_key"] = (encode_query(query, self.semantic_cache.model_name),
+                                    intent_data['payment_provider'], intent_data['programming_language'],
+                                    result_ids(context))
+        return request
+
+    def cached_answer(self, request: Dict) -> Optional[str]:
+        """An earlier LLM answer to a similar query over the same documentation, if cached"""
+        if self.semantic_cache is None:
+            return None
+        return self.semantic_cache.get(*request['cache_key'])
+
+    def remember_answer(self, request: Dict, answer: str):
+        if self.semantic_cache is not None and answer:
+            self.semantic_cache.put(*request['cache_key'], answer)
+
+    def fallback_response(self, request: Dict, error: Exception) -> Dict:
+        """Answer from the documentation and code templates alone when the LLM is unavailable"""
+        print(f"LLM unavailable ({error}), answering without it")
+        response = self.format_response(request['intent_data'], request['search_results'], request['code_snippet'])
 
         # Add to conversation history
-        self.conversation_history.append({
-            "role": "assistant",
-            "content": llm_response
-        })
+        self.add_turn(request['session'], "assistant", response['message'])
+        return response
 
-        return {
+    def finish_llm_response(self, request: Dict, llm_response: str, cached: bool = False) -> Dict:
+        search_results = request['search_results']
+
+        # Add to conversation history
+        self.add_turn(request['session'], "assistant", llm_response)
+
+        response = {
             "message": llm_response,
-            "intent_data": intent_data,
+            "intent_data": request['intent_data'],
             "documentation": search_results[:3] if search_results else []
-        }
\ No newline at end of file
+        }
+        if cached:
+            response["cached"] = True
+        return response
\ No newline at end of file
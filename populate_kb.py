@@ -1,39 +1,193 @@
 import argparse
 import os
-import sys
-from scraper import scrape_documentation
-from embedder import clean_and_structure_docs, create_embeddings
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from scraper import scrape_documentation, DEFAULT_MAX_DEPTH, DEFAULT_MAX_PAGES, DEFAULT_CONCURRENCY
+from embedder import clean_and_structure_docs, structure_document, create_embeddings, DEFAULT_BATCH_SIZE, NO_QUANTIZATION
+from vector_store import CURRENT_FILE
+from payment_providers import get_provider_config, get_supported_providers
 
-def main():
-    parser = argparse.ArgumentParser(description="Populate Payment API Knowledge Base")
-    parser.add_argument("--provider", choices=["stripe", "paypal", "all"], default="all",
-                        help="Which API provider to scrape")
-    args = parser.parse_args()
 
-    providers = ["stripe", "paypal"] if args.provider == "all" else [args.provider]
+class StageTimer:
+    """Wall-clock time per (provider, stage), safe to update from several threads"""
+
+    def __init__(self):
+        self.timings = {}
+        self.lock = threading.Lock()
+
+    def record(self, provider, stage, seconds):
+        with self.lock:
+            self.timings.setdefault(provider, {})[stage] = seconds
+        print(f"[{provider}] {stage} finished in {seconds:.1f}s")
+
+    def report(self, total):
+        print("\nStage timings:")
+        for provider, stages in self.timings.items():
+            line = ", ".join(f"{stage} {seconds:.1f}s" for stage, seconds in stages.items())
+            print(f"  {provider}: {line}")
+        print(f"  total wall clock: {total:.1f}s")
+
+
+def scrape_provider(provider, args, timer, events):
+    """Stage 1 (I/O bound): crawl one provider's documentation.
+
+    Every changed page is put on events as ('page', provider, filename) as
+    soon as it is saved, followed by ('done', provider, crawl result or
+    exception) once the crawl is over.
+    """
+    start = time.time()
+
+    def on_page(filename, changed):
+        if changed:
+            events.put(('page', provider, filename))
+
+    try:
+        base_url = get_provider_config(provider)['base_url']
+        crawl = scrape_documentation(base_url, f"knowledge_base/{provider}", max_depth=args.max_depth,
+                                     max_pages=args.max_pages, concurrency=args.concurrency,
+                                     use_cache=not args.no_cache, on_page=on_page)
+    except Exception as e:
+        events.put(('done', provider, e))
+        return
+    timer.record(provider, "scrape", time.time() - start)
+    events.put(('done', provider, crawl))
+
+
+def clean_feeder(events, crawled, parse_pool, cleaned):
+    """Stage 2 (CPU bound): submit each crawled page to the process pool as it arrives.
+
+    Futures are kept in cleaned[provider][filename]. Finished crawls are
+    passed on to crawled only after all of their pages were submitted.
+    """
+    while True:
+        event = events.get()
+        if event is None:
+            break
+        kind, provider, value = event
+        if kind == 'page':
+            path = os.path.join(f"knowledge_base/{provider}", value)
+            cleaned.setdefault(provider, {})[value] = parse_pool.submit(structure_document, path)
+        else:
+            crawled.put((provider, value))
+
 
-    for provider in providers:
-        print(f"Processing {provider.capitalize()} documentation...")
+def embedding_consumer(jobs, args, timer):
+    """Stage 3: a single consumer so only one batched encode runs at a time"""
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        provider, structured_output, embeddings_dir = job
+        start = time.time()
+        try:
+            create_embeddings(structured_output, embeddings_dir, batch_size=args.batch_size,
+                              incremental=args.incremental,
+                              ann_index=args.ann_index, ann_lists=args.ann_lists,
+                              quantization=args.quantize)
+            timer.record(provider, "embed", time.time() - start)
+            print(f"✅ Finished processing {provider.capitalize()} documentation!")
+        except Exception as e:
+            print(f"Error embedding {provider}: {e}")
 
-        # Step 1: Scrape documentation
-        print("Scraping documentation...")
-        base_url = "https://developer.paypal.com" if provider == "paypal" else "https://docs.stripe.com"
-        output_dir = f"knowledge_base/{provider}"
-        scrape_documentation(base_url, output_dir)
 
-        # Step 2: Clean and structure documents
-        print("Cleaning and structuring documents...")
-        structured_output = f"structured_knowledge/{provider}.json"
-        clean_and_structure_docs(output_dir, structured_output)
+def run_pipeline(providers, args):
+    """Scrape, clean and embed providers with the stages overlapped.
 
-        # Step 3: Create embeddings
-        print("Creating embeddings...")
-        embeddings_dir = f"vector_db/{provider}"
-        create_embeddings(structured_output, embeddings_dir)
+    Crawls run in a thread pool and queue each page as it is saved, a
+    feeder thread hands queued pages to a process pool for cleaning while
+    the crawls go on, and a single thread embeds providers in the order
+    their cleaning completes.
+    """
+    timer = StageTimer()
+    pipeline_start = time.time()
+
+    jobs = queue.Queue()
+    consumer = threading.Thread(target=embedding_consumer, args=(jobs, args, timer))
+    consumer.start()
+
+    try:
+        with ThreadPoolExecutor(max_workers=len(providers)) as fetch_pool, \
+                ProcessPoolExecutor(max_workers=args.workers) as parse_pool:
+            events = queue.Queue()
+            crawled = queue.Queue()
+            cleaned = {}
+            feeder = threading.Thread(target=clean_feeder, args=(events, crawled, parse_pool, cleaned))
+            feeder.start()
+            try:
+                for provider in providers:
+                    fetch_pool.submit(scrape_provider, provider, args, timer, events)
+
+                for _ in providers:
+                    provider, crawl = crawled.get()
+                    if isinstance(crawl, Exception):
+                        print(f"Error scraping {provider}: {crawl}")
+                        continue
+
+                    structured_output = f"structured_knowledge/{provider}.jsonl"
+                    embeddings_dir = f"vector_db/{provider}"
+                    if not crawl['changed'] and not crawl['removed'] and crawl['unchanged'] \
+                            and os.path.exists(structured_output) \
+                            and os.path.exists(os.path.join(embeddings_dir, CURRENT_FILE)):
+                        print(f"No documentation changes for {provider.capitalize()}, skipping cleaning and embedding")
+                        continue
+
+                    # Pages cleaned during the crawl are collected, the rest is reused or cleaned now
+                    start = time.time()
+                    clean_and_structure_docs(f"knowledge_base/{provider}", structured_output,
+                                             unchanged_files=crawl['unchanged'], executor=parse_pool,
+                                             cleaned=cleaned.pop(provider, None))
+                    timer.record(provider, "clean", time.time() - start)
+
+                    jobs.put((provider, structured_output, embeddings_dir))
+            finally:
+                events.put(None)
+                feeder.join()
+    finally:
+        jobs.put(None)
+        consumer.join()
+
+    timer.report(time.time() - pipeline_start)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Populate Payment API Knowledge Base")
+    parser.add_argument("--provider", choices=get_supported_providers() + ["all"], default="all",
+                        help="Which API provider to scrape")
+    parser.add_argument("--max-depth", type=int, default=DEFAULT_MAX_DEPTH,
+                        help="How many links deep to crawl from the provider's start page")
+    parser.add_argument("--max-pages", type=int, default=DEFAULT_MAX_PAGES,
+                        help="Maximum number of documentation pages to fetch per provider")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY,
+                        help="Number of pages fetched in parallel")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="Number of processes used to clean documents")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Ignore the crawl cache and re-download every page")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE,
+                        help="Number of chunks to encode per model call")
+    parser.add_argument("--incremental", action=argparse.BooleanOptionalAction, default=True,
+                        help="Only encode chunks whose content changed since the last build (default: on)")
+    parser.add_argument("--ann-index", action=argparse.BooleanOptionalAction, default=None,
+                        help="Build an IVF approximate nearest-neighbour index next to the embeddings "
+                             "(default: as in the previous build)")
+    parser.add_argument("--ann-lists", type=int, default=None,
+                        help="Number of IVF clusters (default: sqrt of the number of chunks)")
+    parser.add_argument("--quantize", choices=["int8", "pq", NO_QUANTIZATION], default=None,
+                        help="Also store compressed int8 or product-quantized codes of the embeddings, "
+                             "or none (default: as in the previous build)")
+    return parser.parse_args(argv)
+
+
+def main():
+    args = parse_args()
+    providers = get_supported_providers() if args.provider == "all" else [args.provider]
+    print(f"Processing {', '.join(p.capitalize() for p in providers)} documentation...")
 
-        print(f"✅ Finished processing {provider.capitalize()} documentation!")
+    run_pipeline(providers, args)
 
     print("\nKnowledge base population complete!")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,246 @@
+"""Compressed embedding codes (int8 scalar and product quantization) with asymmetric scoring"""
+
+import os
+import time
+from typing import Dict, List
+
+import numpy as np
+
+from ann_index import kmeans, assign, sample_queries, recall_at_k
+
+# Each quantizer is a directory of .npy files in the snapshot. The codes are memory-mapped read-only,
+# like embeddings.npy, so every worker on a host shares one copy in the page cache.
+INT8_FILE = 'int8_codes'
+PQ_FILE = 'pq_codes'
+DEFAULT_PQ_SUBVECTORS = 96     # 384 dims -> 4 dims per sub-vector, 96 bytes per row
+DEFAULT_RERANK_FACTOR = 4      # exact re-ranking looks at top_k * factor shortlisted rows
+BLOCK_SIZE = 16384             # rows per block when building codes
+SCORE_BLOCK_SIZE = 512         # int8 rows converted per block at query time, small enough to stay in cache
+
+
+def save_arrays(path, **arrays):
+    os.makedirs(path, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(os.path.join(path, f"{name}.npy"), array)
+
+
+def load_arrays(path, *names):
+    """Arrays saved by save_arrays, with 'codes' memory-mapped; also reads the older single .npz file"""
+    if os.path.isfile(path):
+        data = np.load(path)
+        return [data[name] for name in names]
+    return [np.load(os.path.join(path, f"{name}.npy"), mmap_mode='r' if name == 'codes' else None)
+            for name in names]
+
+
+class ScalarQuantizer:
+    """Symmetric per-dimension int8 codes: row ~= codes * scale.
+
+    Queries stay float32 (asymmetric distance), so scoring is one
+    matrix-vector product against the int8 codes converted block by block.
+    """
+
+    mode = 'int8'
+    filename = INT8_FILE
+
+    def __init__(self, scale, codes):
+        self.scale = scale      # (dim,) float32
+        self.codes = codes      # (n_rows, dim) int8
+
+    @classmethod
+    def build(cls, matrix, block_size=BLOCK_SIZE):
+        start = time.time()
+        n_rows, dim = matrix.shape
+        max_abs = np.zeros(dim, dtype=np.float32)
+        for offset in range(0, n_rows, block_size):
+            block = np.asarray(matrix[offset:offset + block_size], dtype=np.float32)
+            max_abs = np.maximum(max_abs, np.abs(block).max(axis=0))
+        scale = np.where(max_abs > 0, max_abs / 127.0, 1.0).astype(np.float32)
+
+        codes = np.empty((n_rows, dim), dtype=np.int8)
+        for offset in range(0, n_rows, block_size):
+            block = np.asarray(matrix[offset:offset + block_size], dtype=np.float32)
+            codes[offset:offset + block_size] = np.clip(np.rint(block / scale), -127, 127)
+        print(f"Built int8 codes for {n_rows} rows in {time.time() - start:.1f}s")
+        return cls(scale, codes)
+
+    def scores(self, query, rows=None, block_size=SCORE_BLOCK_SIZE):
+        """Approximate inner products of query with every row (or only rows)"""
+        codes = self.codes if rows is None else self.codes[rows]
+        scaled_query = (query * self.scale).astype(np.float32)
+        scores = np.empty(codes.shape[0], dtype=np.float32)
+        for offset in range(0, codes.shape[0], block_size):
+            scores[offset:offset + block_size] = codes[offset:offset + block_size].astype(np.float32) @ scaled_query
+        return scores
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + self.scale.nbytes
+
+    def save(self, path):
+        save_arrays(path, scale=self.scale, codes=self.codes)
+
+    @classmethod
+    def load(cls, path):
+        return cls(*load_arrays(path, 'scale', 'codes'))
+
+
+class ProductQuantizer:
+    """Splits rows into sub-vectors and stores the id of the nearest of 256 sub-centroids for each.
+
+    A query is scored by building a (sub-vectors x 256) table of its inner
+    products with the sub-centroids once, then summing table lookups per row.
+    """
+
+    mode = 'pq'
+    filename = PQ_FILE
+
+    def __init__(self, codebooks, codes):
+        self.codebooks = codebooks  # (n_subvectors, n_centroids, sub_dim) float32
+        self.codes = codes          # (n_subvectors, n_rows) uint8, one contiguous row per sub-vector
+
+    @property
+    def n_subvectors(self):
+        return self.codebooks.shape[0]
+
+    @classmethod
+    def build(cls, matrix, n_subvectors=DEFAULT_PQ_SUBVECTORS, n_iter=20, seed=0, block_size=BLOCK_SIZE):
+        start = time.time()
+        n_rows, dim = matrix.shape
+        if dim % n_subvectors:
+            raise ValueError(f"Dimension {dim} is not divisible by {n_subvectors} sub-vectors")
+        sub_dim = dim // n_subvectors
+        n_centroids = min(256, n_rows)
+
+        # Train every codebook on the same sample of rows
+        rng = np.random.default_rng(seed)
+        max_train = 64 * 256
+        picks = np.sort(rng.choice(n_rows, max_train, replace=False)) if n_rows > max_train else slice(None)
+        train = np.asarray(matrix[picks], dtype=np.float32)
+
+        codebooks = np.empty((n_subvectors, n_centroids, sub_dim), dtype=np.float32)
+        for i in range(n_subvectors):
+            codebooks[i] = kmeans(train[:, i * sub_dim:(i + 1) * sub_dim], n_centroids, n_iter=n_iter,
+                                  seed=seed, spherical=False)
+
+        codes = np.empty((n_subvectors, n_rows), dtype=np.uint8)
+        for offset in range(0, n_rows, block_size):
+            block = np.asarray(matrix[offset:offset + block_size], dtype=np.float32)
+            for i in range(n_subvectors):
+                codes[i, offset:offset + block_size] = assign(block[:, i * sub_dim:(i + 1) * sub_dim],
+                                                              codebooks[i], spherical=False)
+        print(f"Built PQ codes ({n_subvectors} x {n_centroids}) for {n_rows} rows in {time.time() - start:.1f}s")
+        return cls(codebooks, codes)
+
+    def scores(self, query, rows=None):
+        """Approximate inner products of query with every row (or only rows) via table lookups"""
+        codes = self.codes if rows is None else self.codes[:, rows]
+        sub_queries = query.reshape(self.n_subvectors, -1)
+        table = np.einsum('mkd,md->mk', self.codebooks, sub_queries).astype(np.float32)
+        scores = np.zeros(codes.shape[1], dtype=np.float32)
+        for i in range(self.n_subvectors):
+            scores += table[i].take(codes[i])
+        return scores
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + self.codebooks.nbytes
+
+    def save(self, path):
+        save_arrays(path, codebooks=self.codebooks, codes=self.codes)
+
+    @classmethod
+    def load(cls, path):
+        return cls(*load_arrays(path, 'codebooks', 'codes'))
+
+
+QUANTIZERS = {'int8': ScalarQuantizer, 'pq': ProductQuantizer}
+
+
+def build_quantizer(mode, matrix, **kwargs):
+    if mode not in QUANTIZERS:
+        raise ValueError(f"Unknown quantization mode {mode!r}, expected one of {sorted(QUANTIZERS)}")
+    return QUANTIZERS[mode].build(matrix, **kwargs)
+
+
+def rank_quantized(quantizer, matrix, query, top_k, rows=None, rerank_factor=DEFAULT_RERANK_FACTOR):
+    """(row ids, scores) of the approximate top_k, best first.
+
+    With rerank_factor, the top_k * rerank_factor rows by code score are
+    re-scored exactly against the float matrix, which only reads those rows
+    when it is memory-mapped. rerank_factor=0 returns the code scores as is.
+    """
+    scores = quantizer.scores(query, rows)
+    shortlist_size = top_k * rerank_factor if rerank_factor else top_k
+    shortlist = np.argpartition(-scores, shortlist_size - 1)[:shortlist_size] \
+        if shortlist_size < len(scores) else np.arange(len(scores))
+    shortlist_rows = shortlist if rows is None else rows[shortlist]
+
+    if rerank_factor:
+        order = np.argsort(shortlist_rows)
+        shortlist_rows = shortlist_rows[order]
+        scores = np.asarray(matrix[shortlist_rows], dtype=np.float32) @ query
+    else:
+        scores = scores[shortlist]
+
+    best = np.argsort(-scores, kind='stable')[:top_k]
+    return shortlist_rows[best], scores[best]
+
+
+def resident_bytes(quantizer, workers=1) -> Dict:
+    """Resident memory per worker for the codes as VectorStore loads them.
+
+    The codes are memory-mapped, so workers on one host share a single
+    copy and each holds only the small scale or codebook arrays itself.
+    """
+    shared = quantizer.codes.nbytes
+    private = quantizer.nbytes - shared
+    return {'workers': workers, 'private': private, 'shared': shared, 'per_worker': private + shared / workers}
+
+
+def quantization_report(matrix, quantizer, queries=None, k=10, rerank_factors=(0, 2, 4, 8),
+                        workers=(1, 4, 16)) -> List[Dict]:
+    """Print and return memory use and recall@k of the codes against exact float search"""
+    queries = sample_queries(matrix) if queries is None else queries
+    n_rows, dim = matrix.shape
+    float64_bytes = n_rows * dim * 8
+    print(f"{quantizer.mode} codes: {quantizer.nbytes / max(n_rows, 1):.0f} bytes/row, "
+          f"{float64_bytes / quantizer.nbytes:.1f}x smaller than float64, "
+          f"{float64_bytes / 2 / quantizer.nbytes:.1f}x smaller than float32")
+    for count in workers:
+        memory = resident_bytes(quantizer, count)
+        print(f"{count:>3} workers: {memory['per_worker'] / 2 ** 20:.2f} MiB resident per worker "
+              f"({memory['private'] / 2 ** 20:.2f} MiB own, {memory['shared'] / 2 ** 20:.2f} MiB of codes shared)")
+
+    report = []
+    for factor in rerank_factors:
+        def search(query, top_k, factor=factor):
+            return rank_quantized(quantizer, matrix, query, top_k, rerank_factor=factor)[0]
+
+        recall, ms = recall_at_k(matrix, queries, search, k)
+        report.append({'rerank_factor': factor, 'recall': recall, 'ms_per_query': ms,
+                       'bytes_per_row': quantizer.nbytes / max(n_rows, 1),
+                       'resident_per_worker': [resident_bytes(quantizer, count) for count in workers]})
+        label = f"rerank x{factor}" if factor else "codes only"
+        print(f"{label:<12} recall@{k}={recall:.3f}  {ms:.3f} ms/query")
+    return report
+
+
+if __name__ == '__main__':
+    import argparse
+    from vector_store import read_store, resolve_store_dir
+
+    parser = argparse.ArgumentParser(description="Report memory and recall@k of quantized embeddings")
+    parser.add_argument("store", help="Store directory, e.g. vector_db/stripe")
+    parser.add_argument("--mode", choices=sorted(QUANTIZERS), default='int8')
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--workers", type=int, nargs='+', default=[1, 4, 16],
+                        help="Worker counts to show resident memory per worker for")
+    args = parser.parse_args()
+
+    _, embeddings, _ = read_store(args.store)
+    # Report on the saved codes, loaded as the app loads them, when the store has them
+    codes_path = os.path.join(resolve_store_dir(args.store), QUANTIZERS[args.mode].filename)
+    quantizer = QUANTIZERS[args.mode].load(codes_path) if os.path.exists(codes_path) \
+        else build_quantizer(args.mode, embeddings)
+    quantization_report(embeddings, quantizer, k=args.k, workers=args.workers)
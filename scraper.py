@@ -1,97 +1,351 @@
-import requests
+import asyncio
+import aiohttp
 from bs4 import BeautifulSoup
+import hashlib
+import random
 import re
 import json
 import os
 import time
-from urllib.parse import urljoin
+from urllib.parse import urljoin, urldefrag, urlparse
 
-def scrape_documentation(base_url, output_dir):
-    """Scrape documentation from a payment API provider website"""
-    # Create output directory if it doesn't exist
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
+# Crawl defaults, all overridable per call
+DEFAULT_MAX_DEPTH = 2          # 0 = start page only, 1 = pages it links to, ...
+DEFAULT_MAX_PAGES = 200        # cap on documentation pages fetched per crawl
+DEFAULT_CONCURRENCY = 8        # requests in flight at once
+DEFAULT_RATE_LIMIT = 4.0       # requests per second per host
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 0.5          # seconds, doubled on every retry
+DEFAULT_TIMEOUT = 30           # seconds per request
 
-    print(f"Scraping documentation from {base_url}...")
+CRAWL_CACHE_FILE = '.crawl_cache.json'
 
-    # Get the main page
-    try:
-        response = requests.get(base_url)
-        response.raise_for_status()
-    except requests.exceptions.RequestException as e:
-        print(f"Error fetching {base_url}: {e}")
-        return
+DOC_PATH_PATTERNS = ['/docs/', '/reference/', '/guides/', '/api/']
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+GONE_STATUSES = {404, 410}  # pages that no longer exist; they do not make a crawl incomplete
 
-    soup = BeautifulSoup(response.text, 'html.parser')
 
-    # Extract links to documentation pages
-    links = []
-    visited_links = set()
+class HostRateLimiter:
+    """Spaces out requests to each host so no host sees more than `rate` per second"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.next_slot = {}
+        self.locks = {}
+
+    async def wait(self, url):
+        if not self.interval:
+            return
+        host = urlparse(url).netloc
+        lock = self.locks.setdefault(host, asyncio.Lock())
+        async with lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot.get(host, now))
+            self.next_slot[host] = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+class CrawlCache:
+    """Per-URL validators (ETag, Last-Modified, body hash) from the previous crawl.
+
+    Stored next to the scraped pages so the next crawl can send conditional
+    requests and tell which pages actually changed.
+    """
+
+    def __init__(self, output_dir):
+        self.path = os.path.join(output_dir, CRAWL_CACHE_FILE)
+        self.output_dir = output_dir
+        self.entries = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r') as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"Ignoring unreadable crawl cache {self.path}: {e}")
+
+    def get(self, url):
+        """Cached entry for url, only if the page it describes is still on disk"""
+        entry = self.entries.get(url)
+        if entry and entry.get('filename') and not os.path.exists(os.path.join(self.output_dir, entry['filename'])):
+            return None
+        return entry
+
+    def conditional_headers(self, url):
+        entry = self.get(url) or {}
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def update(self, url, **fields):
+        self.entries.setdefault(url, {}).update(fields)
+
+    def limits(self, base_url):
+        """max_depth and max_pages of the crawls from base_url that saved the current pages"""
+        return (self.entries.get(base_url) or {}).get('limits')
+
+    def set_limits(self, base_url, limits):
+        self.update(base_url, limits=limits)
 
-    # Find all links in the main navigation that likely point to docs
+    def forget_files(self, filenames):
+        """Drop the entries of pages saved as any of filenames"""
+        filenames = set(filenames)
+        self.entries = {url: entry for url, entry in self.entries.items() if entry.get('filename') not in filenames}
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entries, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+
+def is_doc_link(href):
+    """Filter for documentation links based on common patterns"""
+    return any(pattern in href for pattern in DOC_PATH_PATTERNS)
+
+
+def extract_links(page_url, soup, allowed_host):
+    """Absolute documentation links on a page that stay on the crawled host"""
+    links = []
     for a in soup.find_all('a', href=True):
         href = a['href']
+        if not is_doc_link(href):
+            continue
+
+        # Handle relative URLs and drop fragments so a page is only fetched once
+        href, _ = urldefrag(urljoin(page_url, href))
+        if urlparse(href).netloc == allowed_host:
+            links.append(href)
+    return links
+
+
+def extract_document(url, soup):
+    """Pull the title, main content and code examples out of a documentation page"""
+    # Look for common content container classes
+    content = None
+    for selector in ['article', '.documentation', '.docs-content', '.content', 'main', '#main-content']:
+        content = soup.select_one(selector)
+        if content:
+            break
+
+    if not content:
+        content = soup.find('body')  # Fallback to body if no content container found
+
+    # Extract code examples
+    code_examples = []
+    for code in soup.find_all(['pre', 'code']):
+        code_examples.append(code.text)
+
+    return {
+        'url': url,
+        'title': soup.title.text if soup.title else '',
+        'content': content.text.strip() if content else '',
+        'code_examples': code_examples
+    }
+
+
+def filename_for(url):
+    """Safe, collision-resistant filename for a page URL.
 
-        # Filter for documentation links based on common patterns
-        if '/docs/' in href or '/reference/' in href or '/guides/' in href or '/api/' in href:
-            # Handle relative URLs
-            if href.startswith('/'):
-                href = urljoin(base_url, href)
-            elif not href.startswith('http'):
-                href = urljoin(base_url, href)
+    The readable slug of the path maps '-', '.' and '/' alike and drops the
+    query, so a short hash of the full URL keeps such pages apart.
+    """
+    slug = re.sub(r'[^\w]', '_', urlparse(url).path.strip('/')) or 'doc'
+    return f"{slug}_{hashlib.sha1(url.encode('utf-8')).hexdigest()[:8]}"
 
-            # Only add if not already in the list
-            if href not in visited_links:
-                links.append(href)
-                visited_links.add(href)
 
-    print(f"Found {len(links)} documentation links to process")
+def saved_pages(output_dir):
+    """Filenames of the pages saved in output_dir, without the crawl cache and other dotfiles"""
+    return {name for name in os.listdir(output_dir) if name.endswith('.json') and not name.startswith('.')}
 
-    # Process each documentation page
-    for i, link in enumerate(links[:20]):  # Limit to first 20 for initial testing
+
+def remove_stale_pages(output_dir, written, cache=None):
+    """Delete saved pages the crawl did not write, e.g. pages no longer linked or older doc_N.json names.
+
+    Returns the removed filenames. Their crawl cache entries are dropped too.
+    """
+    stale = sorted(saved_pages(output_dir) - set(written))
+    for filename in stale:
+        os.remove(os.path.join(output_dir, filename))
+    if cache and stale:
+        cache.forget_files(stale)
+    if stale:
+        print(f"Removed {len(stale)} pages the crawl no longer reaches from {output_dir}")
+    return stale
+
+
+def parse_page(url, html, allowed_host):
+    """Parse a fetched page into (document, links); runs off the event loop"""
+    soup = BeautifulSoup(html, 'html.parser')
+    return extract_document(url, soup), extract_links(url, soup, allowed_host)
+
+
+async def fetch(session, url, limiter, retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF, headers=None):
+    """GET a page, retrying transient failures with jittered exponential backoff.
+
+    Returns (status, body, response headers); body is None for a 304.
+    """
+    for attempt in range(retries + 1):
+        await limiter.wait(url)
         try:
-            print(f"Processing {i+1}/{len(links)}: {link}")
-
-            # Add delay to avoid rate limiting
-            time.sleep(1)
-
-            page_response = requests.get(link)
-            page_response.raise_for_status()
-            page_soup = BeautifulSoup(page_response.text, 'html.parser')
-
-            # Extract content (You'll need to adapt this for each site)
-            # Look for common content container classes
-            content = None
-            for selector in ['article', '.documentation', '.docs-content', '.content', 'main', '#main-content']:
-                content = page_soup.select_one(selector)
-                if content:
-                    break
-
-            if not content:
-                content = page_soup.find('body')  # Fallback to body if no content container found
-
-            # Extract code examples
-            code_examples = []
-            for code in page_soup.find_all(['pre', 'code']):
-                code_examples.append(code.text)
-
-            # Generate a safe filename from the URL
-            filename = re.sub(r'[^\w]', '_', link.split('/')[-1])
-            if not filename or filename.isspace():
-                filename = f"doc_{i}"
-
-            # Save content to file
-            with open(os.path.join(output_dir, f"{filename}.json"), 'w') as f:
-                json.dump({
-                    'url': link,
-                    'title': page_soup.title.text if page_soup.title else '',
-                    'content': content.text.strip() if content else '',
-                    'code_examples': code_examples
-                }, f, indent=2)
-
-            print(f"Saved {filename}.json")
-
-        except Exception as e:
-            print(f"Error processing {link}: {e}")
-
-    print(f"Documentation scraping complete. Saved to {output_dir}")
\ No newline at end of file
+            async with session.get(url, headers=headers) as response:
+                if response.status in RETRY_STATUSES and attempt < retries:
+                    retry_after = response.headers.get('Retry-After', '')
+                    delay = float(retry_after) if retry_after.isdigit() else backoff * 2 ** attempt
+                    print(f"Got {response.status} for {url}, retrying in {delay:.1f}s")
+                    await asyncio.sleep(delay + random.uniform(0, backoff))
+                    continue
+                if response.status == 304:
+                    return response.status, None, response.headers
+                response.raise_for_status()
+                return response.status, await response.text(), response.headers
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            if attempt == retries:
+                raise
+            delay = backoff * 2 ** attempt + random.uniform(0, backoff)
+            print(f"Error fetching {url} ({e!r}), retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+
+async def crawl(base_url, output_dir, max_depth=DEFAULT_MAX_DEPTH, max_pages=DEFAULT_MAX_PAGES,
+                concurrency=DEFAULT_CONCURRENCY, rate_limit=DEFAULT_RATE_LIMIT, retries=DEFAULT_RETRIES,
+                backoff=DEFAULT_BACKOFF, timeout=DEFAULT_TIMEOUT, use_cache=True, on_page=None):
+    """Breadth-first crawl of documentation pages under base_url.
+
+    With use_cache, pages are requested conditionally against the crawl
+    cache; a 304 or an identical body leaves the saved file untouched.
+    After a crawl without errors that reached every page within its limits,
+    saved pages it did not reach are removed, so they are not embedded
+    again. Pages are kept when the start page failed, nothing past it was
+    fetched, the page cap was hit, or the limits are tighter than those of
+    the crawls that saved them. Returns {'changed': [...],
+    'unchanged': [...], 'removed': [...]} lists of filenames.
+    on_page(filename, changed) is called for every saved or unchanged page
+    as soon as it is known, so later stages can start on it mid-crawl.
+    """
+    allowed_host = urlparse(base_url).netloc
+    limiter = HostRateLimiter(rate_limit)
+    loop = asyncio.get_running_loop()
+    # Without use_cache the validators are not sent, but the cache is still kept up to date
+    cache = CrawlCache(output_dir)
+
+    queue = asyncio.Queue()
+    seen = {base_url}
+    changed = []
+    unchanged = []
+    errors = 0
+    scheduled_pages = 0
+
+    queue.put_nowait((base_url, 0))
+
+    async def worker(session):
+        nonlocal scheduled_pages, errors
+        while True:
+            url, depth = await queue.get()
+            try:
+                entry = cache.get(url) if use_cache else None
+                headers = cache.conditional_headers(url) if entry else None
+                status, html, response_headers = await fetch(session, url, limiter, retries, backoff, headers)
+
+                body_hash = hashlib.sha1(html.encode('utf-8')).hexdigest() if html is not None else None
+                if entry and (status == 304 or body_hash == entry.get('body_hash')):
+                    # Not modified: reuse the saved page and the links recorded for it
+                    links = entry.get('links', [])
+                    if entry.get('filename'):
+                        unchanged.append(entry['filename'])
+                        if on_page:
+                            on_page(entry['filename'], False)
+                else:
+                    document, links = await loop.run_in_executor(None, parse_page, url, html, allowed_host)
+
+                    # The start page is only a source of links
+                    filename = None
+                    if depth > 0:
+                        filename = (entry or {}).get('filename') or f"{filename_for(url)}.json"
+                        with open(os.path.join(output_dir, filename), 'w') as f:
+                            json.dump(document, f, indent=2)
+                        changed.append(filename)
+                        print(f"Saved {filename} ({len(changed) + len(unchanged)}/{max_pages})")
+                        if on_page:
+                            on_page(filename, True)
+
+                    cache.update(url, body_hash=body_hash, filename=filename, links=links,
+                                 etag=response_headers.get('ETag'),
+                                 last_modified=response_headers.get('Last-Modified'))
+
+                if depth < max_depth:
+                    for link in links:
+                        if link in seen or scheduled_pages >= max_pages:
+                            continue
+                        seen.add(link)
+                        scheduled_pages += 1
+                        queue.put_nowait((link, depth + 1))
+            except aiohttp.ClientResponseError as e:
+                # A gone start page says nothing about the pages below it
+                if e.status not in GONE_STATUSES or depth == 0:
+                    errors += 1
+                print(f"Error processing {url}: {e}")
+            except Exception as e:
+                errors += 1
+                print(f"Error processing {url}: {e}")
+            finally:
+                queue.task_done()
+
+    # One pooled session so connections are reused across requests
+    connector = aiohttp.TCPConnector(limit=concurrency, limit_per_host=concurrency)
+    client_timeout = aiohttp.ClientTimeout(total=timeout)
+    async with aiohttp.ClientSession(connector=connector, timeout=client_timeout) as session:
+        workers = [asyncio.create_task(worker(session)) for _ in range(concurrency)]
+        await queue.join()
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+    # A failed page may still exist, and pages past the limits were never requested,
+    # so only a complete crawl says which saved pages are gone
+    limits = {'max_depth': max_depth, 'max_pages': max_pages}
+    previous_limits = cache.limits(base_url) or limits
+    removed = []
+    if errors:
+        print(f"{errors} pages failed, keeping previously saved pages")
+    elif not changed and not unchanged:
+        print("No pages fetched past the start page, keeping previously saved pages")
+    elif scheduled_pages >= max_pages:
+        print(f"Reached the {max_pages} page cap, keeping previously saved pages")
+    elif any(limits[key] < previous_limits.get(key, limits[key]) for key in limits):
+        print("Limits are tighter than in earlier crawls, keeping previously saved pages")
+    else:
+        removed = remove_stale_pages(output_dir, changed + unchanged, cache)
+        previous_limits = limits
+
+    # Saved pages may come from any crawl since the last removal, so remember the widest limits
+    cache.set_limits(base_url, {key: max(limits[key], previous_limits.get(key, limits[key])) for key in limits})
+    cache.save()
+    return {'changed': changed, 'unchanged': unchanged, 'removed': removed}
+
+
+def scrape_documentation(base_url, output_dir, max_depth=DEFAULT_MAX_DEPTH, max_pages=DEFAULT_MAX_PAGES,
+                         concurrency=DEFAULT_CONCURRENCY, rate_limit=DEFAULT_RATE_LIMIT, use_cache=True,
+                         on_page=None):
+    """Scrape documentation from a payment API provider website.
+
+    Returns {'changed': [...], 'unchanged': [...], 'removed': [...]} lists of page filenames in output_dir.
+    """
+    # Create output directory if it doesn't exist
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    print(f"Scraping documentation from {base_url} (depth {max_depth}, up to {max_pages} pages)...")
+
+    start = time.time()
+    result = asyncio.run(crawl(base_url, output_dir, max_depth=max_depth, max_pages=max_pages,
+                               concurrency=concurrency, rate_limit=rate_limit, use_cache=use_cache,
+                               on_page=on_page))
+
+    print(f"Documentation scraping complete. {len(result['changed'])} pages changed, "
+          f"{len(result['unchanged'])} unchanged, {len(result['removed'])} removed in {output_dir} "
+          f"({time.time() - start:.1f}s)")
+    return result
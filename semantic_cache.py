@@ -0,0 +1,224 @@
+"""Semantic cache of LLM answers, keyed on the query embedding and the retrieved documentation"""
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from model_registry import DEFAULT_MODEL
+
+DEFAULT_THRESHOLD = 0.92     # cosine similarity above which a stored answer is reused
+DEFAULT_MAX_ENTRIES = 10000
+DEFAULT_TTL = 24 * 3600      # seconds
+
+
+def result_ids(results: Iterable[Dict]) -> List[str]:
+    """Stable ids of retrieved documentation chunks and code snippets"""
+    ids = []
+    for result in results:
+        if 'document_id' in result:
+            ids.append(f"{result.get('provider', '')}:{result['document_id']}#{result.get('chunk_id', '')}")
+        elif 'code' in result:
+            # Generated code snippets have no id; the template code identifies them
+            ids.append(f"code:{hashlib.sha1(result['code'].encode('utf-8')).hexdigest()}")
+    return sorted(ids)
+
+
+def cache_scope(provider: Optional[str], language: Optional[str], doc_ids: Iterable[str]) -> str:
+    """Answers are only reused between queries with the same provider, language and retrieved documents"""
+    key = json.dumps([provider or '', language or '', sorted(doc_ids)])
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+class MemoryBackend:
+    """Process-local entries with LRU eviction and a TTL"""
+
+    name = 'memory'
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, ttl=DEFAULT_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # entry id -> (scope, embedding, answer, expires_at)
+        self._scopes = {}              # scope -> entry ids
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self.evictions = 0
+        self.expirations = 0
+
+    def best_match(self, scope: str, embedding: np.ndarray) -> Optional[Tuple[str, float]]:
+        """(answer, similarity) of the most similar live entry in scope"""
+        with self._lock:
+            now = time.monotonic()
+            best = None
+            for entry_id in list(self._scopes.get(scope, ())):
+                _, stored, answer, expires_at = self._entries[entry_id]
+                if self.ttl and expires_at < now:
+                    self._remove(entry_id)
+                    self.expirations += 1
+                    continue
+                similarity = float(stored @ embedding)
+                if best is None or similarity > best[2]:
+                    best = (entry_id, answer, similarity)
+
+            if best is None:
+                return None
+            self._entries.move_to_end(best[0])
+            return best[1], best[2]
+
+    def put(self, scope: str, embedding: np.ndarray, answer: str):
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = (scope, embedding, answer, time.monotonic() + self.ttl if self.ttl else None)
+            self._scopes.setdefault(scope, set()).add(entry_id)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, entry_id):
+        scope = self._entries.pop(entry_id)[0]
+        ids = self._scopes[scope]
+        ids.discard(entry_id)
+        if not ids:
+            del self._scopes[scope]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._scopes.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SQLiteBackend:
+    """Entries in a SQLite file, shared by every worker on the host and kept across restarts"""
+
+    name = 'sqlite'
+
+    def __init__(self, path, max_entries=DEFAULT_MAX_ENTRIES, ttl=DEFAULT_TTL):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.evictions = 0
+        self.expirations = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=10, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS semantic_cache ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, scope TEXT NOT NULL, embedding BLOB NOT NULL, "
+            "answer TEXT NOT NULL, created_at REAL NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS semantic_cache_scope ON semantic_cache (scope)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS semantic_cache_last_used ON semantic_cache (last_used)")
+
+    def best_match(self, scope: str, embedding: np.ndarray) -> Optional[Tuple[str, float]]:
+        # Wall-clock time, since entries outlive the process
+        now = time.time()
+        min_created = now - self.ttl if self.ttl else 0
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, embedding, answer FROM semantic_cache WHERE scope = ? AND created_at >= ?",
+                (scope, min_created)
+            ).fetchall()
+            if not rows:
+                return None
+
+            stored = np.frombuffer(b''.join(row[1] for row in rows), dtype=np.float32).reshape(len(rows), -1)
+            similarities = stored @ embedding
+            best = int(np.argmax(similarities))
+            self._db.execute("UPDATE semantic_cache SET last_used = ? WHERE id = ?", (now, rows[best][0]))
+            return rows[best][2], float(similarities[best])
+
+    def put(self, scope: str, embedding: np.ndarray, answer: str):
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO semantic_cache (scope, embedding, answer, created_at, last_used) VALUES (?, ?, ?, ?, ?)",
+                (scope, np.asarray(embedding, dtype=np.float32).tobytes(), answer, now, now)
+            )
+            if self.ttl:
+                self.expirations += self._db.execute(
+                    "DELETE FROM semantic_cache WHERE created_at < ?", (now - self.ttl,)).rowcount
+            excess = len(self) - self.max_entries
+            if excess > 0:
+                self.evictions += self._db.execute(
+                    "DELETE FROM semantic_cache WHERE id IN "
+                    "(SELECT id FROM semantic_cache ORDER BY last_used LIMIT ?)", (excess,)).rowcount
+
+    def clear(self):
+        with self._lock:
+            self._db.execute("DELETE FROM semantic_cache")
+
+    def __len__(self):
+        return self._db.execute("SELECT COUNT(*) FROM semantic_cache").fetchone()[0]
+
+    def close(self):
+        self._db.close()
+
+
+BACKENDS = {'memory': MemoryBackend, 'sqlite': SQLiteBackend}
+
+
+class SemanticCache:
+    """Returns a stored LLM answer for a query close enough to one answered before.
+
+    A stored answer only matches a query with the same provider, language
+    and retrieved documents (its scope), and whose embedding has cosine
+    similarity of at least threshold with the stored query's. Embeddings
+    are the normalized query vectors from model_registry.encode_query, so
+    the one computed for search is reused.
+    """
+
+    def __init__(self, backend=None, threshold=DEFAULT_THRESHOLD, model_name=DEFAULT_MODEL):
+        self.backend = backend if backend is not None else MemoryBackend()
+        self.threshold = threshold
+        self.model_name = model_name
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.similarity_total = 0.0
+
+    def get(self, embedding: np.ndarray, provider: Optional[str], language: Optional[str],
+            doc_ids: Iterable[str]) -> Optional[str]:
+        """Cached answer for the query, or None on a miss"""
+        match = self.backend.best_match(cache_scope(provider, language, doc_ids), embedding)
+        with self._lock:
+            if match is None or match[1] < self.threshold:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.similarity_total += match[1]
+        return match[0]
+
+    def put(self, embedding: np.ndarray, provider: Optional[str], language: Optional[str],
+            doc_ids: Iterable[str], answer: str):
+        self.backend.put(cache_scope(provider, language, doc_ids), embedding, answer)
+        with self._lock:
+            self.stores += 1
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'backend': self.backend.name,
+            'size': len(self.backend),
+            'max_entries': self.backend.max_entries,
+            'threshold': self.threshold,
+            'hits': self.hits,
+            'misses': self.misses,
+            'stores': self.stores,
+            'evictions': self.backend.evictions,
+            'expirations': self.backend.expirations,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'mean_hit_similarity': self.similarity_total / self.hits if self.hits else None
+        }
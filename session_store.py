@@ -0,0 +1,177 @@
+"""Per-session conversation state with bounded history and idle eviction"""
+
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Dict, List, Optional
+
+DEFAULT_MAX_TURNS = 20          # messages kept per session, user and assistant
+DEFAULT_IDLE_TIMEOUT = 3600     # seconds without a request before a session is dropped
+DEFAULT_MAX_SESSIONS = 10000    # sessions held in memory
+DEFAULT_SESSION = 'default'     # used by callers that do not pass a session id
+PRUNE_EVERY = 1000              # saves between deletions of idle rows from the database
+
+
+class ConversationSession:
+    """One user's recent turns, plus the provider, language and task they last mentioned.
+
+    The facts are updated as user turns are added, so checking them does
+    not rescan the history.
+    """
+
+    def __init__(self, session_id: str, max_turns: int = DEFAULT_MAX_TURNS, persist: bool = True):
+        self.session_id = session_id
+        self.persist = persist  # False for throwaway sessions, such as one query of a batch
+        self.turns = deque(maxlen=max_turns)
+        self.last_provider = None
+        self.last_language = None
+        self.last_intent = None
+        self.last_active = time.time()
+
+    def add_turn(self, role: str, content: str, intent_data: Optional[Dict] = None):
+        self.turns.append({"role": role, "content": content})
+        if intent_data:
+            self.last_provider = intent_data.get('payment_provider') or self.last_provider
+            self.last_language = intent_data.get('programming_language') or self.last_language
+            intents = [intent for intent in intent_data.get('matched_intents', []) if intent != 'language_preference']
+            self.last_intent = intents[0] if intents else self.last_intent
+        self.last_active = time.time()
+
+    def recent(self, n: int) -> List[Dict]:
+        """The last n turns, oldest first"""
+        return list(self.turns)[-n:]
+
+    def to_dict(self) -> Dict:
+        return {
+            "turns": list(self.turns),
+            "last_provider": self.last_provider,
+            "last_language": self.last_language,
+            "last_intent": self.last_intent,
+            "last_active": self.last_active
+        }
+
+    @classmethod
+    def from_dict(cls, session_id: str, data: Dict, max_turns: int = DEFAULT_MAX_TURNS):
+        session = cls(session_id, max_turns)
+        session.turns.extend(data.get("turns", []))
+        session.last_provider = data.get("last_provider")
+        session.last_language = data.get("last_language")
+        session.last_intent = data.get("last_intent")
+        session.last_active = data.get("last_active", session.last_active)
+        return session
+
+
+class SessionStore:
+    """ConversationSessions by session id, least recently active evicted first.
+
+    Sessions idle for longer than idle_timeout, and the least recently
+    active ones beyond max_sessions, are dropped from memory. With path,
+    sessions are also written to a SQLite file on every turn, so they
+    survive restarts and are shared by the workers on a host; rows idle
+    past the timeout are deleted from it as well.
+    """
+
+    def __init__(self, max_turns=DEFAULT_MAX_TURNS, idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 max_sessions=DEFAULT_MAX_SESSIONS, path=None):
+        self.max_turns = max_turns
+        self.idle_timeout = idle_timeout
+        self.max_sessions = max_sessions
+        self.path = path
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self.evictions = 0
+        self._saves = 0
+
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, timeout=10, check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS sessions ("
+                             "session_id TEXT PRIMARY KEY, state TEXT NOT NULL, last_active REAL NOT NULL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS sessions_last_active ON sessions (last_active)")
+
+    def get(self, session_id: Optional[str] = None) -> ConversationSession:
+        """The session for session_id, created if it is new or was evicted"""
+        session_id = session_id or DEFAULT_SESSION
+        with self._lock:
+            self._evict(time.time())
+            session = self._sessions.get(session_id)
+            # Another worker may have served this session since, so the database copy wins if newer.
+            # Only its timestamp is read here; the state is fetched and decoded when it is newer.
+            state = self._newer_state(session_id, session.last_active if session else None)
+            if state is None:
+                return self._touch(session_id, session)
+
+        stored = ConversationSession.from_dict(session_id, json.loads(state), self.max_turns)
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None or stored.last_active > session.last_active:
+                session = stored
+            return self._touch(session_id, session)
+
+    def _touch(self, session_id, session):
+        if session is None:
+            session = ConversationSession(session_id, self.max_turns)
+        self._sessions[session_id] = session
+        self._sessions.move_to_end(session_id)
+        return session
+
+    def save(self, session: ConversationSession):
+        """Persist session, if the store has a database"""
+        if self._db is None or not session.persist:
+            return
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO sessions (session_id, state, last_active) VALUES (?, ?, ?)",
+                             (session.session_id, json.dumps(session.to_dict()), session.last_active))
+            self._saves += 1
+            if self._saves % PRUNE_EVERY == 0:
+                self._db.execute("DELETE FROM sessions WHERE last_active < ?", (time.time() - self.idle_timeout,))
+
+    def _newer_state(self, session_id, last_active):
+        """The stored JSON state of session_id if it is newer than last_active, otherwise None"""
+        if self._db is None:
+            return None
+        row = self._db.execute("SELECT last_active FROM sessions WHERE session_id = ? AND last_active >= ?",
+                               (session_id, time.time() - self.idle_timeout)).fetchone()
+        if row is None or (last_active is not None and row[0] <= last_active):
+            return None
+        row = self._db.execute("SELECT state FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+        return row[0] if row else None
+
+    def _evict(self, now):
+        # Sessions are ordered by last access, so only the oldest need checking
+        while self._sessions:
+            session_id, session = next(iter(self._sessions.items()))
+            if len(self._sessions) <= self.max_sessions and now - session.last_active <= self.idle_timeout:
+                break
+            del self._sessions[session_id]
+            self.evictions += 1
+
+    def evict_idle(self) -> int:
+        """Drop idle sessions now, from memory and the database; returns how many were dropped from memory"""
+        now = time.time()
+        with self._lock:
+            evictions = self.evictions
+            self._evict(now)
+            if self._db is not None:
+                self._db.execute("DELETE FROM sessions WHERE last_active < ?", (now - self.idle_timeout,))
+            return self.evictions - evictions
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def stats(self):
+        return {
+            'active_sessions': len(self._sessions),
+            'max_sessions': self.max_sessions,
+            'max_turns': self.max_turns,
+            'idle_timeout': self.idle_timeout,
+            'evictions': self.evictions,
+            'persistent': self._db is not None
+        }
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
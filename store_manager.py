@@ -0,0 +1,109 @@
+"""Serves the live VectorStore per provider and swaps in new snapshots without a restart"""
+
+import os
+import threading
+import time
+from collections.abc import Mapping
+
+from vector_store import VectorStore, CURRENT_FILE, LEGACY_FILE
+
+DEFAULT_POLL_INTERVAL = 30  # seconds
+
+
+def store_signature(path):
+    """What identifies the on-disk state of a store: its CURRENT snapshot, or the legacy file's mtime"""
+    store_dir = path if os.path.isdir(path) else os.path.dirname(path)
+    current_file = os.path.join(store_dir, CURRENT_FILE)
+    if os.path.exists(current_file):
+        with open(current_file, 'r') as f:
+            return f.read().strip()
+
+    legacy_file = os.path.join(path, LEGACY_FILE) if os.path.isdir(path) else path
+    return os.path.getmtime(legacy_file) if os.path.exists(legacy_file) else None
+
+
+class StoreManager(Mapping):
+    """Read-only mapping of provider name to its current VectorStore.
+
+    A background thread polls each store directory and, when populate_kb.py
+    publishes a new snapshot, loads it off the request path and replaces
+    the mapping entry in one assignment. A search holds its own reference
+    to the store it started on, so it finishes on the old snapshot; the old
+    store (and its memory maps) is freed once the last such search returns.
+    """
+
+    def __init__(self, paths, store_options=None, poll_interval=DEFAULT_POLL_INTERVAL):
+        self.paths = dict(paths)
+        self.store_options = store_options or {}
+        self.poll_interval = poll_interval
+        self.swaps = 0
+
+        self._stores = {}
+        self._signatures = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+        for provider, path in self.paths.items():
+            self._signatures[provider] = store_signature(path)
+            self._stores[provider] = VectorStore(path, **self.store_options)
+
+    def __getitem__(self, provider):
+        return self._stores[provider]
+
+    def __iter__(self):
+        return iter(self._stores)
+
+    def __len__(self):
+        return len(self._stores)
+
+    def check(self):
+        """Load and swap in every store whose snapshot changed; returns the providers swapped"""
+        swapped = []
+        with self._lock:
+            for provider, path in self.paths.items():
+                signature = store_signature(path)
+                if signature == self._signatures.get(provider):
+                    continue
+
+                try:
+                    start = time.time()
+                    store = VectorStore(path, **self.store_options)
+                except Exception as e:
+                    # A snapshot pruned or half-written mid-load; retry on the next poll
+                    print(f"Error loading new {provider} store: {e}")
+                    continue
+
+                # Copy on write, so a request iterating the old mapping is never disturbed
+                stores = dict(self._stores)
+                stores[provider] = store
+                self._stores = stores
+                self._signatures[provider] = signature
+                self.swaps += 1
+                swapped.append(provider)
+                print(f"Swapped in {provider} store version {store.manifest.get('version')} "
+                      f"({len(store.documents)} chunks, loaded in {time.time() - start:.1f}s)")
+        return swapped
+
+    def start(self):
+        """Start polling for new snapshots in a daemon thread"""
+        if self._thread is None and self.poll_interval:
+            self._thread = threading.Thread(target=self._watch, name="store-watcher", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _watch(self):
+        while not self._stop.wait(self.poll_interval):
+            try:
+                self.check()
+            except Exception as e:
+                print(f"Error checking for new store snapshots: {e}")
+
+    def versions(self):
+        return {provider: store.manifest.get('version') for provider, store in self._stores.items()}
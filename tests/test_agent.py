@@ -4,14 +4,28 @@ import os
 import tempfile
 import sys
 import shutil
+import asyncio
+import threading
+from unittest import mock
+import numpy as np
 
 # Add parent directory to path so we can import modules
-sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(PROJECT_DIR)
 
 from intent_recognizer import IntentRecognizer
-from vector_store import VectorStore
+import vector_store
+from vector_store import VectorStore, write_store, federated_search, CATEGORY_BOOST
+from embedder import document_records, create_embeddings, previous_build_settings
+from model_registry import get_model
 from code_generator import CodeGenerator
 from payment_api_agent import PaymentAPIAgent
+from query_cache import LRUCache
+from quantization import ScalarQuantizer, ProductQuantizer, INT8_FILE, PQ_FILE
+from ann_index import IVFIndex, INDEX_FILE, sample_queries, recall_at_k
+from store_manager import StoreManager
+from session_store import SessionStore, ConversationSession
+from intent_classifier import SemanticIntentClassifier
 
 class TestPaymentAPIAgent(unittest.TestCase):
     def setUp(self):
@@ -96,6 +110,37 @@ class TestPaymentAPIAgent(unittest.TestCase):
         self.assertEqual('stripe', result['payment_provider'])
         self.assertEqual('javascript', result['programming_language'])
 
+    def test_intent_recognizer_regex_fallback(self):
+        """Test that patterns the keyword automaton cannot hold are still matched, in declaration order"""
+        recognizer = IntentRecognizer()
+        recognizer.intents['payment_processing'].append(r'pay\w+ intent')
+        recognizer.compile()
+
+        result = recognizer.recognize("Got an error creating a Payment Intent in Node")
+        self.assertEqual(['payment_processing', 'error_handling', 'language_preference'], result['matched_intents'])
+        self.assertEqual('javascript', result['programming_language'])
+        self.assertIsNone(result['payment_provider'])
+
+    def test_semantic_intents(self):
+        """Test classifying a paraphrase, asking about an unclear query and continuing a session's task"""
+        classifier = SemanticIntentClassifier({
+            'refund': ["give a customer their money back"],
+            'subscription': ["bill customers every month"]
+        }, min_confidence=0.4)
+        agent = PaymentAPIAgent(self.intent_recognizer, self.vector_stores, self.code_generator,
+                                intent_classifier=classifier)
+
+        response = agent.process_query("Hello there, I use Stripe", session_id="s")
+        self.assertEqual("intent", response["missing_info"])
+
+        response = agent.process_query("Give my customer their money back with Stripe in Python", session_id="s")
+        self.assertEqual(['refund', 'language_preference'], response["intent_data"]["matched_intents"])
+        self.assertEqual('semantic', response["intent_data"]["intent_source"])
+
+        response = agent.process_query("What about in Ruby?", session_id="s")
+        self.assertEqual('session', response["intent_data"]["intent_source"])
+        self.assertIn('refund', response["intent_data"]["matched_intents"])
+
     def test_code_generation(self):
         """Test code generation module"""
         code = self.code_generator.generate_code(
@@ -107,6 +152,268 @@ class TestPaymentAPIAgent(unittest.TestCase):
         self.assertIn("stripe.paymentIntents.create", code['code'])
         self.assertEqual("javascript", code['language'])
 
+    def test_template_index(self):
+        """Test wildcard templates, lazily loaded provider files and placeholder substitution"""
+        os.makedirs(os.path.join(self.templates_dir, "templates"))
+        with open(os.path.join(self.templates_dir, "templates", "paypal.json"), "w") as f:
+            json.dump({
+                "paypal_refund_python": {
+                    "code": "refund = Refund({'amount': {amount}})\nprint(f\"{e}\")",
+                    "explanation": "PayPal refund", "requires": []
+                },
+                "paypal_*_ruby": {"code": "require 'paypal-sdk-rest'", "explanation": "Any PayPal task", "requires": []}
+            }, f)
+        generator = CodeGenerator(self.templates_dir)
+        self.assertNotIn("paypal", generator.loaded_providers)
+
+        code = generator.generate_code("refund", "paypal", "python", {"amount": 500})
+        self.assertEqual("refund = Refund({'amount': 500})\nprint(f\"{e}\")", code["code"])
+        self.assertIn("paypal", generator.loaded_providers)
+
+        code = generator.generate_code("subscription", "paypal", "ruby")
+        self.assertEqual(("Any PayPal task", "ruby"), (code["explanation"], code["language"]))
+
+        # No PayPal template for the intent or language: falls back to the Stripe JavaScript example
+        code = generator.generate_code("subscription", "paypal", "php")
+        self.assertEqual("javascript", code["language"])
+        self.assertIn("fallback", code["explanation"])
+
+    def test_resolve_memo_survives_concurrent_template_loads(self):
+        """Test that a match resolved while another thread adds templates is not memoized over them"""
+        generator = CodeGenerator(self.templates_dir)
+        added = {"stripe_refund_python": {"code": "stripe.Refund.create()", "explanation": "Stripe refund",
+                                          "requires": []}}
+        loader = threading.Thread(target=generator.add_templates, args=(added,))
+
+        class LoadingIndex(dict):
+            def get(self, key, default=None):
+                # Another request adds templates between this resolve's lookups and its memo write
+                value = super().get(key, default)
+                if loader.ident is None:
+                    loader.start()
+                    loader.join(timeout=0.2)
+                return value
+
+        generator.index = LoadingIndex(generator.index)
+        first = generator.resolve("refund", "stripe", "python")
+        loader.join()
+        self.assertTrue(first[2])
+
+        template, language, is_fallback = generator.resolve("refund", "stripe", "python")
+        self.assertEqual(("Stripe refund", "python", False), (template.explanation, language, is_fallback))
+
+    def test_provider_templates_load_lazily(self):
+        """Test that a Stripe lookup in the shipped templates reads stripe.json and not paypal.json"""
+        generator = CodeGenerator(os.path.join(PROJECT_DIR, "code_examples"))
+        self.assertEqual({"paypal", "stripe"}, set(generator.provider_files))
+        self.assertEqual(set(), generator.loaded_providers)
+
+        code = generator.generate_code("payment_processing", "stripe", "python")
+        self.assertIn("stripe.PaymentIntent.create", code["code"])
+        self.assertEqual({"stripe"}, generator.loaded_providers)
+
+        code = generator.generate_code("payment_processing", "paypal", "python")
+        self.assertIn("/v2/checkout/orders", code["code"])
+        self.assertEqual({"paypal", "stripe"}, generator.loaded_providers)
+
+    def test_vector_search(self):
+        """Test that search returns ranked result dicts without raw vectors"""
+        results = self.vector_stores['stripe'].search("process a payment", top_k=2)
+
+        self.assertEqual(2, len(results))
+        for result in results:
+            self.assertNotIn("embedding", result)
+            self.assertIn("relevance_score", result)
+        self.assertGreaterEqual(results[0]["relevance_score"], results[1]["relevance_score"])
+
+    def test_binary_store_format(self):
+        """Test that the memory-mapped store format is preferred over legacy JSON"""
+        legacy_store = self.vector_stores['paypal']
+        store_dir = os.path.join(self.test_dir, "paypal")
+        write_store(store_dir, legacy_store.documents, [[1.0] + [0.0] * 383, [0.0, 1.0] + [0.0] * 382])
+
+        store = VectorStore(os.path.join(store_dir, "embeddings.json"))
+
+        self.assertEqual((2, 384), store.embeddings.shape)
+        self.assertEqual("float32", str(store.embeddings.dtype))
+        self.assertEqual(legacy_store.documents, store.documents)
+
+    def test_search_result_cache(self):
+        """Test that repeated searches hit the cache and a reload invalidates it"""
+        store = self.vector_stores['stripe']
+        first = store.search("Process a  payment", top_k=1)
+        first[0]['provider'] = 'stripe'
+        second = store.search("process a payment", top_k=1)
+
+        self.assertNotIn('provider', second[0])
+        self.assertEqual(1, store.cache_stats()['hits'])
+
+        store.reload()
+        store.search("process a payment", top_k=1)
+        self.assertEqual(1, store.cache_stats()['hits'])
+
+    def test_federated_search(self):
+        """Test that results from every store are merged into one ranked, tagged top-k"""
+        results = federated_search(self.vector_stores, "authenticate with PayPal", top_k=3, parallel=True)
+
+        self.assertEqual(3, len(results))
+        self.assertEqual({'paypal', 'stripe'}, {result['provider'] for result in results})
+        scores = [result['relevance_score'] for result in results]
+        self.assertEqual(sorted(scores, reverse=True), scores)
+
+    def test_federated_search_reuses_pool(self):
+        """Test that parallel federated search matches serial search and does not start threads per query"""
+        serial = federated_search(self.vector_stores, "authenticate with PayPal", top_k=3)
+        with mock.patch.object(vector_store, 'SEARCH_THREADS', 2), \
+                mock.patch.object(vector_store, 'PARALLEL_MIN_SCORES', 0):
+            self.assertEqual(serial, federated_search(self.vector_stores, "authenticate with PayPal", top_k=3,
+                                                      parallel=True))
+            threads = threading.active_count()
+            for _ in range(5):
+                federated_search(self.vector_stores, "process a payment", top_k=3, parallel=True)
+            self.assertEqual(threads, threading.active_count())
+
+    def test_filtered_search(self):
+        """Test that categories rank matching chunks first and unknown filters fall back to all rows"""
+        store = self.vector_stores['paypal']
+        results = store.search("payment", top_k=2, categories=['authentication'])
+        self.assertEqual(['doc2', 'doc1'], [result['document_id'] for result in results])
+
+        results = store.search("payment", top_k=2, categories=['webhook'], language='python')
+        self.assertEqual(2, len(results))
+
+    def test_categories_do_not_exclude_chunks(self):
+        """Test category preference on chunks labelled by the embedder, where most labels are not the query's intent"""
+        records = [record for doc in json.load(open(os.path.join(PROJECT_DIR, "structured_knowledge", "paypal.json")))
+                   for record in document_records(doc)]
+        store_dir = os.path.join(self.test_dir, "labelled")
+        write_store(store_dir, records, get_model().encode([record['text'] for record in records]))
+        store = VectorStore(store_dir)
+        self.assertEqual(1, len(store.category_rows['authentication']))
+
+        plain = {(r['document_id'], r['chunk_id']): r['relevance_score'] for r in store.search("authenticate", top_k=3)}
+        results = store.search("authenticate", top_k=3, categories=['authentication'])
+
+        self.assertEqual(3, len(results))
+        for result in results:
+            boost = CATEGORY_BOOST if result['category'] == 'authentication' else 0.0
+            self.assertAlmostEqual(plain[(result['document_id'], result['chunk_id'])] + boost,
+                                   result['relevance_score'], places=5)
+        scores = [result['relevance_score'] for result in results]
+        self.assertEqual(sorted(scores, reverse=True), scores)
+
+        queries, categories = ["authenticate", "add package tracking"], [['authentication'], ['refund']]
+        batched = store.search_batch(queries, top_k=3, filters=[(c, None) for c in categories])
+        self.assertEqual([store.search(q, top_k=3, categories=c) for q, c in zip(queries, categories)], batched)
+
+    def test_hybrid_search(self):
+        """Test that BM25 ranks chunks containing an exact identifier first in hybrid mode"""
+        store = VectorStore(os.path.join(self.test_dir, "stripe", "embeddings.json"), search_mode='hybrid')
+        results = store.search("PaymentIntent", top_k=2)
+
+        self.assertEqual('doc1', results[0]['document_id'])
+        self.assertGreater(results[0]['relevance_score'], results[1]['relevance_score'])
+
+    def test_quantized_search(self):
+        """Test that int8 codes saved with the store give the same ranking as the float vectors"""
+        store_dir = os.path.join(self.test_dir, "paypal")
+        documents = self.vector_stores['paypal'].documents
+        vectors = np.array([[1.0, 0.2] + [0.0] * 382, [0.1, 1.0] + [0.0] * 382], dtype=np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        write_store(store_dir, documents, vectors, artifacts={INT8_FILE: ScalarQuantizer.build(vectors)})
+
+        for rerank_factor in (0, 4):
+            store = VectorStore(store_dir, quantization='int8', rerank_factor=rerank_factor)
+            self.assertEqual(1, store.quantizer.codes.itemsize)
+            # Memory-mapped like the float matrix, so workers share the codes
+            self.assertIsInstance(store.quantizer.codes, np.memmap)
+            results = store.search_vector(vectors[1], top_k=2)
+            self.assertEqual(['doc2', 'doc1'], [result['document_id'] for result in results])
+
+    def test_ivf_and_quantized_recall(self):
+        """Test IVF recall at the default n_probe, and that re-ranked int8 and PQ results are in exact order"""
+        rng = np.random.default_rng(0)
+        centers = rng.normal(size=(40, 64))
+        matrix = centers[rng.integers(0, 40, 2000)] + rng.normal(0, 0.3, (2000, 64))
+        matrix = (matrix / np.linalg.norm(matrix, axis=1, keepdims=True)).astype(np.float32)
+        records = [{'document_id': f"doc{i}", 'chunk_id': 0, 'text': f"chunk {i}", 'category': 'general'}
+                   for i in range(len(matrix))]
+        index = IVFIndex.build(matrix)
+        store_dir = os.path.join(self.test_dir, "synthetic")
+        write_store(store_dir, records, matrix, artifacts={INDEX_FILE: index,
+                                                           INT8_FILE: ScalarQuantizer.build(matrix),
+                                                           PQ_FILE: ProductQuantizer.build(matrix, n_subvectors=16)})
+        queries = sample_queries(matrix, n_queries=50, seed=1)
+
+        # Every row is in exactly one list, and probing every list is exact search
+        self.assertEqual(list(range(len(matrix))), sorted(index.rows.tolist()))
+        self.assertEqual(len(matrix), len(index.candidates(queries[0], n_probe=index.n_lists)))
+
+        store = VectorStore(store_dir, index_type='ivf')
+        self.assertLess(len(index.candidates(queries[0], store.n_probe)), len(matrix))
+        recall, _ = recall_at_k(store.embeddings, queries, lambda q, k: [row for row, _ in store.rank_vector(q, k)])
+        self.assertGreaterEqual(recall, 0.9)
+
+        for quantization in ('int8', 'pq'):
+            store = VectorStore(store_dir, quantization=quantization)
+            recall, _ = recall_at_k(store.embeddings, queries,
+                                    lambda q, k: [row for row, _ in store.rank_vector(q, k)])
+            self.assertGreaterEqual(recall, 0.9)
+            for query in queries:
+                rows, scores = zip(*store.rank_vector(query, 10))
+                exact = store.embeddings[list(rows)] @ query
+                np.testing.assert_allclose(exact, scores, rtol=1e-5, atol=1e-6)
+                self.assertEqual(sorted(exact.tolist(), reverse=True), exact.tolist())
+                if quantization == 'int8':
+                    self.assertEqual(np.argsort(-(store.embeddings @ query))[:10].tolist(), list(rows))
+
+    def test_rebuild_keeps_search_artifacts(self):
+        """Test that a rebuild without index or quantization options keeps the previous build's"""
+        structured_file = os.path.join(PROJECT_DIR, "structured_knowledge", "paypal.json")
+        store_dir = os.path.join(self.test_dir, "rebuilt")
+        create_embeddings(structured_file, store_dir, ann_index=True, quantization='int8')
+        self.assertEqual({'ann_index': True, 'quantization': 'int8'},
+                         {key: previous_build_settings(store_dir)[key] for key in ('ann_index', 'quantization')})
+
+        create_embeddings(structured_file, store_dir, incremental=True)
+        self.assertEqual({'ann_index': True, 'quantization': 'int8'},
+                         {key: previous_build_settings(store_dir)[key] for key in ('ann_index', 'quantization')})
+        store = VectorStore(store_dir, index_type='ivf', quantization='int8')
+        self.assertIsNotNone(store.index)
+        self.assertIsNotNone(store.quantizer)
+
+        create_embeddings(structured_file, store_dir, incremental=True, ann_index=False, quantization='none')
+        self.assertEqual({'ann_index': False, 'quantization': None},
+                         {key: previous_build_settings(store_dir)[key] for key in ('ann_index', 'quantization')})
+
+    def test_store_manager_swaps_snapshot(self):
+        """Test that a newly published snapshot is swapped in while the old store stays usable"""
+        store_dir = os.path.join(self.test_dir, "stripe")
+        documents = self.vector_stores['stripe'].documents
+        write_store(store_dir, documents, [[1.0] + [0.0] * 383, [0.0, 1.0] + [0.0] * 382])
+        manager = StoreManager({'stripe': store_dir}, poll_interval=0)
+        old_store = manager['stripe']
+        self.assertEqual([], manager.check())
+
+        write_store(store_dir, documents[:1], [[1.0] + [0.0] * 383])
+        self.assertEqual(['stripe'], manager.check())
+
+        self.assertIsNot(old_store, manager['stripe'])
+        self.assertEqual(1, len(manager['stripe'].documents))
+        self.assertEqual(2, len(old_store.search_vector(old_store.embeddings[0], top_k=2)))
+
+    def test_lru_cache_eviction(self):
+        """Test LRU eviction order and counters"""
+        cache = LRUCache(max_entries=2, ttl=60)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(1, cache.get('a'))
+        self.assertEqual(1, cache.stats()['evictions'])
+
     def test_query_processing(self):
         """Test full query processing"""
         query = "How do I authenticate with PayPal using Python?"
@@ -116,6 +423,38 @@ class TestPaymentAPIAgent(unittest.TestCase):
         self.assertIn("message", response)
         self.assertIn("PayPal", response["message"])
 
+    def test_async_query_processing(self):
+        """Test that the async path gives the same response as process_query"""
+        query = "How do I authenticate with PayPal using Python?"
+        response = asyncio.run(self.agent.aprocess_query(query))
+
+        self.assertEqual(self.agent.process_query(query)["message"], response["message"])
+
+    def test_stream_query(self):
+        """Test that streaming sends the documentation first and ends with the full response"""
+        events = list(self.agent.stream_query("How do I authenticate with PayPal using Python?"))
+
+        self.assertEqual(["documentation", "token", "done"], [event for event, _ in events])
+        self.assertIn("documentation", events[0][1])
+        self.assertEqual(events[-1][1]["message"], "".join(data["text"] for event, data in events if event == "token"))
+
+    def test_batch_processing(self):
+        """Test that a batch gives each query the response it gets alone, and batched search matches search"""
+        queries = ["How do I authenticate with PayPal using Python?", "How do I process a payment?",
+                   "How do I process a payment with Stripe in JavaScript?"]
+        responses = self.agent.process_batch(queries)
+
+        self.assertEqual(len(queries), len(responses))
+        self.assertEqual(0, len(self.agent.sessions))
+        for i, (query, response) in enumerate(zip(queries, responses)):
+            self.assertEqual(self.agent.process_query(query, session_id=f"alone-{i}"), response)
+        self.assertEqual("payment_provider", responses[1]["missing_info"])
+
+        store = VectorStore(os.path.join(self.test_dir, "stripe", "embeddings.json"))
+        batched = store.search_batch(["process a payment", "authenticate"], top_k=2)
+        self.assertEqual([store.search("process a payment", top_k=2), store.search("authenticate", top_k=2)],
+                         batched)
+
     def test_missing_provider(self):
         """Test handling of missing provider information"""
         query = "How do I process a payment?"
@@ -124,6 +463,60 @@ class TestPaymentAPIAgent(unittest.TestCase):
         self.assertIn("missing_info", response)
         self.assertEqual("payment_provider", response["missing_info"])
 
+    def test_sessions_are_isolated(self):
+        """Test that each session remembers its own provider and history"""
+        self.agent.process_query("I'm using Stripe with Python", session_id="a")
+        response = self.agent.process_query("How do I process a payment?", session_id="b")
+
+        self.assertEqual("payment_provider", response["missing_info"])
+        self.assertEqual("stripe", self.agent.sessions.get("a").last_provider)
+        self.assertEqual(1, len(self.agent.sessions.get("b").turns))
+        self.assertNotIn("missing_info", self.agent.process_query("How do I process a payment?", session_id="a"))
+
+    def test_session_store_bounds_and_persistence(self):
+        """Test the turn limit, idle eviction and reloading sessions from SQLite"""
+        path = os.path.join(self.test_dir, "sessions.sqlite3")
+        store = SessionStore(max_turns=4, idle_timeout=60, path=path)
+        session = store.get("a")
+        for i in range(6):
+            session.add_turn("user", f"message {i}", {"payment_provider": "paypal", "programming_language": None})
+        store.save(session)
+
+        self.assertEqual(["message 2", "message 3", "message 4", "message 5"], [t["content"] for t in session.turns])
+
+        reopened = SessionStore(max_turns=4, idle_timeout=60, path=path).get("a")
+        self.assertEqual("paypal", reopened.last_provider)
+        self.assertEqual(list(session.turns), list(reopened.turns))
+
+        store.idle_timeout = 0
+        session.last_active -= 1
+        self.assertEqual(1, store.evict_idle())
+        self.assertEqual(0, len(SessionStore(path=path).get("a").turns))
+
+    def test_session_store_decodes_only_newer_copies(self):
+        """Test that a worker reloads a session from SQLite only after another worker saved a newer one"""
+        path = os.path.join(self.test_dir, "sessions.sqlite3")
+        first, second = SessionStore(path=path), SessionStore(path=path)
+        session = first.get("a")
+        session.add_turn("user", "hello", {"payment_provider": "stripe", "programming_language": None})
+        first.save(session)
+
+        with mock.patch("session_store.ConversationSession.from_dict",
+                        wraps=ConversationSession.from_dict) as from_dict:
+            self.assertIs(session, first.get("a"))
+            self.assertEqual(0, from_dict.call_count)
+
+            other = second.get("a")
+            self.assertEqual(1, from_dict.call_count)
+            other.add_turn("user", "in python", {"payment_provider": None, "programming_language": "python"})
+            second.save(other)
+
+            reloaded = first.get("a")
+            self.assertEqual(2, from_dict.call_count)
+            self.assertEqual("python", reloaded.last_language)
+            self.assertIs(reloaded, first.get("a"))
+            self.assertEqual(2, from_dict.call_count)
+
     def test_conversation_history(self):
         """Test that conversation history is maintained"""
         # First query
@@ -0,0 +1,175 @@
+import unittest
+import hashlib
+import inspect
+import json
+import os
+import tempfile
+import shutil
+import sys
+from unittest import mock
+import numpy as np
+
+# Add parent directory to path so we can import modules
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import embedder
+from embedder import (create_embeddings, document_records, previous_build_settings, iter_structured_docs,
+                      index_structured_docs, content_hash, CHUNK_SIZE)
+from vector_store import read_store
+
+
+def stub_vector(text, dimension=16):
+    """Deterministic vector for a text, the same in every build"""
+    seed = int(hashlib.sha1(text.encode('utf-8')).hexdigest()[:8], 16)
+    return np.random.default_rng(seed).normal(size=dimension).astype(np.float32)
+
+
+class StubModel:
+    """Stands in for the sentence-transformers model and records every text it encodes"""
+
+    def __init__(self, dimension=16):
+        self.dimension = dimension
+        self.encoded = []
+
+    def get_sentence_embedding_dimension(self):
+        return self.dimension
+
+    def encode(self, texts, batch_size=32, **kwargs):
+        self.encoded.extend(texts)
+        return np.stack([stub_vector(text, self.dimension) for text in texts])
+
+
+def structured_doc(name, chunks, code_examples=()):
+    return {
+        'title': name.capitalize(),
+        'url': f"https://docs.example.com/{name}",
+        'chunks': list(chunks),
+        'code_examples': [{'code': code, 'language': 'python'} for code in code_examples],
+        'category': 'general',
+        'source_file': f"{name}.json"
+    }
+
+
+class TestEmbedder(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.structured_file = os.path.join(self.test_dir, "docs.jsonl")
+        self.store_dir = os.path.join(self.test_dir, "store")
+        self.model = StubModel()
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def write_docs(self, docs):
+        with open(self.structured_file, 'w') as f:
+            for doc in docs:
+                f.write(json.dumps(doc) + '\n')
+
+    def build(self, **kwargs):
+        self.model.encoded = []
+        with mock.patch('embedder.get_model', return_value=self.model):
+            count = create_embeddings(self.structured_file, self.store_dir, **kwargs)
+        documents, embeddings, _ = read_store(self.store_dir)
+        self.assertEqual(count, len(documents))
+        return documents, np.array(embeddings)
+
+    def test_structured_docs_stream_from_jsonl(self):
+        """Test offsets, lazy in-order iteration and the records built from a JSON Lines file"""
+        docs = [structured_doc('payments', ["Create a payment."], code_examples=["stripe.PaymentIntent.create()"]),
+                structured_doc('refunds', ["Refund a charge.", "Refunds take 5 days."]),
+                structured_doc('payouts', ["Send a payout."])]
+        with open(self.structured_file, 'w') as f:
+            f.write(json.dumps(docs[0]) + '\n\n')
+            for doc in docs[1:]:
+                f.write(json.dumps(doc) + '\n')
+
+        offsets = index_structured_docs(self.structured_file)
+        self.assertEqual({'payments.json', 'refunds.json', 'payouts.json'}, set(offsets))
+        with open(self.structured_file, 'r') as f:
+            for doc in docs:
+                f.seek(offsets[doc['source_file']])
+                self.assertEqual(doc, json.loads(f.readline()))
+
+        stream = iter_structured_docs(self.structured_file)
+        self.assertTrue(inspect.isgenerator(stream))
+        self.assertEqual(docs[0], next(stream))
+        self.assertEqual(docs[1:], list(stream))
+
+        records = [record for doc in iter_structured_docs(self.structured_file) for record in document_records(doc)]
+        self.assertEqual([(docs[0]['url'], 0), (docs[0]['url'], 'code_0'), (docs[1]['url'], 0), (docs[1]['url'], 1),
+                          (docs[2]['url'], 0)], [(r['document_id'], r['chunk_id']) for r in records])
+        self.assertEqual("Code example (python): stripe.PaymentIntent.create()", records[1]['text'])
+        self.assertEqual('python', records[1]['language'])
+        self.assertEqual([content_hash(r['text']) for r in records], [r['content_hash'] for r in records])
+
+        # Legacy .json files holding one list still load, but have no offsets to reuse
+        legacy_file = os.path.join(self.test_dir, "docs.json")
+        with open(legacy_file, 'w') as f:
+            json.dump(docs, f)
+        self.assertEqual(docs, list(iter_structured_docs(legacy_file)))
+        self.assertEqual({}, index_structured_docs(legacy_file))
+
+    def test_batches_keep_vectors_aligned_with_records(self):
+        """Test that with a batch size that does not divide the record count, row i holds record i's vector"""
+        docs = [structured_doc('payments', ["Create a payment.", "Capture it later.", "Cancel it."],
+                               code_examples=["stripe.PaymentIntent.create()"]),
+                structured_doc('refunds', ["Refund a charge.", "Create a payment."]),
+                structured_doc('payouts', ["Send a payout."], code_examples=["stripe.Payout.create()"])]
+        self.write_docs(docs)
+        records = [record for doc in docs for record in document_records(doc)]
+        self.assertEqual(8, len(records))
+
+        documents, embeddings = self.build(batch_size=3)
+
+        self.assertEqual([(r['document_id'], r['chunk_id'], r['text']) for r in records],
+                         [(d['document_id'], d['chunk_id'], d['text']) for d in documents])
+        for row, record in enumerate(records):
+            expected = stub_vector(record['text'])
+            np.testing.assert_allclose(expected / np.linalg.norm(expected), embeddings[row], rtol=1e-6, atol=1e-7)
+
+    def test_incremental_rebuild_encodes_only_changed_chunks(self):
+        """Test that unchanged chunks reuse their vectors, changed and new ones are encoded and removed ones dropped"""
+        self.write_docs([structured_doc('payments', ["Create a payment.", "Capture it later."]),
+                         structured_doc('refunds', ["Refund a charge."]),
+                         structured_doc('webhooks', [], code_examples=["handle(event)"])])
+        documents, embeddings = self.build(incremental=True)
+        self.assertEqual(4, len(self.model.encoded))
+        first = {doc['text']: embeddings[row] for row, doc in enumerate(documents)}
+
+        self.write_docs([structured_doc('payments', ["Create a payment.", "Capture it later."]),
+                         structured_doc('refunds', ["Refund part of a charge."]),
+                         structured_doc('disputes', ["Respond to a dispute."])])
+        documents, embeddings = self.build(incremental=True)
+
+        self.assertEqual(["Refund part of a charge.", "Respond to a dispute."], self.model.encoded)
+        texts = [doc['text'] for doc in documents]
+        self.assertEqual(["Create a payment.", "Capture it later.", "Refund part of a charge.",
+                          "Respond to a dispute."], texts)
+        for row, text in enumerate(texts[:2]):
+            np.testing.assert_allclose(first[text], embeddings[row], rtol=1e-6)
+
+        # Without incremental, everything is encoded again
+        self.build(incremental=False)
+        self.assertEqual(4, len(self.model.encoded))
+
+    def test_changed_model_or_chunking_forces_full_rebuild(self):
+        """Test that a store built with another model or chunk size is not reused"""
+        self.write_docs([structured_doc('payments', ["Create a payment.", "Capture it later."])])
+        self.build(incremental=True)
+        self.assertEqual(CHUNK_SIZE, previous_build_settings(self.store_dir)['chunk_size'])
+
+        self.build(incremental=True)
+        self.assertEqual([], self.model.encoded)
+
+        self.build(incremental=True, model_name='other-model')
+        self.assertEqual(2, len(self.model.encoded))
+        self.assertEqual('other-model', previous_build_settings(self.store_dir)['model'])
+
+        with mock.patch.object(embedder, 'CHUNK_SIZE', CHUNK_SIZE // 2):
+            self.build(incremental=True, model_name='other-model')
+        self.assertEqual(2, len(self.model.encoded))
+        self.assertEqual(CHUNK_SIZE // 2, previous_build_settings(self.store_dir)['chunk_size'])
+
+
+if __name__ == "__main__":
+    unittest.main()
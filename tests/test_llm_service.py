@@ -0,0 +1,207 @@
+import unittest
+import json
+import os
+import tempfile
+import shutil
+import sys
+import threading
+import time
+import asyncio
+import gc
+import warnings
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Add parent directory to path so we can import modules
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from llm_service import LLMService, LLMServiceError, CircuitOpenError, CircuitBreaker
+from intent_recognizer import IntentRecognizer
+from code_generator import CodeGenerator
+from payment_api_agent import PaymentAPIAgentWithLLM
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # Statuses to answer with, in order; 200 once the list is used up
+    statuses = []
+    delay = 0
+    requests = 0
+    truncate = False
+    stream_tokens = ['Use ', 'a ', 'PaymentIntent']
+
+    def do_POST(self):
+        StubHandler.requests += 1
+        payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        time.sleep(StubHandler.delay)
+
+        status = StubHandler.statuses.pop(0) if StubHandler.statuses else 200
+        if status != 200:
+            self.send_response(status)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        if payload.get('stream'):
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.end_headers()
+            for token in StubHandler.stream_tokens:
+                event = {'type': 'content_block_delta', 'index': 0, 'delta': {'type': 'text_delta', 'text': token}}
+                self.wfile.write(f"event: content_block_delta\ndata: {json.dumps(event)}\n\n".encode('utf-8'))
+                self.wfile.flush()
+            self.wfile.write(b'event: message_stop\ndata: {"type": "message_stop"}\n\n')
+            return
+
+        body = json.dumps({'content': [{'type': 'text', 'text': 'stub answer'}]}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if StubHandler.truncate:
+            # Drop the connection halfway through the promised body
+            self.wfile.write(body[:len(body) // 2])
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestLLMService(unittest.TestCase):
+    def setUp(self):
+        """Start a local stub of the messages API"""
+        StubHandler.statuses = []
+        StubHandler.delay = 0
+        StubHandler.requests = 0
+        StubHandler.truncate = False
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.service = self.make_service()
+
+    def tearDown(self):
+        """Stop the server"""
+        self.service.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def make_service(self, **options):
+        options.setdefault('backoff', 0.01)
+        options.setdefault('max_retries', 2)
+        service = LLMService(api_key='test', **options)
+        service.api_url = f"http://127.0.0.1:{self.server.server_address[1]}/v1/messages"
+        return service
+
+    def test_retries_transient_errors(self):
+        """Test that 429 and 5xx responses are retried with backoff"""
+        StubHandler.statuses = [429, 503]
+        self.assertEqual('stub answer', self.service.generate_response([{'role': 'user', 'content': 'hi'}]))
+        self.assertEqual(3, StubHandler.requests)
+
+    def test_gives_up_after_retries_and_on_client_errors(self):
+        """Test that persistent failures and non-retryable statuses raise LLMServiceError"""
+        StubHandler.statuses = [500, 500, 500]
+        with self.assertRaises(LLMServiceError):
+            self.service.generate_response([{'role': 'user', 'content': 'hi'}])
+
+        StubHandler.requests = 0
+        StubHandler.statuses = [400]
+        with self.assertRaises(LLMServiceError):
+            self.service.generate_response([{'role': 'user', 'content': 'hi'}])
+        self.assertEqual(1, StubHandler.requests)
+
+    def test_read_timeout(self):
+        """Test that a hung upstream fails after the read timeout instead of blocking"""
+        service = self.make_service(read_timeout=0.2, max_retries=0)
+        StubHandler.delay = 1.0
+
+        start = time.time()
+        with self.assertRaises(LLMServiceError):
+            service.generate_response([{'role': 'user', 'content': 'hi'}])
+        self.assertLess(time.time() - start, 1.0)
+
+    def test_circuit_breaker(self):
+        """Test that the circuit opens after repeated failures and closes after a successful trial"""
+        service = self.make_service(max_retries=0, breaker=CircuitBreaker(failure_threshold=2, reset_timeout=0.2))
+        StubHandler.statuses = [503, 503]
+        for _ in range(2):
+            with self.assertRaises(LLMServiceError):
+                service.generate_response([{'role': 'user', 'content': 'hi'}])
+
+        # Open: fails fast without calling the API
+        with self.assertRaises(CircuitOpenError):
+            service.generate_response([{'role': 'user', 'content': 'hi'}])
+        self.assertEqual(2, StubHandler.requests)
+
+        # Half-open after the reset timeout: the trial call succeeds and closes the circuit
+        time.sleep(0.25)
+        self.assertEqual('stub answer', service.generate_response([{'role': 'user', 'content': 'hi'}]))
+        self.assertEqual('closed', service.breaker.state)
+
+    def test_connection_dropped_mid_body(self):
+        """Test that a truncated response body raises LLMServiceError and counts as a breaker failure"""
+        StubHandler.truncate = True
+        with self.assertRaises(LLMServiceError):
+            self.service.generate_response([{'role': 'user', 'content': 'hi'}])
+        self.assertEqual(1, self.service.breaker.failures)
+
+        async def agenerate():
+            try:
+                return await self.service.agenerate_response([{'role': 'user', 'content': 'hi'}])
+            finally:
+                await self.service.aclose()
+
+        with self.assertRaises(LLMServiceError):
+            asyncio.run(agenerate())
+        self.assertEqual(2, self.service.breaker.failures)
+
+    def test_async_sessions_closed_across_event_loops(self):
+        """Test that a session left by a finished event loop is closed, and aclose closes the rest"""
+        sessions = []
+
+        async def agenerate():
+            answer = await self.service.agenerate_response([{'role': 'user', 'content': 'hi'}])
+            sessions.append(self.service.session())
+            return answer
+
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            self.assertEqual('stub answer', asyncio.run(agenerate()))
+            self.assertEqual('stub answer', asyncio.run(agenerate()))
+            self.assertIsNot(sessions[0], sessions[1])
+            self.assertTrue(sessions[0].closed)
+            self.assertFalse(sessions[1].closed)
+
+            asyncio.run(self.service.aclose())
+            self.assertTrue(sessions[1].closed)
+            sessions.clear()
+            gc.collect()
+        self.assertEqual([], [str(w.message) for w in caught if 'Unclosed client session' in str(w.message)])
+
+    def test_stream_response(self):
+        """Test that streamed text deltas are yielded in order"""
+        tokens = list(self.service.stream_response([{'role': 'user', 'content': 'hi'}]))
+        self.assertEqual(StubHandler.stream_tokens, tokens)
+
+    def test_agent_falls_back_without_llm(self):
+        """Test that the agent answers from templates when the LLM API is down"""
+        templates_dir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(templates_dir, "templates.json"), "w") as f:
+                json.dump({"stripe_payment_processing_python": {
+                    "code": "stripe.PaymentIntent.create()", "explanation": "Test template", "requires": []
+                }}, f)
+            agent = PaymentAPIAgentWithLLM(IntentRecognizer(), {}, CodeGenerator(templates_dir),
+                                           self.make_service(max_retries=0))
+            StubHandler.statuses = [503]
+
+            response = agent.process_query("How do I process a payment with Stripe in Python?")
+
+            self.assertIn("stripe.PaymentIntent.create()", response["message"])
+            self.assertEqual("assistant", agent.conversation_history[-1]["role"])
+        finally:
+            shutil.rmtree(templates_dir)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,93 @@
+import unittest
+import os
+import tempfile
+import shutil
+import sys
+import threading
+from http.server import ThreadingHTTPServer
+from unittest import mock
+import numpy as np
+
+# Add parent directory to path so we can import modules
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import populate_kb
+from populate_kb import run_pipeline, parse_args
+from embedder import clean_and_structure_docs, create_embeddings
+from vector_store import read_store
+from tests.test_scraper import FixtureHandler, PAGES
+from tests.test_embedder import StubModel
+
+
+class TestPopulatePipeline(unittest.TestCase):
+    def setUp(self):
+        """Serve the scraper's fixture site and run the pipeline in a scratch directory"""
+        FixtureHandler.flaky_failures = {}
+        FixtureHandler.requests = []
+        FixtureHandler.not_modified = []
+        self.original_pages = dict(PAGES)
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), FixtureHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        base_url = f"http://127.0.0.1:{self.server.server_address[1]}/"
+
+        self.original_dir = os.getcwd()
+        self.test_dir = tempfile.mkdtemp()
+        os.chdir(self.test_dir)
+        os.makedirs("structured_knowledge")
+
+        self.model = StubModel()
+        patches = [mock.patch('populate_kb.get_provider_config', return_value={'base_url': base_url}),
+                   mock.patch('embedder.get_model', return_value=self.model)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        os.chdir(self.original_dir)
+        shutil.rmtree(self.test_dir)
+        self.server.shutdown()
+        self.server.server_close()
+        PAGES.clear()
+        PAGES.update(self.original_pages)
+
+    def run_pipeline(self, *argv):
+        self.model.encoded = []
+        args = parse_args(["--provider", "stripe", "--workers", "2", *argv])
+        with mock.patch('populate_kb.clean_and_structure_docs', wraps=clean_and_structure_docs) as clean:
+            run_pipeline(["stripe"], args)
+        return clean
+
+    def test_pages_cleaned_while_crawling_match_serial_build(self):
+        """Test that cleaning pages as they are crawled gives the same store as cleaning them afterwards"""
+        clean = self.run_pipeline()
+        pages = sorted(name for name in os.listdir("knowledge_base/stripe") if not name.startswith('.'))
+        self.assertEqual(3, len(pages))
+        self.assertEqual(pages, sorted(clean.call_args.kwargs['cleaned']))
+
+        clean_and_structure_docs("knowledge_base/stripe", "structured_knowledge/serial.jsonl")
+        create_embeddings("structured_knowledge/serial.jsonl", "serial_store")
+        with open("structured_knowledge/stripe.jsonl") as pipelined, open("structured_knowledge/serial.jsonl") as serial:
+            self.assertEqual(serial.read(), pipelined.read())
+
+        documents, embeddings, _ = read_store("vector_db/stripe")
+        serial_documents, serial_embeddings, _ = read_store("serial_store")
+        self.assertEqual(serial_documents, documents)
+        np.testing.assert_array_equal(serial_embeddings, embeddings)
+
+    def test_no_incremental_forces_full_rebuild(self):
+        """Test that rebuilds encode only changed chunks by default and everything with --no-incremental"""
+        self.run_pipeline()
+        total = len(read_store("vector_db/stripe")[0])
+        self.assertEqual(total, len(self.model.encoded))
+
+        PAGES['/docs/refunds'] = '<html><title>Refunds</title><body><main>Refunds changed.</main></body></html>'
+        self.run_pipeline()
+        self.assertEqual(["Refunds changed."], self.model.encoded)
+
+        PAGES['/docs/refunds'] = '<html><title>Refunds</title><body><main>Refunds changed again.</main></body></html>'
+        self.run_pipeline("--no-incremental")
+        self.assertEqual(total, len(self.model.encoded))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,227 @@
+import unittest
+import json
+import os
+import tempfile
+import shutil
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Add parent directory to path so we can import modules
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from scraper import scrape_documentation, filename_for, CRAWL_CACHE_FILE
+
+# Fixture site: the start page links to two doc pages, one of which links deeper
+PAGES = {
+    '/': '<html><title>Home</title><body>'
+         '<a href="/docs/payments">Payments</a> <a href="/docs/refunds#top">Refunds</a>'
+         '<a href="/blog/news">Blog</a> <a href="https://example.com/docs/other">External</a>'
+         '</body></html>',
+    '/docs/payments': '<html><title>Payments</title><body><article>Create a PaymentIntent.'
+                      '<pre>stripe.paymentIntents.create()</pre>'
+                      '<a href="/docs/payments/cards">Cards</a></article></body></html>',
+    '/docs/refunds': '<html><title>Refunds</title><body><main>Refund a charge.</main></body></html>',
+    '/docs/payments/cards': '<html><title>Cards</title><body><main>Accept cards.</main></body></html>',
+}
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    flaky_failures = {}
+    requests = []
+    not_modified = []
+
+    def do_GET(self):
+        FixtureHandler.requests.append(self.path)
+
+        # Fail the first request for flaky paths with a retryable status
+        if FixtureHandler.flaky_failures.get(self.path, 0) > 0:
+            FixtureHandler.flaky_failures[self.path] -= 1
+            self.send_response(503)
+            self.end_headers()
+            return
+
+        body = PAGES.get(self.path)
+        if body is None:
+            self.send_response(404)
+            self.end_headers()
+            return
+
+        # Answer conditional requests for unchanged pages with a 304
+        etag = f'"{hash(body)}"'
+        if self.headers.get('If-None-Match') == etag:
+            FixtureHandler.not_modified.append(self.path)
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        data = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestScraper(unittest.TestCase):
+    def setUp(self):
+        """Start a local fixture server"""
+        FixtureHandler.flaky_failures = {}
+        FixtureHandler.requests = []
+        FixtureHandler.not_modified = []
+        self.original_pages = dict(PAGES)
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), FixtureHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}/"
+        self.output_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Stop the server and clean up"""
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.output_dir)
+        PAGES.clear()
+        PAGES.update(self.original_pages)
+
+    def page_file(self, path):
+        return f"{filename_for(self.base_url + path.lstrip('/'))}.json"
+
+    def saved_documents(self):
+        documents = {}
+        for filename in os.listdir(self.output_dir):
+            if filename.startswith('.'):
+                continue
+            with open(os.path.join(self.output_dir, filename), 'r') as f:
+                doc = json.load(f)
+            documents[doc['url'].replace(self.base_url, '/')] = doc
+        return documents
+
+    def test_crawl_follows_doc_links_to_depth(self):
+        """Test that only same-host doc pages within the depth limit are saved"""
+        scrape_documentation(self.base_url, self.output_dir, max_depth=2, rate_limit=0)
+        documents = self.saved_documents()
+
+        self.assertEqual({'/docs/payments', '/docs/refunds', '/docs/payments/cards'}, set(documents))
+        self.assertEqual('Payments', documents['/docs/payments']['title'])
+        self.assertIn('stripe.paymentIntents.create()', documents['/docs/payments']['code_examples'])
+        self.assertNotIn('/blog/news', FixtureHandler.requests)
+
+    def test_crawl_respects_depth_and_page_cap(self):
+        """Test that max_depth and max_pages bound the crawl"""
+        scrape_documentation(self.base_url, self.output_dir, max_depth=1, rate_limit=0)
+        self.assertEqual({'/docs/payments', '/docs/refunds'}, set(self.saved_documents()))
+
+        shutil.rmtree(self.output_dir)
+        scrape_documentation(self.base_url, self.output_dir, max_depth=2, max_pages=1, rate_limit=0)
+        self.assertEqual(1, len(self.saved_documents()))
+
+    def test_crawl_retries_transient_errors(self):
+        """Test that a 503 is retried instead of dropping the page"""
+        FixtureHandler.flaky_failures = {'/docs/refunds': 1}
+        scrape_documentation(self.base_url, self.output_dir, max_depth=1, rate_limit=0)
+
+        self.assertIn('/docs/refunds', self.saved_documents())
+        self.assertEqual(2, FixtureHandler.requests.count('/docs/refunds'))
+
+    def test_recrawl_uses_conditional_requests(self):
+        """Test that unchanged pages come back as 304 and are reported as unchanged"""
+        first = scrape_documentation(self.base_url, self.output_dir, max_depth=2, rate_limit=0)
+        self.assertEqual(3, len(first['changed']))
+
+        PAGES['/docs/refunds'] = '<html><title>Refunds</title><body><main>Refunds changed.</main></body></html>'
+        second = scrape_documentation(self.base_url, self.output_dir, max_depth=2, rate_limit=0)
+
+        self.assertEqual([self.page_file('/docs/refunds')], second['changed'])
+        self.assertEqual({self.page_file('/docs/payments'), self.page_file('/docs/payments/cards')},
+                         set(second['unchanged']))
+        self.assertIn('/docs/payments/cards', FixtureHandler.not_modified)
+        self.assertEqual('Refunds changed.', self.saved_documents()['/docs/refunds']['content'])
+
+    def test_pages_are_reported_as_they_are_saved(self):
+        """Test that on_page sees each page on disk before the crawl returns"""
+        seen = []
+
+        def on_page(filename, changed):
+            self.assertTrue(os.path.exists(os.path.join(self.output_dir, filename)))
+            seen.append((filename, changed))
+
+        first = scrape_documentation(self.base_url, self.output_dir, max_depth=2, rate_limit=0, on_page=on_page)
+        self.assertEqual(sorted((name, True) for name in first['changed']), sorted(seen))
+
+        seen.clear()
+        second = scrape_documentation(self.base_url, self.output_dir, max_depth=2, rate_limit=0, on_page=on_page)
+        self.assertEqual(sorted((name, False) for name in second['unchanged']), sorted(seen))
+
+    def test_complete_crawl_removes_stale_pages(self):
+        """Test that pages the crawl no longer reaches are deleted, unless a page failed"""
+        with open(os.path.join(self.output_dir, "doc_0.json"), "w") as f:
+            json.dump({'url': self.base_url + 'old', 'title': 'Old', 'content': '', 'code_examples': []}, f)
+        first = scrape_documentation(self.base_url, self.output_dir, max_depth=2, rate_limit=0)
+        self.assertEqual(['doc_0.json'], first['removed'])
+        self.assertEqual({'/docs/payments', '/docs/refunds', '/docs/payments/cards'}, set(self.saved_documents()))
+
+        # A failed page keeps what was saved before; a page that is gone is removed with its cache entry
+        del PAGES['/docs/payments/cards']
+        FixtureHandler.flaky_failures = {'/docs/refunds': 10}
+        second = scrape_documentation(self.base_url, self.output_dir, max_depth=2, rate_limit=0)
+        self.assertEqual([], second['removed'])
+        self.assertIn('/docs/payments/cards', self.saved_documents())
+
+        FixtureHandler.flaky_failures = {}
+        third = scrape_documentation(self.base_url, self.output_dir, max_depth=2, rate_limit=0)
+        self.assertEqual([self.page_file('/docs/payments/cards')], third['removed'])
+        self.assertNotIn(self.page_file('/docs/payments/cards'), self.cached_files())
+
+    def cached_files(self):
+        with open(os.path.join(self.output_dir, CRAWL_CACHE_FILE)) as f:
+            return {entry.get('filename') for entry in json.load(f).values()} - {None}
+
+    def test_failed_start_page_keeps_saved_pages(self):
+        """Test that a 404 start page counts as a failure instead of emptying the knowledge base"""
+        scrape_documentation(self.base_url, self.output_dir, max_depth=2, rate_limit=0)
+        del PAGES['/']
+        result = scrape_documentation(self.base_url, self.output_dir, max_depth=2, rate_limit=0)
+
+        self.assertEqual([], result['removed'])
+        self.assertEqual({'/docs/payments', '/docs/refunds', '/docs/payments/cards'}, set(self.saved_documents()))
+        self.assertEqual(3, len(self.cached_files()))
+
+    def test_tighter_limits_keep_pages_they_do_not_reach(self):
+        """Test that a rerun with a smaller page cap or depth does not delete pages past its limits"""
+        scrape_documentation(self.base_url, self.output_dir, max_depth=2, rate_limit=0)
+        expected = {'/docs/payments', '/docs/refunds', '/docs/payments/cards'}
+
+        capped = scrape_documentation(self.base_url, self.output_dir, max_depth=2, max_pages=1, rate_limit=0)
+        self.assertEqual([], capped['removed'])
+        self.assertEqual(expected, set(self.saved_documents()))
+
+        shallow = scrape_documentation(self.base_url, self.output_dir, max_depth=1, rate_limit=0)
+        self.assertEqual([], shallow['removed'])
+        self.assertEqual(expected, set(self.saved_documents()))
+        self.assertEqual(3, len(self.cached_files()))
+
+        # Back at the original limits, the crawl is complete again and prunes as before
+        del PAGES['/docs/payments/cards']
+        full = scrape_documentation(self.base_url, self.output_dir, max_depth=2, rate_limit=0)
+        self.assertEqual([self.page_file('/docs/payments/cards')], full['removed'])
+
+    def test_similar_urls_get_separate_files(self):
+        """Test that URLs differing only in punctuation or query string are not saved over each other"""
+        urls = ['/docs/a-b', '/docs/a_b', '/docs/a/b', '/docs/x?lang=py', '/docs/x?lang=node']
+        PAGES['/'] = '<html><body>' + ''.join(f'<a href="{url}">{url}</a>' for url in urls) + '</body></html>'
+        for url in urls:
+            PAGES[url] = f'<html><title>{url}</title><body><main>Page {url}</main></body></html>'
+
+        result = scrape_documentation(self.base_url, self.output_dir, max_depth=1, rate_limit=0)
+        self.assertEqual(len(urls), len(set(result['changed'])))
+        self.assertEqual(set(urls), set(self.saved_documents()))
+        self.assertEqual(len(urls), len(self.cached_files()))
+
+
+if __name__ == "__main__":
+    unittest.main()
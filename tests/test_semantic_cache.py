@@ -0,0 +1,116 @@
+import unittest
+import json
+import os
+import tempfile
+import shutil
+import sys
+import time
+import numpy as np
+
+# Add parent directory to path so we can import modules
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from semantic_cache import SemanticCache, MemoryBackend, SQLiteBackend, result_ids
+from intent_recognizer import IntentRecognizer
+from code_generator import CodeGenerator
+from vector_store import VectorStore, write_store
+from payment_api_agent import PaymentAPIAgentWithLLM
+
+
+def unit(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+class CountingLLMService:
+    def __init__(self):
+        self.calls = 0
+
+    def generate_response(self, messages, context=None):
+        self.calls += 1
+        return f"answer {self.calls}"
+
+
+class TestSemanticCache(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def backends(self, **options):
+        return [MemoryBackend(**options), SQLiteBackend(os.path.join(self.test_dir, "cache.sqlite3"), **options)]
+
+    def test_similar_query_hits_within_scope(self):
+        """Test that a close embedding hits, and a distant one or another scope misses"""
+        for backend in self.backends():
+            cache = SemanticCache(backend, threshold=0.9)
+            cache.put(unit([1, 0, 0]), 'stripe', 'python', ['a#1'], "refund answer")
+
+            self.assertEqual("refund answer", cache.get(unit([1, 0.1, 0]), 'stripe', 'python', ['a#1']))
+            self.assertIsNone(cache.get(unit([0, 1, 0]), 'stripe', 'python', ['a#1']))
+            self.assertIsNone(cache.get(unit([1, 0, 0]), 'stripe', 'ruby', ['a#1']))
+            self.assertIsNone(cache.get(unit([1, 0, 0]), 'stripe', 'python', ['b#1']))
+
+            stats = cache.stats()
+            self.assertEqual((1, 3), (stats['hits'], stats['misses']))
+            self.assertEqual(0.25, stats['hit_rate'])
+            backend.clear()
+
+    def test_eviction_and_expiry(self):
+        """Test LRU eviction past max_entries and expiry after the TTL"""
+        for backend in self.backends(max_entries=2, ttl=0):
+            cache = SemanticCache(backend, threshold=0.9)
+            cache.put(unit([1, 0, 0]), 'stripe', None, ['a'], "a")
+            time.sleep(0.01)
+            cache.put(unit([0, 1, 0]), 'stripe', None, ['b'], "b")
+            time.sleep(0.01)
+            # Using "a" makes "b" the least recently used entry
+            self.assertEqual("a", cache.get(unit([1, 0, 0]), 'stripe', None, ['a']))
+            time.sleep(0.01)
+            cache.put(unit([0, 0, 1]), 'stripe', None, ['c'], "c")
+
+            self.assertEqual(2, len(backend))
+            self.assertIsNone(cache.get(unit([0, 1, 0]), 'stripe', None, ['b']))
+            self.assertEqual("a", cache.get(unit([1, 0, 0]), 'stripe', None, ['a']))
+            self.assertEqual(1, cache.stats()['evictions'])
+
+        for backend in self.backends(ttl=0.05):
+            cache = SemanticCache(backend, threshold=0.9)
+            cache.put(unit([1, 0, 0]), 'stripe', None, ['a'], "a")
+            time.sleep(0.1)
+            self.assertIsNone(cache.get(unit([1, 0, 0]), 'stripe', None, ['a']))
+
+    def test_sqlite_entries_survive_reopen(self):
+        """Test that the SQLite backend shares answers across cache instances"""
+        path = os.path.join(self.test_dir, "shared.sqlite3")
+        SemanticCache(SQLiteBackend(path)).put(unit([1, 2, 3]), 'paypal', 'java', ['x'], "shared answer")
+        self.assertEqual("shared answer", SemanticCache(SQLiteBackend(path)).get(unit([1, 2, 3]), 'paypal', 'java', ['x']))
+
+    def test_agent_reuses_llm_answer(self):
+        """Test that a repeated query over the same documentation skips the LLM call"""
+        records = [{"document_id": "https://stripe.com/docs/refunds", "chunk_id": 0, "title": "Refunds",
+                    "text": "Refund a payment by creating a Refund for its PaymentIntent", "category": "refund"}]
+        store_dir = os.path.join(self.test_dir, "stripe")
+        write_store(store_dir, records, np.ones((1, 384), dtype=np.float32))
+        templates_dir = os.path.join(self.test_dir, "templates")
+        os.makedirs(templates_dir)
+        with open(os.path.join(templates_dir, "templates.json"), "w") as f:
+            json.dump({}, f)
+
+        llm_service = CountingLLMService()
+        cache = SemanticCache(MemoryBackend(), threshold=0.9)
+        agent = PaymentAPIAgentWithLLM(IntentRecognizer(), {'stripe': VectorStore(store_dir)},
+                                       CodeGenerator(templates_dir), llm_service, semantic_cache=cache)
+
+        first = agent.process_query("How do I refund a Stripe payment in Python?")
+        second = agent.process_query("how do i refund a  STRIPE payment in python?")
+
+        self.assertEqual(1, llm_service.calls)
+        self.assertEqual(first["message"], second["message"])
+        self.assertTrue(second["cached"])
+        self.assertEqual(["stripe:https://stripe.com/docs/refunds#0"], result_ids(second["documentation"]))
+
+
+if __name__ == "__main__":
+    unittest.main()
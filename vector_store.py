@@ -1,43 +1,660 @@
 import json
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-from sentence_transformers import SentenceTransformer
-from scipy.spatial.distance import cosine
+from model_registry import DEFAULT_MODEL, get_model, encode_query, encode_queries
+from query_cache import LRUCache, normalize_query
+from ann_index import INDEX_FILE, DEFAULT_N_PROBE, IVFIndex
+from bm25_index import BM25_FILE, BM25Builder, BM25Index, reciprocal_rank_fusion
+from quantization import QUANTIZERS, DEFAULT_RERANK_FACTOR, rank_quantized
+
+# On-disk layout of a store directory (vector_db/<provider>/). Each build is
+# written to snapshots/<version>/ and CURRENT names the live snapshot.
+CURRENT_FILE = 'CURRENT'
+SNAPSHOTS_DIR = 'snapshots'
+KEEP_SNAPSHOTS = 2
+EMBEDDINGS_FILE = 'embeddings.npy'    # float32 matrix, one row per chunk
+METADATA_FILE = 'metadata.jsonl'      # one JSON record per row, without the vector
+MANIFEST_FILE = 'manifest.json'       # format version, shape and model
+LEGACY_FILE = 'embeddings.json'       # old format: records with inline float lists
+FORMAT_VERSION = 1
+
+# Hybrid search fuses this many dense and lexical candidates with reciprocal rank fusion
+HYBRID_DEPTH = 50
+RRF_K = 60
+
+# Cosine similarity added to chunks in a requested category. Categories are one keyword-based
+# label per chunk, so they rank matching chunks higher rather than excluding the others.
+CATEGORY_BOOST = 0.05
+
+# Federated searches run their stores in parallel on one shared pool, and only on more than one
+# core over at least this many (query x row) scores; below it, handing the searches to threads
+# costs more than the matrix products it overlaps
+SEARCH_THREADS = os.cpu_count() or 1
+PARALLEL_MIN_SCORES = 50000
+
+# Batch search scores blocks of queries whose (queries x chunks) score matrix stays under this many floats
+BATCH_SCORE_ELEMENTS = 8 * 1024 * 1024
+
+
+def normalize_rows(matrix):
+    """L2-normalize each row of a matrix, leaving all-zero rows untouched"""
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def top_k_indices(scores, top_k):
+    """Return the indices of the top_k highest scores, best first"""
+    if top_k <= 0 or len(scores) == 0:
+        return np.array([], dtype=np.int64)
+    if top_k < len(scores):
+        candidates = np.argpartition(-scores, top_k - 1)[:top_k]
+    else:
+        candidates = np.arange(len(scores))
+    return candidates[np.argsort(-scores[candidates], kind='stable')]
+
+
+class StoreWriter:
+    """Streams records and vectors into a new snapshot of the store in output_dir.
+
+    Rows are appended to disk as they arrive, so memory use does not grow
+    with the corpus. finalize() turns them into embeddings.npy, artifacts
+    (such as search indexes) can then be added, and publish() writes the
+    BM25 index built from the streamed records and atomically
+    switches CURRENT to the snapshot, so readers see either the previous
+    store or the new one, never a mix.
+    """
+
+    def __init__(self, output_dir, dimension, model_name=DEFAULT_MODEL, settings=None):
+        self.output_dir = output_dir
+        self.dimension = dimension
+        self.model_name = model_name
+        self.settings = settings or {}  # build settings recorded in the manifest, e.g. the chunk size
+        self.count = 0
+        self.artifacts = []
+        self.lexical = BM25Builder()
+
+        # Versions are zero-padded nanosecond timestamps, so they sort by age
+        self.version = f"{time.time_ns():020d}"
+        self.snapshot_dir = os.path.join(output_dir, SNAPSHOTS_DIR, self.version)
+        os.makedirs(self.snapshot_dir)
+
+        self.raw_path = os.path.join(self.snapshot_dir, EMBEDDINGS_FILE + '.raw')
+        self.raw_file = open(self.raw_path, 'wb')
+        self.metadata_file = open(os.path.join(self.snapshot_dir, METADATA_FILE), 'w')
+
+    def append(self, records, vectors):
+        vectors = normalize_rows(np.asarray(vectors, dtype=np.float32).reshape(len(records), self.dimension))
+        self.raw_file.write(np.ascontiguousarray(vectors).tobytes())
+        for record in records:
+            self.metadata_file.write(json.dumps({k: v for k, v in record.items() if k != 'embedding'},
+                                                separators=(',', ':')))
+            self.metadata_file.write('\n')
+        self.lexical.add(records)
+        self.count += len(records)
+
+    def finalize(self):
+        """Write embeddings.npy from the streamed rows and return it memory-mapped"""
+        self.raw_file.close()
+        self.metadata_file.close()
+
+        # Prepend the .npy header by copying the raw rows in blocks
+        embeddings_path = os.path.join(self.snapshot_dir, EMBEDDINGS_FILE)
+        with open(embeddings_path, 'wb') as out, open(self.raw_path, 'rb') as raw:
+            header = {'descr': '<f4', 'fortran_order': False, 'shape': (self.count, self.dimension)}
+            np.lib.format.write_array_header_1_0(out, header)
+            shutil.copyfileobj(raw, out, 16 * 1024 * 1024)
+        os.remove(self.raw_path)
+        return np.load(embeddings_path, mmap_mode='r')
+
+    def add_artifact(self, filename, artifact):
+        """Save an object with a save(path) method into the snapshot"""
+        artifact.save(os.path.join(self.snapshot_dir, filename))
+        self.artifacts.append(filename)
+
+    def abort(self):
+        """Discard an unpublished snapshot"""
+        self.raw_file.close()
+        self.metadata_file.close()
+        shutil.rmtree(self.snapshot_dir, ignore_errors=True)
+
+    def publish(self):
+        if BM25_FILE not in self.artifacts:
+            self.add_artifact(BM25_FILE, self.lexical.build())
+
+        with open(os.path.join(self.snapshot_dir, MANIFEST_FILE), 'w') as f:
+            json.dump({
+                'format_version': FORMAT_VERSION,
+                'version': self.version,
+                'count': self.count,
+                'dimension': self.dimension,
+                'dtype': 'float32',
+                'normalized': True,
+                'model': self.model_name,
+                'artifacts': sorted(self.artifacts),
+                **self.settings
+            }, f, indent=2)
+
+        # Publish the snapshot with an atomic rename of the pointer file
+        pointer_tmp = os.path.join(self.output_dir, CURRENT_FILE + '.tmp')
+        with open(pointer_tmp, 'w') as f:
+            f.write(self.version)
+        os.replace(pointer_tmp, os.path.join(self.output_dir, CURRENT_FILE))
+
+        prune_snapshots(self.output_dir, current=self.version)
+        return self.version
+
+
+def write_store(output_dir, records, embeddings, model_name=DEFAULT_MODEL, artifacts=None):
+    """Write records and their vectors as a new snapshot of the store in output_dir.
+
+    artifacts maps file names to objects with a save(path) method, such as
+    search indexes, that are stored in the snapshot next to the vectors.
+    Returns the new snapshot version.
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    writer = StoreWriter(output_dir, embeddings.shape[1], model_name)
+    writer.append(records, embeddings)
+    writer.finalize()
+    for filename, artifact in (artifacts or {}).items():
+        writer.add_artifact(filename, artifact)
+    return writer.publish()
+
+
+def prune_snapshots(output_dir, keep=KEEP_SNAPSHOTS, current=None):
+    """Delete all but the newest `keep` snapshots.
+
+    Workers that still have an older snapshot memory-mapped keep working,
+    the pages stay valid until they drop the mapping.
+    """
+    snapshots_root = os.path.join(output_dir, SNAPSHOTS_DIR)
+    if not os.path.isdir(snapshots_root):
+        return
+    for version in sorted(os.listdir(snapshots_root))[:-keep]:
+        if version == current:
+            continue
+        shutil.rmtree(os.path.join(snapshots_root, version), ignore_errors=True)
+
+
+def resolve_store_dir(path):
+    """Directory holding the live binary files for a store path"""
+    store_dir = path if os.path.isdir(path) else os.path.dirname(path)
+    current_file = os.path.join(store_dir, CURRENT_FILE)
+    if os.path.exists(current_file):
+        with open(current_file, 'r') as f:
+            return os.path.join(store_dir, SNAPSHOTS_DIR, f.read().strip())
+    return store_dir
+
+
+def read_store(path):
+    """Load (documents, embeddings, manifest) from a store directory or legacy JSON file.
+
+    The binary format is memory-mapped read-only, so the matrix is not copied
+    into the process and forked workers share the same page cache.
+    """
+    store_dir = resolve_store_dir(path)
+    manifest_file = os.path.join(store_dir, MANIFEST_FILE)
+
+    if os.path.exists(manifest_file):
+        with open(manifest_file, 'r') as f:
+            manifest = json.load(f)
+        with open(os.path.join(store_dir, METADATA_FILE), 'r') as f:
+            documents = [json.loads(line) for line in f if line.strip()]
+        embeddings = np.load(os.path.join(store_dir, EMBEDDINGS_FILE), mmap_mode='r')
+        if not manifest.get('normalized'):
+            embeddings = normalize_rows(np.asarray(embeddings, dtype=np.float32))
+        return documents, embeddings, manifest
+
+    # Fall back to the legacy JSON file with inline vectors
+    legacy_file = os.path.join(path, LEGACY_FILE) if os.path.isdir(path) else path
+    with open(legacy_file, 'r') as f:
+        data = json.load(f)
+
+    documents = [{k: v for k, v in item.items() if k != 'embedding'} for item in data]
+    if data:
+        embeddings = normalize_rows(np.array([item['embedding'] for item in data], dtype=np.float32))
+    else:
+        embeddings = np.zeros((0, 0), dtype=np.float32)
+    return documents, embeddings, {'format_version': 0, 'count': len(documents), 'normalized': True}
+
 
 class VectorStore:
-    def __init__(self, embeddings_file):
-        # Load embeddings
-        with open(embeddings_file, 'r') as f:
-            data = json.load(f)
+    def __init__(self, embeddings_file, model_name=DEFAULT_MODEL, index_type='flat', n_probe=DEFAULT_N_PROBE,
+                 search_mode='dense', quantization=None, rerank_factor=DEFAULT_RERANK_FACTOR,
+                 result_cache_size=1024, result_cache_ttl=600):
+        # Accepts a store directory, or a legacy embeddings.json path whose
+        # directory is checked for the binary format first
+        self.path = embeddings_file
+        self.default_model_name = model_name
+
+        # 'ivf' scores only the rows in the n_probe closest clusters, 'flat' scores every row
+        self.index_type = index_type
+        self.n_probe = n_probe
+
+        # 'hybrid' fuses the dense ranking with a BM25 ranking, 'dense' uses embeddings only
+        self.search_mode = search_mode
+
+        # 'int8' or 'pq' scores compressed codes instead of the float matrix and
+        # re-ranks the top_k * rerank_factor rows exactly (0 disables re-ranking)
+        self.quantization = quantization
+        self.rerank_factor = rerank_factor
+
+        # Top-k results per (store version, query, k); cleared whenever the store reloads
+        self.result_cache = LRUCache(max_entries=result_cache_size, ttl=result_cache_ttl)
+        self.reloads = 0
+        self.load()
+
+    def load(self):
+        """(Re)read the store files and the optional IVF, BM25 and quantized indexes"""
+        self.documents, self.embeddings, self.manifest = read_store(self.path)
+        self.model_name = self.manifest.get('model', self.default_model_name)
+
+        self.index = None
+        if self.index_type == 'ivf':
+            index_path = os.path.join(resolve_store_dir(self.path), INDEX_FILE)
+            if os.path.exists(index_path):
+                self.index = IVFIndex.load(index_path)
+            else:
+                print(f"No IVF index found for {self.path}, using exact search")
+
+        self.lexical = None
+        if self.search_mode == 'hybrid':
+            lexical_path = os.path.join(resolve_store_dir(self.path), BM25_FILE)
+            if os.path.exists(lexical_path):
+                self.lexical = BM25Index.load(lexical_path)
+            else:
+                # Stores written before BM25 was added: index the records in memory
+                self.lexical = BM25Index.build(self.documents)
+
+        self.quantizer = None
+        if self.quantization and len(self.documents):
+            quantizer_class = QUANTIZERS[self.quantization]
+            codes_path = os.path.join(resolve_store_dir(self.path), quantizer_class.filename)
+            if not os.path.exists(codes_path) and os.path.exists(codes_path + '.npz'):
+                # Snapshots written before the codes were memory-mapped
+                codes_path += '.npz'
+            if os.path.exists(codes_path):
+                self.quantizer = quantizer_class.load(codes_path)
+            else:
+                print(f"No {self.quantization} codes found for {self.path}, using float embeddings")
+
+        self.build_filters()
+
+    def build_filters(self):
+        """Precompute the sorted row indices for every category and language"""
+        categories = {}
+        languages = {}
+        for row, doc in enumerate(self.documents):
+            categories.setdefault(doc.get('category'), []).append(row)
+            languages.setdefault(doc.get('language'), []).append(row)
+        self.category_rows = {k: np.array(v, dtype=np.int64) for k, v in categories.items()}
+        self.language_rows = {k: np.array(v, dtype=np.int64) for k, v in languages.items()}
+
+    def filter_rows(self, language=None):
+        """Rows that are prose or code examples in language.
+
+        Prose chunks have no language and always pass the filter. Returns
+        None when nothing is filtered or nothing matches, so callers fall
+        back to searching every row.
+        """
+        if not language:
+            return None
+        allowed = [self.language_rows[l] for l in (language, None) if l in self.language_rows]
+        rows = np.unique(np.concatenate(allowed)) if allowed else np.array([], dtype=np.int64)
+        if len(rows) == 0 or len(rows) == len(self.documents):
+            return None
+        return rows
+
+    def preferred_rows(self, categories=None, rows=None):
+        """Rows, among rows if given, labelled with any of categories; None if there are none"""
+        matches = [self.category_rows[c] for c in categories or () if c in self.category_rows]
+        if not matches:
+            return None
+        preferred = np.unique(np.concatenate(matches))
+        if rows is not None:
+            preferred = np.intersect1d(preferred, rows, assume_unique=True)
+        return preferred if len(preferred) else None
+
+    def reload(self):
+        """Pick up a rebuilt store and drop results cached for the old one"""
+        self.load()
+        self.reloads += 1
+        self.result_cache.clear()
 
-        self.documents = data
-        self.embeddings = np.array([item['embedding'] for item in data])
-        self.model = SentenceTransformer('all-MiniLM-L6-v2')
+    @property
+    def version(self):
+        return (self.manifest.get('version'), self.reloads)
 
-    def search(self, query, top_k=5):
-        # Encode query
-        query_embedding = self.model.encode(query)
+    @property
+    def model(self):
+        # Resolved through the registry so every store shares one encoder per process
+        return get_model(self.model_name)
 
-        # Calculate distances
-        distances = [1 - cosine(query_embedding, doc_embedding) for doc_embedding in self.embeddings]
+    def encode_query(self, query):
+        """Encode and L2-normalize a query string, shared with other stores on the same model"""
+        return encode_query(query, self.model_name)
 
-        # Get top results
-        top_indices = np.argsort(distances)[-top_k:][::-1]
+    def encode_queries(self, queries):
+        """Encode several queries in one batch, sharing the cache with encode_query"""
+        return encode_queries(queries, self.model_name)
 
+    def search(self, query, top_k=5, categories=None, language=None):
+        """Top-k chunks for query, preferring categories and restricted to a programming language"""
+        categories = tuple(sorted(categories)) if categories else None
+        key = (self.version, normalize_query(query), top_k, categories, language)
+        results = self.result_cache.get(key)
+        if results is None:
+            results = self.search_encoded(query, self.encode_query(query), top_k, categories, language)
+            self.result_cache.put(key, results)
+
+        # Callers annotate the dicts they get back, so never hand out the cached ones
+        return [dict(result) for result in results]
+
+    def search_encoded(self, query, query_embedding, top_k=5, categories=None, language=None):
+        """Search in the store's search mode with the query text and its encoded vector"""
+        if self.lexical is not None:
+            return self.search_hybrid(query, query_embedding, top_k, categories, language)
+        return self.search_vector(query_embedding, top_k, categories, language)
+
+    def search_vector(self, query_embedding, top_k=5, categories=None, language=None):
+        """Search with an already encoded, normalized query vector"""
+        if len(self.documents) == 0:
+            return []
+        rows = self.filter_rows(language)
+        return self.results(self.rank_vector(query_embedding, top_k, rows, self.preferred_rows(categories, rows)))
+
+    def search_hybrid(self, query, query_embedding, top_k=5, categories=None, language=None):
+        """Fuse the dense and BM25 rankings with reciprocal rank fusion.
+
+        relevance_score is the fused score; exact identifiers in the query
+        lift chunks that contain them even when their embeddings are far apart.
+        """
+        if len(self.documents) == 0:
+            return []
+
+        rows = self.filter_rows(language)
+        depth = max(top_k, HYBRID_DEPTH)
+        dense = self.rank_vector(query_embedding, depth, rows, self.preferred_rows(categories, rows))
+        return self.fuse_rankings(query, dense, top_k, rows)
+
+    def fuse_rankings(self, query, dense, top_k, rows=None):
+        """Results for the reciprocal rank fusion of a dense ranking with the query's BM25 ranking"""
+        lexical, _ = self.lexical.rank(query, max(top_k, HYBRID_DEPTH), rows)
+        fused = reciprocal_rank_fusion([[row for row, _ in dense], lexical], k=RRF_K)
+        ranked = sorted(fused.items(), key=lambda item: item[1], reverse=True)[:top_k]
+        return self.results(ranked)
+
+    def search_batch(self, queries, query_embeddings=None, top_k=5, filters=None):
+        """search for several queries at once; query_embeddings has one encoded row per query.
+
+        Without query_embeddings, the queries are encoded here in one batch.
+
+        filters holds a (categories, language) pair per query. Results are
+        shared with search's cache, and the queries that miss it are scored
+        together by rank_vectors.
+        """
+        filters = filters or [(None, None)] * len(queries)
+        keys = []
+        for query, (categories, language) in zip(queries, filters):
+            categories = tuple(sorted(categories)) if categories else None
+            keys.append((self.version, normalize_query(query), top_k, categories, language))
+
+        results = [self.result_cache.get(key) for key in keys]
+        pending = [i for i, cached in enumerate(results) if cached is None]
+        if pending and len(self.documents) == 0:
+            for i in pending:
+                results[i] = []
+        elif pending:
+            if query_embeddings is None:
+                query_embeddings = self.encode_queries(queries)
+            rows = [self.filter_rows(filters[i][1]) for i in pending]
+            preferred = [self.preferred_rows(filters[i][0], query_rows) for i, query_rows in zip(pending, rows)]
+            depth = max(top_k, HYBRID_DEPTH) if self.lexical is not None else top_k
+            rankings = self.rank_vectors(np.asarray(query_embeddings)[pending], depth, rows, preferred)
+            for i, ranked, query_rows in zip(pending, rankings, rows):
+                if self.lexical is not None:
+                    results[i] = self.fuse_rankings(queries[i], ranked, top_k, query_rows)
+                else:
+                    results[i] = self.results(ranked)
+                self.result_cache.put(keys[i], results[i])
+
+        # Callers annotate the dicts they get back, so never hand out the cached ones
+        return [[dict(result) for result in query_results] for query_results in results]
+
+    def rank_vectors(self, query_embeddings, top_k, rows=None, preferred=None):
+        """rank_vector for every row of query_embeddings, each optionally with its own rows and preferred rows.
+
+        Exact float search scores a block of queries against every stored
+        chunk in one matrix-matrix product; IVF and quantized search rank
+        the queries one at a time.
+        """
+        rows = rows if rows is not None else [None] * len(query_embeddings)
+        preferred = preferred if preferred is not None else [None] * len(query_embeddings)
+        if self.index is not None or self.quantizer is not None:
+            return [self.rank_vector(embedding, top_k, query_rows, query_preferred)
+                    for embedding, query_rows, query_preferred in zip(query_embeddings, rows, preferred)]
+
+        rankings = []
+        # Bound the (queries x chunks) score matrix to about BATCH_SCORE_ELEMENTS floats
+        block_size = max(1, BATCH_SCORE_ELEMENTS // max(len(self.documents), 1))
+        for offset in range(0, len(query_embeddings), block_size):
+            scores = query_embeddings[offset:offset + block_size] @ self.embeddings.T
+            block = slice(offset, offset + block_size)
+            for query_scores, query_rows, query_preferred in zip(scores, rows[block], preferred[block]):
+                if query_preferred is not None:
+                    query_scores[query_preferred] += CATEGORY_BOOST
+                if query_rows is None:
+                    rankings.append([(i, query_scores[i]) for i in top_k_indices(query_scores, top_k)])
+                else:
+                    candidate_scores = query_scores[query_rows]
+                    rankings.append([(query_rows[i], candidate_scores[i])
+                                     for i in top_k_indices(candidate_scores, top_k)])
+        return rankings
+
+    def rank_vector(self, query_embedding, top_k, rows=None, preferred=None):
+        """(row, score) pairs of the top_k rows, best first, optionally only among rows.
+
+        The score is the cosine similarity, plus CATEGORY_BOOST for preferred
+        rows. A boosted top-k row is either in the top-k of all rows or in
+        the top-k of the preferred rows, so ranking both is exact.
+        """
+        ranked = self.rank_cosine(query_embedding, top_k, rows)
+        if preferred is None:
+            return ranked
+
+        scores = dict(ranked)
+        scores.update(self.rank_cosine(query_embedding, top_k, preferred))
+        candidates = np.fromiter(scores, dtype=np.int64, count=len(scores))
+        boosted = np.array([scores[row] for row in candidates], dtype=np.float32)
+        boosted[np.isin(candidates, preferred, assume_unique=True)] += CATEGORY_BOOST
+        return [(candidates[i], boosted[i]) for i in top_k_indices(boosted, top_k)]
+
+    def rank_cosine(self, query_embedding, top_k, rows=None):
+        """(row, cosine score) pairs of the top_k rows, best first, optionally only among rows"""
+        candidates = self.candidate_rows(query_embedding, top_k, rows)
+
+        if self.quantizer is not None:
+            # Score the compressed codes, then re-rank a shortlist against the float rows
+            ranked_rows, scores = rank_quantized(self.quantizer, self.embeddings, query_embedding, top_k,
+                                                 candidates, self.rerank_factor)
+            return list(zip(ranked_rows, scores))
+
+        if candidates is None:
+            # Cosine similarity against every stored chunk in one matrix-vector product
+            scores = self.embeddings @ query_embedding
+            return [(i, scores[i]) for i in top_k_indices(scores, top_k)]
+
+        # Only score the sub-matrix of candidate rows
+        scores = self.embeddings[candidates] @ query_embedding
+        return [(candidates[i], scores[i]) for i in top_k_indices(scores, top_k)]
+
+    def candidate_rows(self, query_embedding, top_k, rows=None):
+        """Rows worth scoring for a query: IVF candidates, the filter rows, or None for every row"""
+        if self.index is None:
+            return rows
+
+        # Only score the rows in the closest clusters
+        candidates = self.index.candidates(query_embedding, self.n_probe)
+        if rows is not None:
+            candidates = candidates[np.isin(candidates, rows, assume_unique=True)]
+            if len(candidates) < top_k:
+                # Too few filtered rows near the query; the filtered set is small, score all of it
+                candidates = rows
+        return candidates
+
+    def results(self, ranked):
+        """Result dicts for (row, score) pairs"""
         results = []
-        for idx in top_indices:
+        for idx, score in ranked:
             doc = self.documents[idx].copy()
-            doc['relevance_score'] = float(distances[idx])
-            # Remove the embedding to make output cleaner
-            doc.pop('embedding')
+            doc['relevance_score'] = float(score)
             results.append(doc)
 
         return results
 
-# Create vector stores
-paypal_store = VectorStore("vector_db/paypal/embeddings.json")
-stripe_store = VectorStore("vector_db/stripe/embeddings.json")
+    def cache_stats(self):
+        return self.result_cache.stats()
+
+
+_search_pool = None
+_search_pool_lock = threading.Lock()
+
+
+def search_pool():
+    """The thread pool shared by every federated search, started on first use"""
+    global _search_pool
+    if _search_pool is None:
+        with _search_pool_lock:
+            if _search_pool is None:
+                _search_pool = ThreadPoolExecutor(max_workers=SEARCH_THREADS, thread_name_prefix="federated")
+    return _search_pool
+
+
+def map_stores(search_one, stores, parallel, n_queries=1):
+    """search_one for every (provider, store) item; in parallel when it is allowed and pays off.
+
+    NumPy releases the GIL during the matrix products, so stores are
+    scored concurrently on search_pool.
+    """
+    items = list(stores.items())
+    scores = n_queries * sum(len(store.documents) for store in stores.values())
+    if parallel and len(items) > 1 and SEARCH_THREADS > 1 and scores >= PARALLEL_MIN_SCORES:
+        return list(search_pool().map(search_one, items))
+    return [search_one(item) for item in items]
+
+
+def federated_search(stores, query, top_k=5, parallel=False, categories=None, language=None):
+    """Search several provider stores with one query encode and merge into a global top-k.
+
+    stores maps provider name to VectorStore. Each result is tagged with its
+    provider; categories and language apply to each store as in
+    VectorStore.search. With parallel=True large stores are scored in
+    threads, see map_stores.
+    """
+    # Encode once per distinct model; normally every store shares one
+    embeddings = {}
+    for store in stores.values():
+        if store.model_name not in embeddings:
+            embeddings[store.model_name] = store.encode_query(query)
+
+    def search_one(item):
+        provider, store = item
+        results = store.search_encoded(query, embeddings[store.model_name], top_k, categories, language)
+        for result in results:
+            result['provider'] = provider
+        return results
+
+    per_store = map_stores(search_one, stores, parallel)
+    merged = [result for results in per_store for result in results]
+    merged.sort(key=lambda result: result['relevance_score'], reverse=True)
+    return merged[:top_k]
+
+
+def federated_search_batch(stores, queries, top_k=5, parallel=False, filters=None):
+    """federated_search for several queries: one batch encode per model and one search_batch per store.
+
+    filters holds a (categories, language) pair per query. Returns one
+    merged, provider-tagged top-k list per query.
+    """
+    embeddings = {}
+    for store in stores.values():
+        if store.model_name not in embeddings:
+            embeddings[store.model_name] = store.encode_queries(queries)
+
+    def search_one(item):
+        provider, store = item
+        per_query = store.search_batch(queries, embeddings[store.model_name], top_k, filters)
+        for results in per_query:
+            for result in results:
+                result['provider'] = provider
+        return per_query
+
+    per_store = map_stores(search_one, stores, parallel, len(queries))
+
+    merged = []
+    for i in range(len(queries)):
+        results = [result for store_results in per_store for result in store_results[i]]
+        results.sort(key=lambda result: result['relevance_score'], reverse=True)
+        merged.append(results[:top_k])
+    return merged
+
+
+def federated_benchmark(rows, n_stores=2, dimension=384, iterations=50):
+    """ms per federated query over synthetic stores: serial, the shared pool, and a pool started per query"""
+    import tempfile
+
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as tmp:
+        stores = {}
+        for i in range(n_stores):
+            records = [{'document_id': f"doc{row}", 'chunk_id': 0, 'text': ''} for row in range(rows)]
+            write_store(os.path.join(tmp, str(i)), records, rng.normal(size=(rows, dimension)))
+            stores[f"provider{i}"] = VectorStore(os.path.join(tmp, str(i)))
+        query = normalize_rows(rng.normal(size=(1, dimension)).astype(np.float32))[0]
+
+        def search_one(item):
+            return item[1].search_vector(query, top_k=5)
+
+        def per_query_pool():
+            with ThreadPoolExecutor(max_workers=len(stores)) as executor:
+                return list(executor.map(search_one, stores.items()))
+
+        timings = {}
+        for label, run in [("serial", lambda: [search_one(item) for item in stores.items()]),
+                           ("shared pool", lambda: list(search_pool().map(search_one, stores.items()))),
+                           ("pool per query", per_query_pool)]:
+            best = float('inf')
+            for _ in range(5):
+                start = time.perf_counter()
+                for _ in range(iterations):
+                    run()
+                best = min(best, (time.perf_counter() - start) / iterations * 1000)
+            timings[label] = best
+        return timings
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Example search, or time serial against parallel federated search")
+    parser.add_argument("--benchmark", type=int, nargs='*', metavar="ROWS",
+                        help="Rows per store to time federated search at, e.g. --benchmark 1000 20000 100000")
+    args = parser.parse_args()
 
-# Example search
-results = paypal_store.search("How do I process a payment?")
-print(json.dumps(results[:2], indent=2))
+    if args.benchmark is not None:
+        print(f"{SEARCH_THREADS} search threads")
+        for rows in args.benchmark or [1000, 20000, 100000]:
+            timings = federated_benchmark(rows)
+            print(f"{rows:>8} rows/store  " + "  ".join(f"{label} {ms:.2f} ms" for label, ms in timings.items()))
+    else:
+        # Create vector stores
+        paypal_store = VectorStore("vector_db/paypal/embeddings.json")
+        stripe_store = VectorStore("vector_db/stripe/embeddings.json")
 
+        # Example search
+        results = paypal_store.search("How do I process a payment?")
+        print(json.dumps(results[:2], indent=2))